@@ -0,0 +1,121 @@
+"""Benchmark parse_query against the substring scans it replaced
+
+Run from the repository root:
+
+    python benchmarks/query_parser_bench.py [number of queries]
+
+Both parsers must agree on every query of the corpus before timings are
+printed.
+"""
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.services.query_parser import (
+    BLOOD_METRICS, COMMON_EXERCISES, COMPARISON_METRICS, COMPARISON_PERIODS, DEFAULT_TIME_RANGE,
+    INTENT_KEYWORDS, MEAL_TYPES, METRIC_TERMS, TIME_RANGES, PatternMatcher, _vocabulary, matcher, parse_query
+)
+
+
+def legacy_parse(query_text):
+    """The per-keyword substring scans parse_query replaced, frozen as the reference it must agree with"""
+    query_text = query_text.lower().strip()
+    scores = {intent: 0 for intent in INTENT_KEYWORDS}
+    for intent, keywords in INTENT_KEYWORDS.items():
+        for keyword in keywords:
+            if keyword in query_text:
+                scores[intent] += 1
+    max_score = max(scores.values())
+    intent = None
+    if max_score > 0:
+        top_intents = [name for name, score in scores.items() if score == max_score]
+        if len(top_intents) == 1:
+            intent = top_intents[0]
+    if intent is None:
+        intent = 'comparison' if ('compare' in query_text or ' vs ' in query_text or 'versus' in query_text) else 'summary'
+
+    time_range = DEFAULT_TIME_RANGE
+    for phrase, value in TIME_RANGES:
+        if phrase in query_text:
+            time_range = value
+            break
+
+    # Scans the handlers made after routing
+    terms = [term for term in METRIC_TERMS if term in query_text]
+    meal_types = [meal_type for meal_type in MEAL_TYPES if meal_type in query_text]
+    exercises = [exercise for exercise in COMMON_EXERCISES if exercise in query_text]
+    blood_metrics = [name for name, keywords in BLOOD_METRICS if any(keyword in query_text for keyword in keywords)]
+    periods = [period for period in COMPARISON_PERIODS if period in query_text]
+    metrics = [metric for metric in COMPARISON_METRICS if metric in query_text]
+    return intent, time_range, terms, meal_types, exercises, blood_metrics, periods, metrics
+
+
+def benchmark_corpus(size, seed=42):
+    """Realistic chat queries built from templates"""
+    rng = random.Random(seed)
+    templates = [
+        "How many {metric} did I get {period}?",
+        "What was my average {metric} {period}",
+        "Show me my {meal} calories {period}",
+        "How has my {lift} progressed {period}?",
+        "Compare my {metric} {period} vs {period2}",
+        "What is my latest {blood} level?",
+        "Did I take my medication {period}?",
+        "Give me a health summary for {period}",
+        "How much deep sleep did I get {period} compared to {period2}?",
+        "What was my heart rate during my last run {period}",
+        "How far did I walk {period} and how many steps",
+        "Is my {blood} normal in my last blood test report",
+        "Show my workout volume and duration {period}",
+        "Steps vs calories {period}",
+        "overview of my diet and nutrition {period}, especially protein and carbs",
+        "what's my sleep score been like {period}"
+    ]
+    words = {
+        'metric': ['steps', 'calories', 'sleep', 'heart rate', 'distance', 'protein', 'rem sleep', 'weight'],
+        'period': ['today', 'yesterday', 'this week', 'last week', 'this month', 'last month', 'in the last 30 days', 'over the past year', ''],
+        'meal': MEAL_TYPES,
+        'lift': COMMON_EXERCISES,
+        'blood': ['cholesterol', 'LDL', 'blood sugar', 'hemoglobin', 'vitamin D', 'TSH', 'iron', 'platelet']
+    }
+    corpus = []
+    for _ in range(size):
+        values = {key: rng.choice(options) for key, options in words.items()}
+        values['period2'] = rng.choice(words['period'])
+        corpus.append(rng.choice(templates).format(**values))
+    return corpus
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    corpus = benchmark_corpus(size)
+
+    # Both parsers must agree before their speed means anything
+    for query_text in corpus:
+        parsed = parse_query(query_text)
+        legacy = legacy_parse(query_text)
+        current = (
+            parsed.intent, parsed.time_range, [term for term in METRIC_TERMS if parsed.has(term)], parsed.meal_types,
+            parsed.exercises, parsed.blood_metrics, parsed.periods, parsed.metrics
+        )
+        assert current == legacy, (query_text, current, legacy)
+
+    started = time.perf_counter()
+    for query_text in corpus:
+        legacy_parse(query_text)
+    legacy_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for query_text in corpus:
+        parse_query(query_text)
+    parse_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    PatternMatcher(_vocabulary())
+    build_time = time.perf_counter() - started
+
+    print(f"{size} queries, {len(matcher.patterns)} patterns, automaton built in {build_time * 1000:.2f} ms")
+    print(f"substring scans: {legacy_time / size * 1e6:.2f} us/query")
+    print(f"parse_query:     {parse_time / size * 1e6:.2f} us/query ({legacy_time / parse_time:.2f}x)")
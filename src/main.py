@@ -2,9 +2,13 @@ import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))  # DON'T CHANGE THIS !!!
 
+import json
+import time
+import click
 from flask import Flask, jsonify, request, send_from_directory
 from flask_cors import CORS
 from src.models.user import db, User
+from src.models.schema import configure_sqlite, upgrade_schema
 from src.routes.strava import strava_bp
 from src.routes.strava_direct import strava_direct_bp
 from src.routes.healthifyme import healthifyme_bp
@@ -13,6 +17,15 @@ from src.routes.blood_report import blood_report_bp
 from src.routes.medication import medication_bp
 from src.routes.hevy import hevy_bp
 from src.routes.chat import chat_bp
+from src.routes.sync import sync_bp
+from src.services.job_queue import job_queue
+from src.services.scheduler import sync_scheduler
+from src.services.orchestrator import sync_all
+from src.services.token_manager import token_manager
+from src.services.events import change_bus
+from src.services.chat_history import chat_history
+from src.services.personal_records import rebuild_personal_records
+from src.services.blood_metrics import backfill_blood_metrics
 import os
 
 app = Flask(__name__)
@@ -34,6 +47,7 @@ app.register_blueprint(blood_report_bp, url_prefix='/api/blood-reports')
 app.register_blueprint(medication_bp, url_prefix='/api/medications')
 app.register_blueprint(hevy_bp, url_prefix='/api/hevy')
 app.register_blueprint(chat_bp, url_prefix='/api/chat')
+app.register_blueprint(sync_bp, url_prefix='/api/sync')
 
 # Serve static files
 @app.route('/', defaults={'path': ''})
@@ -135,9 +149,52 @@ def health_check():
         "message": "Health Dashboard API is running"
     })
 
+@app.cli.command('sync-all')
+@click.option('--source-type', 'source_types', multiple=True, help="Only sync these source types (activity, workout, food, sleep)")
+@click.option('--user-id', 'user_ids', multiple=True, type=int, help="Only sync these users")
+@click.option('--limit', 'limits', multiple=True, help="Concurrency for a source type, e.g. activity=8")
+def sync_all_command(source_types, user_ids, limits):
+    """Sync every active connection and print a summary"""
+    limits = {source_type: int(limit) for source_type, limit in (item.split('=', 1) for item in limits)}
+    summary = sync_all(app, list(source_types) or None, list(user_ids) or None, limits)
+    # Recompute derived data now rather than after a debounce the command won't wait for
+    change_bus.flush(force=True)
+    click.echo(json.dumps(summary, indent=2, default=str))
+
+@app.cli.command('worker')
+def worker_command():
+    """Run the sync workers, the scheduler and the token refresher until interrupted"""
+    start_background_workers()
+    click.echo("Background workers running; press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+
+def start_background_workers():
+    """Start the sync workers, the scheduler feeding them and the token refresher keeping their OAuth tokens valid
+    
+    They must run in a single process: `flask worker` next to web servers
+    with several processes, or the development server's reloader child.
+    """
+    job_queue.start()
+    sync_scheduler.start()
+    token_manager.start()
+
+@app.cli.command('rebuild-personal-records')
+@click.option('--user-id', type=int, help="Only rebuild this user's records")
+def rebuild_personal_records_command(user_id):
+    """Recompute personal records from the full workout history"""
+    written = rebuild_personal_records(user_id)
+    click.echo(f"Rebuilt {written} personal records")
+
 # Create database tables
 with app.app_context():
+    configure_sqlite(db.engine)
     db.create_all()
+    upgrade_schema()
+    backfill_blood_metrics()
     
     # Check if we need to initialize the medication repository
     from src.models.medication import Medication
@@ -145,6 +202,18 @@ with app.app_context():
         from src.routes.medication import initialize_medication_repository
         initialize_medication_repository()
 
+# Bind the background services to the app. Importing the app starts no
+# threads: the change bus and the chat history writer start with their
+# first use in a process, the sync workers with start_background_workers()
+job_queue.init_app(app)
+sync_scheduler.init_app(app)
+token_manager.init_app(app)
+change_bus.init_app(app)
+chat_history.init_app(app)
+
 if __name__ == '__main__':
- app.run(host='0.0.0.0', port=5001, debug=True)
+    # The reloader serves the app from a child process; only that one syncs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
+    app.run(host='0.0.0.0', port=5001, debug=True)
 
@@ -20,6 +20,7 @@ class Activity(db.Model):
     description = db.Column(db.Text, nullable=True)
     route_data = db.Column(db.JSON, nullable=True)  # GPS data if available
     weather_data = db.Column(db.JSON, nullable=True)  # Weather conditions during activity
+    source_fingerprint = db.Column(db.String(64), nullable=True)  # Hash of the source payload, used to skip unchanged records on re-sync
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -38,7 +38,10 @@ class BloodReport(db.Model):
 class BloodMetric(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     blood_report_id = db.Column(db.Integer, db.ForeignKey('blood_report.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=True)  # Copied from the report for indexed trends
+    report_date = db.Column(db.Date, nullable=True)  # Copied from the report for indexed trends
     metric_name = db.Column(db.String(100), nullable=False)
+    metric_code = db.Column(db.String(50), nullable=True)  # Canonical code, see services/blood_metrics.py
     metric_value = db.Column(db.Float, nullable=True)
     unit = db.Column(db.String(50), nullable=True)
     reference_range = db.Column(db.String(100), nullable=True)
@@ -46,6 +49,10 @@ class BloodMetric(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_blood_metric_user_code_date', 'user_id', 'metric_code', 'report_date'),
+    )
+
     def __repr__(self):
         return f'<BloodMetric {self.metric_name}>'
 
@@ -53,7 +60,10 @@ class BloodMetric(db.Model):
         return {
             'id': self.id,
             'blood_report_id': self.blood_report_id,
+            'user_id': self.user_id,
+            'report_date': self.report_date,
             'metric_name': self.metric_name,
+            'metric_code': self.metric_code,
             'metric_value': self.metric_value,
             'unit': self.unit,
             'reference_range': self.reference_range,
@@ -64,3 +64,12 @@ class Insight(db.Model):
             'created_at': self.created_at,
             'updated_at': self.updated_at
         }
+
+
+class IdSequence(db.Model):
+    name = db.Column(db.String(50), primary_key=True)  # Table the ids are handed out for
+    next_id = db.Column(db.Integer, nullable=False)  # First id not yet reserved by any process
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<IdSequence {self.name}:{self.next_id}>'
@@ -76,7 +76,11 @@ class SyncLog(db.Model):
     sync_end_time = db.Column(db.DateTime, nullable=True)
     status = db.Column(db.String(50), nullable=False)  # 'pending', 'success', 'failed'
     items_synced = db.Column(db.Integer, default=0)
+    items_skipped = db.Column(db.Integer, default=0)  # Records unchanged since the last sync
+    items_quarantined = db.Column(db.Integer, default=0)  # Bad records set aside so the rest of the sync could commit
     error_message = db.Column(db.Text, nullable=True)
+    stage_timings = db.Column(db.JSON, nullable=True)  # Seconds spent in each ingestion pipeline stage
+    progress = db.Column(db.JSON, nullable=True)  # Latest progress event, for event streams in other processes
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -97,7 +101,129 @@ class SyncLog(db.Model):
             'sync_end_time': self.sync_end_time,
             'status': self.status,
             'items_synced': self.items_synced,
+            'items_skipped': self.items_skipped,
+            'items_quarantined': self.items_quarantined,
             'error_message': self.error_message,
+            'stage_timings': self.stage_timings,
+            'progress': self.progress,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+
+class SyncJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False)  # Name of the registered job handler, e.g. 'strava_sync'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    data_source_id = db.Column(db.Integer, db.ForeignKey('data_source.id', ondelete='CASCADE'), nullable=False)
+    sync_log_id = db.Column(db.Integer, db.ForeignKey('sync_log.id', ondelete='CASCADE'), nullable=True)
+    payload = db.Column(db.JSON, nullable=True)  # Handler arguments
+    status = db.Column(db.String(50), nullable=False, default='queued')  # 'queued', 'running', 'done', 'dead'
+    attempts = db.Column(db.Integer, default=0)
+    run_after = db.Column(db.DateTime, nullable=True)  # Earliest time a retry may run
+    checkpoint = db.Column(db.JSON, nullable=True)  # How far the last attempt got, saved with each committed chunk
+    worker = db.Column(db.String(100), nullable=True)  # Worker that claimed the job
+    error_message = db.Column(db.Text, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Relationships
+    sync_log = db.relationship('SyncLog', backref=db.backref('jobs', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_sync_job_status_id', 'status', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<SyncJob {self.id} {self.job_type}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'job_type': self.job_type,
+            'user_id': self.user_id,
+            'data_source_id': self.data_source_id,
+            'sync_log_id': self.sync_log_id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'run_after': self.run_after,
+            'checkpoint': self.checkpoint,
+            'error_message': self.error_message,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+
+class DeadLetterJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    sync_job_id = db.Column(db.Integer, db.ForeignKey('sync_job.id', ondelete='CASCADE'), nullable=False)
+    job_type = db.Column(db.String(50), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    data_source_id = db.Column(db.Integer, db.ForeignKey('data_source.id', ondelete='CASCADE'), nullable=False)
+    payload = db.Column(db.JSON, nullable=True)
+    checkpoint = db.Column(db.JSON, nullable=True)  # Where a replay resumes
+    attempts = db.Column(db.Integer, default=0)
+    error_message = db.Column(db.Text, nullable=True)  # Error of the final attempt
+    replayed_at = db.Column(db.DateTime, nullable=True)
+    replay_job_id = db.Column(db.Integer, db.ForeignKey('sync_job.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Relationships
+    sync_job = db.relationship('SyncJob', foreign_keys=[sync_job_id], backref=db.backref('dead_letters', lazy=True))
+
+    def __repr__(self):
+        return f'<DeadLetterJob {self.id} {self.job_type}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'sync_job_id': self.sync_job_id,
+            'sync_log_id': self.sync_job.sync_log_id if self.sync_job else None,
+            'job_type': self.job_type,
+            'user_id': self.user_id,
+            'data_source_id': self.data_source_id,
+            'payload': self.payload,
+            'checkpoint': self.checkpoint,
+            'attempts': self.attempts,
+            'error_message': self.error_message,
+            'replayed_at': self.replayed_at,
+            'replay_job_id': self.replay_job_id,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+
+class SyncLease(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    data_source_id = db.Column(db.Integer, db.ForeignKey('data_source.id', ondelete='CASCADE'), nullable=False)
+    holder = db.Column(db.String(64), nullable=False)  # Random token identifying the sync holding the lease
+    sync_log_id = db.Column(db.Integer, db.ForeignKey('sync_log.id', ondelete='SET NULL'), nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False)  # Pushed forward by heartbeats; an expired lease can be taken over
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'data_source_id', name='uix_sync_lease_connection'),
+    )
+
+    def __repr__(self):
+        return f'<SyncLease {self.user_id}:{self.data_source_id}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'data_source_id': self.data_source_id,
+            'sync_log_id': self.sync_log_id,
+            'expires_at': self.expires_at,
+            'heartbeat_at': self.heartbeat_at,
             'created_at': self.created_at,
             'updated_at': self.updated_at
         }
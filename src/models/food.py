@@ -14,6 +14,7 @@ class FoodEntry(db.Model):
     total_protein = db.Column(db.Float, nullable=True)
     total_fat = db.Column(db.Float, nullable=True)
     total_fiber = db.Column(db.Float, nullable=True)
+    source_fingerprint = db.Column(db.String(64), nullable=True)  # Hash of the source payload, used to skip unchanged records on re-sync
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
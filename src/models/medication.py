@@ -90,3 +90,34 @@ class MedicationLog(db.Model):
             'created_at': self.created_at,
             'updated_at': self.updated_at
         }
+
+
+class MedicationAdherence(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    user_medication_id = db.Column(db.Integer, db.ForeignKey('user_medication.id', ondelete='CASCADE'), nullable=False)
+    date = db.Column(db.Date, nullable=False)  # First day of the dosing window
+    expected_doses = db.Column(db.Integer, nullable=False, default=0)
+    taken_doses = db.Column(db.Integer, nullable=False, default=0)  # Scheduled doses matched by a log
+    extra_doses = db.Column(db.Integer, nullable=False, default=0)  # Logs beyond one per scheduled dose
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_medication_id', 'date', name='uix_medication_adherence_day'),
+        db.Index('ix_medication_adherence_user_date', 'user_id', 'date'),
+    )
+
+    def __repr__(self):
+        return f'<MedicationAdherence {self.user_medication_id} {self.date}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'user_medication_id': self.user_medication_id,
+            'date': self.date,
+            'expected_doses': self.expected_doses,
+            'taken_doses': self.taken_doses,
+            'extra_doses': self.extra_doses,
+            'created_at': self.created_at
+        }
@@ -20,6 +20,7 @@ class SleepRecord(db.Model):
     heart_rate_max = db.Column(db.Float, nullable=True)
     respiratory_rate_avg = db.Column(db.Float, nullable=True)
     sleep_data = db.Column(db.JSON, nullable=True)  # Additional sleep metrics
+    source_fingerprint = db.Column(db.String(64), nullable=True)  # Hash of the source payload, used to skip unchanged records on re-sync
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -6,6 +6,7 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
+    data_version = db.Column(db.Integer, nullable=True, default=0)  # Bumped whenever the user's health data changes
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -12,6 +12,7 @@ class Workout(db.Model):
     duration = db.Column(db.Integer, nullable=True)  # in seconds
     calories_burned = db.Column(db.Float, nullable=True)
     notes = db.Column(db.Text, nullable=True)
+    source_fingerprint = db.Column(db.String(64), nullable=True)  # Hash of the source payload, used to skip unchanged records on re-sync
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -98,3 +99,51 @@ class WorkoutExercise(db.Model):
             'created_at': self.created_at,
             'updated_at': self.updated_at
         }
+
+
+class PersonalRecord(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    exercise_id = db.Column(db.Integer, db.ForeignKey('exercise.id', ondelete='CASCADE'), nullable=False)
+    best_weight = db.Column(db.Float, nullable=True)  # in kg
+    best_weight_at = db.Column(db.DateTime, nullable=True)
+    best_e1rm = db.Column(db.Float, nullable=True)  # Estimated one-rep max in kg (Epley)
+    best_e1rm_at = db.Column(db.DateTime, nullable=True)
+    best_volume = db.Column(db.Float, nullable=True)  # Best sets x reps x weight in one workout
+    best_volume_at = db.Column(db.DateTime, nullable=True)
+    last_performed_at = db.Column(db.DateTime, nullable=True)
+    last_sets = db.Column(db.Integer, nullable=True)
+    last_reps = db.Column(db.Integer, nullable=True)
+    last_weight = db.Column(db.Float, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'exercise_id', name='uix_personal_record_exercise'),
+    )
+
+    # Relationships
+    exercise = db.relationship('Exercise')
+
+    def __repr__(self):
+        return f'<PersonalRecord {self.user_id}:{self.exercise_id}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'exercise_id': self.exercise_id,
+            'exercise_name': self.exercise.name if self.exercise else None,
+            'best_weight': self.best_weight,
+            'best_weight_at': self.best_weight_at,
+            'best_e1rm': self.best_e1rm,
+            'best_e1rm_at': self.best_e1rm_at,
+            'best_volume': self.best_volume,
+            'best_volume_at': self.best_volume_at,
+            'last_performed_at': self.last_performed_at,
+            'last_sets': self.last_sets,
+            'last_reps': self.last_reps,
+            'last_weight': self.last_weight,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
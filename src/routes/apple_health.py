@@ -4,6 +4,9 @@ from flask import Blueprint, request, jsonify, current_app
 from src.models.user import db, User
 from src.models.data_source import DataSource, UserDataSource, SyncLog
 from src.models.sleep import SleepRecord
+from src.services.ingestion import SourceAdapter, run_sync, ingest_records, get_data_source, get_or_create_user_data_source
+from src.services.job_queue import job_queue
+from src.services.leases import SyncInProgress, sync_lease
 from datetime import datetime, timedelta
 
 apple_health_bp = Blueprint('apple_health', __name__)
@@ -35,77 +38,37 @@ def upload_apple_health_export():
         return jsonify({"error": "User not found"}), 404
     
     # Get or create Apple Health data source
-    apple_health_source = DataSource.query.filter_by(name="Apple Health").first()
-    if not apple_health_source:
-        apple_health_source = DataSource(
-            name="Apple Health",
-            source_type="sleep",
-            requires_oauth=False,
-            description="Sleep tracking, heart rate, and general health metrics"
-        )
-        db.session.add(apple_health_source)
-        db.session.commit()
+    apple_health_source = get_data_source(SleepAdapter(), create=True)
     
-    # Create sync log
-    sync_log = SyncLog(
-        user_id=user_id,
-        data_source_id=apple_health_source.id,
-        sync_start_time=datetime.utcnow(),
-        status="pending"
-    )
-    db.session.add(sync_log)
-    db.session.commit()
+    # Save the file
+    filename = f"{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}"
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+    file.save(file_path)
     
+    # Process the file
+    # In a real implementation, we would parse the XML file
+    # For demo purposes, we'll simulate sleep data
+    user_data_source = get_or_create_user_data_source(user_id, apple_health_source.id)
     try:
-        # Save the file
-        filename = f"{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(file_path)
-        
-        # Process the file
-        # In a real implementation, we would parse the XML file
-        # For demo purposes, we'll simulate sleep data
-        sleep_records = simulate_apple_health_sleep_data(user_id)
-        
-        # Process and save sleep records
-        items_synced = process_apple_health_sleep_data(user_id, apple_health_source.id, sleep_records)
-        
-        # Update sync log
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "success"
-        sync_log.items_synced = items_synced
-        
-        # Update or create user data source connection
-        user_data_source = UserDataSource.query.filter_by(
-            user_id=user_id, 
-            data_source_id=apple_health_source.id
-        ).first()
-        
-        if not user_data_source:
-            user_data_source = UserDataSource(
-                user_id=user_id,
-                data_source_id=apple_health_source.id,
-                is_active=True
+        # Don't write alongside a queued or scheduled sync of the connection
+        with sync_lease(user_id, apple_health_source.id):
+            sync_log, stats = run_sync(
+                SleepAdapter(),
+                user_id,
+                apple_health_source.id,
+                records=simulate_apple_health_sleep_data(user_id),
+                user_data_source=user_data_source
             )
-            db.session.add(user_data_source)
-        
-        user_data_source.last_sync_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        return jsonify({
-            "success": True, 
-            "message": f"Successfully processed {items_synced} sleep records from Apple Health export"
-        })
-        
+    except SyncInProgress:
+        return jsonify({"error": "An Apple Health sync is already running for this user; upload again once it finishes"}), 409
     except Exception as e:
-        # Update sync log with error
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "failed"
-        sync_log.error_message = str(e)
-        db.session.commit()
-        
         return jsonify({"error": f"Failed to process Apple Health export: {str(e)}"}), 500
+    
+    return jsonify({
+        "success": True, 
+        "message": f"Successfully processed {stats['created']} sleep records from Apple Health export",
+        "sync_log_id": sync_log.id
+    })
 
 @apple_health_bp.route('/connect_device', methods=['POST'])
 def connect_device():
@@ -123,16 +86,12 @@ def connect_device():
         return jsonify({"error": "User not found"}), 404
     
     # Get or create device data source
-    device_source = DataSource.query.filter_by(name=device_type).first()
-    if not device_source:
-        device_source = DataSource(
-            name=device_type,
-            source_type="sleep",
-            requires_oauth=True,
-            description=f"Sleep tracking via {device_type}"
-        )
-        db.session.add(device_source)
-        db.session.commit()
+    device_adapter = SleepAdapter(
+        source_name=device_type,
+        requires_oauth=True,
+        description=f"Sleep tracking via {device_type}"
+    )
+    device_source = get_data_source(device_adapter, create=True)
     
     # Create or update user data source connection
     user_data_source = UserDataSource.query.filter_by(
@@ -157,16 +116,23 @@ def connect_device():
     # In a real implementation, we would sync data from the device
     # For demo purposes, we'll simulate sleep data
     try:
-        sleep_records = simulate_apple_health_sleep_data(user_id)
-        items_synced = process_apple_health_sleep_data(user_id, device_source.id, sleep_records)
-        
-        user_data_source.last_sync_at = datetime.utcnow()
-        db.session.commit()
+        # Don't write alongside a queued or scheduled sync of the connection
+        with sync_lease(user_id, device_source.id):
+            sync_log, stats = run_sync(
+                device_adapter,
+                user_id,
+                device_source.id,
+                records=simulate_apple_health_sleep_data(user_id),
+                user_data_source=user_data_source
+            )
         
         return jsonify({
             "success": True, 
-            "message": f"Successfully connected to {device_type} and synced {items_synced} sleep records"
+            "message": f"Successfully connected to {device_type} and synced {stats['created']} sleep records",
+            "sync_log_id": sync_log.id
         })
+    except SyncInProgress:
+        return jsonify({"error": f"Connected to {device_type}, but a sync is already running; sync again once it finishes"}), 409
     except Exception as e:
         return jsonify({"error": f"Failed to sync data from {device_type}: {str(e)}"}), 500
 
@@ -194,47 +160,29 @@ def sync_sleep_data():
     if not user_data_source:
         return jsonify({"error": f"User not connected to {source_name}"}), 404
     
-    # Create sync log
-    sync_log = SyncLog(
-        user_id=user_id,
-        data_source_id=data_source.id,
-        sync_start_time=datetime.utcnow(),
-        status="pending"
-    )
-    db.session.add(sync_log)
-    db.session.commit()
+    job = job_queue.enqueue('sleep_sync', user_id, data_source.id)
+    return jsonify({
+        "success": True, 
+        "message": f"{source_name} sync queued",
+        "sync_log_id": job.sync_log_id,
+        "job_id": job.id
+    }), 202
+
+@job_queue.handler('sleep_sync', source_type='sleep')
+def sync_sleep_user(user_data_source, sync_log=None, payload=None):
+    """Fetch and store a user's sleep records from Apple Health or a connected device"""
+    source_name = user_data_source.data_source.name
     
-    try:
-        # In a real implementation, we would fetch data from the device/API
-        # For demo purposes, we'll simulate sleep data
-        sleep_records = simulate_apple_health_sleep_data(user_id)
-        
-        # Process and save sleep records
-        items_synced = process_apple_health_sleep_data(user_id, data_source.id, sleep_records)
-        
-        # Update sync log
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "success"
-        sync_log.items_synced = items_synced
-        
-        # Update last sync time
-        user_data_source.last_sync_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        return jsonify({
-            "success": True, 
-            "message": f"Successfully synced {items_synced} sleep records from {source_name}"
-        })
-        
-    except Exception as e:
-        # Update sync log with error
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "failed"
-        sync_log.error_message = str(e)
-        db.session.commit()
-        
-        return jsonify({"error": f"Failed to sync sleep data: {str(e)}"}), 500
+    # In a real implementation, we would fetch data from the device/API
+    # For demo purposes, we'll simulate sleep data
+    return run_sync(
+        SleepAdapter(source_name=source_name),
+        user_data_source.user_id,
+        user_data_source.data_source_id,
+        records=simulate_apple_health_sleep_data(user_data_source.user_id),
+        user_data_source=user_data_source,
+        sync_log=sync_log
+    )
 
 def simulate_apple_health_sleep_data(user_id):
     """Simulate sleep data from Apple Health for demo purposes"""
@@ -292,52 +240,38 @@ def simulate_apple_health_sleep_data(user_id):
 
 def process_apple_health_sleep_data(user_id, source_id, sleep_records):
     """Process and save Apple Health sleep data to database"""
-    count = 0
+    stats = ingest_records(SleepAdapter(), user_id, source_id, sleep_records)
+    return stats['created']
+
+class SleepAdapter(SourceAdapter):
+    """Ingestion adapter for sleep records from Apple Health and sleep tracking devices"""
+    source_name = "Apple Health"
+    source_type = "sleep"
+    description = "Sleep tracking, heart rate, and general health metrics"
+    model = SleepRecord
+    date_column = 'start_time'
     
-    for record_data in sleep_records:
-        # Check if sleep record already exists
-        existing = SleepRecord.query.filter_by(
-            user_id=user_id,
-            source_id=source_id,
-            external_id=record_data.get('id')
-        ).first()
-        
-        if existing:
-            # Update existing sleep record
-            existing.start_time = record_data.get('start_time')
-            existing.end_time = record_data.get('end_time')
-            existing.duration = record_data.get('duration')
-            existing.deep_sleep_duration = record_data.get('deep_sleep_duration')
-            existing.light_sleep_duration = record_data.get('light_sleep_duration')
-            existing.rem_sleep_duration = record_data.get('rem_sleep_duration')
-            existing.awake_duration = record_data.get('awake_duration')
-            existing.sleep_score = record_data.get('sleep_score')
-            existing.heart_rate_avg = record_data.get('heart_rate_avg')
-            existing.heart_rate_min = record_data.get('heart_rate_min')
-            existing.heart_rate_max = record_data.get('heart_rate_max')
-            existing.respiratory_rate_avg = record_data.get('respiratory_rate_avg')
-            existing.updated_at = datetime.utcnow()
-        else:
-            # Create new sleep record
-            sleep_record = SleepRecord(
-                user_id=user_id,
-                source_id=source_id,
-                external_id=record_data.get('id'),
-                start_time=record_data.get('start_time'),
-                end_time=record_data.get('end_time'),
-                duration=record_data.get('duration'),
-                deep_sleep_duration=record_data.get('deep_sleep_duration'),
-                light_sleep_duration=record_data.get('light_sleep_duration'),
-                rem_sleep_duration=record_data.get('rem_sleep_duration'),
-                awake_duration=record_data.get('awake_duration'),
-                sleep_score=record_data.get('sleep_score'),
-                heart_rate_avg=record_data.get('heart_rate_avg'),
-                heart_rate_min=record_data.get('heart_rate_min'),
-                heart_rate_max=record_data.get('heart_rate_max'),
-                respiratory_rate_avg=record_data.get('respiratory_rate_avg')
-            )
-            db.session.add(sleep_record)
-            count += 1
+    def __init__(self, source_name=None, requires_oauth=False, description=None):
+        # Devices such as Oura or Fitbit share this adapter under their own source name
+        if source_name:
+            self.source_name = source_name
+        if description:
+            self.description = description
+        self.requires_oauth = requires_oauth
     
-    db.session.commit()
-    return count
+    def normalize(self, record_data):
+        return {
+            'external_id': record_data.get('id'),
+            'start_time': record_data.get('start_time'),
+            'end_time': record_data.get('end_time'),
+            'duration': record_data.get('duration'),
+            'deep_sleep_duration': record_data.get('deep_sleep_duration'),
+            'light_sleep_duration': record_data.get('light_sleep_duration'),
+            'rem_sleep_duration': record_data.get('rem_sleep_duration'),
+            'awake_duration': record_data.get('awake_duration'),
+            'sleep_score': record_data.get('sleep_score'),
+            'heart_rate_avg': record_data.get('heart_rate_avg'),
+            'heart_rate_min': record_data.get('heart_rate_min'),
+            'heart_rate_max': record_data.get('heart_rate_max'),
+            'respiratory_rate_avg': record_data.get('respiratory_rate_avg')
+        }
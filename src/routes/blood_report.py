@@ -5,8 +5,16 @@ from werkzeug.utils import secure_filename
 from src.models.user import db, User
 from src.models.data_source import DataSource, UserDataSource, SyncLog
 from src.models.blood_report import BloodReport, BloodMetric
+from src.services.events import publish_change
+from src.services.blood_metrics import metric_code, metric_display_name, metric_history
+from src.services.response_cache import bump_data_version
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import shutil
 import subprocess
+import threading
+import zipfile
 import re
 
 blood_report_bp = Blueprint('blood_report', __name__)
@@ -15,6 +23,18 @@ blood_report_bp = Blueprint('blood_report', __name__)
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'uploads', 'blood_reports')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Number of worker processes used for page-level PDF text extraction, shared
+# by all uploads in the process
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', os.cpu_count() or 2))
+_pdf_executor = None
+_pdf_executor_lock = threading.Lock()
+
+# Limits on uploaded ZIP archives, so a small archive cannot expand to fill
+# the disk: entries per archive, and uncompressed bytes per PDF and in total
+MAX_ZIP_MEMBERS = int(os.getenv('BLOOD_REPORT_MAX_ZIP_MEMBERS', 200))
+MAX_ZIP_MEMBER_SIZE = int(os.getenv('BLOOD_REPORT_MAX_ZIP_MEMBER_SIZE', 50 * 1024 * 1024))
+MAX_ZIP_TOTAL_SIZE = int(os.getenv('BLOOD_REPORT_MAX_ZIP_TOTAL_SIZE', 500 * 1024 * 1024))
+
 @blood_report_bp.route('/upload', methods=['POST'])
 def upload_blood_report():
     """Upload and process blood report PDF"""
@@ -65,6 +85,7 @@ def upload_blood_report():
         is_processed=False
     )
     db.session.add(blood_report)
+    bump_data_version(user_id)
     db.session.commit()
     
     # Process the PDF in the background
@@ -82,6 +103,117 @@ def upload_blood_report():
             "report_id": blood_report.id
         })
 
+@blood_report_bp.route('/upload-batch', methods=['POST'])
+def upload_blood_reports_batch():
+    """Upload and process multiple blood report PDFs or ZIP archives of PDFs"""
+    user_id = request.form.get('user_id')
+    report_date = request.form.get('report_date')
+    report_provider = request.form.get('report_provider', '')
+    
+    if not user_id:
+        return jsonify({"error": "User ID is required"}), 400
+    
+    if report_date:
+        try:
+            # Validate date format
+            datetime.strptime(report_date, '%Y-%m-%d')
+        except ValueError:
+            return jsonify({"error": "Invalid date format. Use YYYY-MM-DD"}), 400
+    
+    files = [f for f in request.files.getlist('files') + request.files.getlist('file') if f.filename]
+    if not files:
+        return jsonify({"error": "No files provided"}), 400
+    
+    # Get user
+    user = User.query.get(user_id)
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+    
+    # Save every PDF, expanding ZIP archives
+    uploads = []
+    skipped = []
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    for file in files:
+        if file.filename.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file.stream) as archive:
+                    members = [
+                        info for info in archive.infolist()
+                        if not info.is_dir() and info.filename.lower().endswith('.pdf') and not info.filename.startswith('__MACOSX')
+                    ]
+                    # Check the sizes the archive declares before expanding anything;
+                    # reads stop at the declared size, so they cannot be exceeded
+                    if len(archive.infolist()) > MAX_ZIP_MEMBERS:
+                        skipped.append({"filename": file.filename, "error": f"ZIP archive has more than {MAX_ZIP_MEMBERS} files"})
+                        continue
+                    if sum(info.file_size for info in members) > MAX_ZIP_TOTAL_SIZE:
+                        skipped.append({"filename": file.filename, "error": "ZIP archive is too large once extracted"})
+                        continue
+                    
+                    for info in members:
+                        name = os.path.basename(info.filename)
+                        if info.file_size > MAX_ZIP_MEMBER_SIZE:
+                            skipped.append({"filename": name, "error": "PDF in ZIP archive is too large"})
+                            continue
+                        file_path = os.path.join(UPLOAD_FOLDER, secure_filename(f"{user_id}_{timestamp}_{len(uploads)}_{name}"))
+                        with archive.open(info) as source, open(file_path, 'wb') as target:
+                            shutil.copyfileobj(source, target)
+                        uploads.append((name, file_path))
+            except zipfile.BadZipFile:
+                skipped.append({"filename": file.filename, "error": "Invalid ZIP archive"})
+        elif file.filename.lower().endswith('.pdf'):
+            file_path = os.path.join(UPLOAD_FOLDER, secure_filename(f"{user_id}_{timestamp}_{len(uploads)}_{file.filename}"))
+            file.save(file_path)
+            uploads.append((file.filename, file_path))
+        else:
+            skipped.append({"filename": file.filename, "error": "Only PDF and ZIP files are supported"})
+    
+    if not uploads:
+        return jsonify({"error": "No PDF files found in upload", "skipped": skipped}), 400
+    
+    # Extract text from all PDFs in parallel, one task per page
+    texts = extract_text_from_pdfs([file_path for _, file_path in uploads])
+    
+    # Parse and store each report in its own transaction; a date given with
+    # the upload applies to every report, else each is dated from its file name
+    form_report_date = datetime.strptime(report_date, '%Y-%m-%d').date() if report_date else None
+    processed = []
+    for filename, file_path in uploads:
+        text = texts.get(file_path)
+        if isinstance(text, Exception):
+            skipped.append({"filename": filename, "error": str(text)})
+            continue
+        
+        try:
+            blood_report = BloodReport(
+                user_id=user_id,
+                report_date=form_report_date or report_date_from_filename(filename) or datetime.utcnow().date(),
+                report_name=os.path.splitext(filename)[0],
+                report_provider=report_provider,
+                pdf_file_path=file_path,
+                is_processed=True
+            )
+            db.session.add(blood_report)
+            db.session.flush()  # Get the ID for the new report
+            
+            metrics = parse_blood_metrics(text)
+            db.session.add_all([build_blood_metric(blood_report, metric_data) for metric_data in metrics])
+            bump_data_version(user_id)
+            db.session.commit()
+            publish_change(blood_report.user_id, 'blood', blood_report.report_date)
+            
+            processed.append({"filename": filename, "report_id": blood_report.id, "metrics": len(metrics)})
+        except Exception as e:
+            db.session.rollback()
+            skipped.append({"filename": filename, "error": str(e)})
+    
+    return jsonify({
+        "success": True,
+        "message": f"Processed {len(processed)} of {len(processed) + len(skipped)} blood reports",
+        "reports": processed,
+        "failed": skipped
+    })
+
 @blood_report_bp.route('/reports', methods=['GET'])
 def get_user_reports():
     """Get all blood reports for a user"""
@@ -96,6 +228,44 @@ def get_user_reports():
         "reports": [report.to_dict() for report in reports]
     })
 
+@blood_report_bp.route('/trends', methods=['GET'])
+def get_metric_trend():
+    """Get the full history of a blood metric for a user"""
+    user_id = request.args.get('user_id')
+    metric = request.args.get('metric')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    
+    if not user_id or not metric:
+        return jsonify({"error": "User ID and metric are required"}), 400
+    
+    try:
+        start_date = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
+        end_date = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None
+    except ValueError:
+        return jsonify({"error": "Invalid date format. Use YYYY-MM-DD"}), 400
+    
+    # Accept a code or any name the metric is reported under
+    code = metric_code(metric)
+    metrics = metric_history(user_id, [code], start_date, end_date)
+    
+    return jsonify({
+        "success": True,
+        "metric_code": code,
+        "metric_name": metric_display_name(code),
+        "history": [
+            {
+                "report_id": m.blood_report_id,
+                "date": m.report_date.isoformat(),
+                "value": m.metric_value,
+                "unit": m.unit,
+                "reference_range": m.reference_range,
+                "is_normal": m.is_normal
+            }
+            for m in reversed(metrics)
+        ]
+    })
+
 @blood_report_bp.route('/report/<int:report_id>', methods=['GET'])
 def get_report_details(report_id):
     """Get details of a specific blood report"""
@@ -165,21 +335,44 @@ def process_blood_report_pdf(report_id):
     
     # Add new metrics
     for metric_data in metrics:
-        metric = BloodMetric(
-            blood_report_id=report.id,
-            metric_name=metric_data.get('name'),
-            metric_value=metric_data.get('value'),
-            unit=metric_data.get('unit'),
-            reference_range=metric_data.get('reference_range'),
-            is_normal=metric_data.get('is_normal')
-        )
-        db.session.add(metric)
+        db.session.add(build_blood_metric(report, metric_data))
     
     report.is_processed = True
+    bump_data_version(report.user_id)
     db.session.commit()
+    publish_change(report.user_id, 'blood', report.report_date)
     
     return len(metrics)
 
+def build_blood_metric(report, metric_data):
+    """Create a BloodMetric row from parsed metric data, coded for trend queries"""
+    return BloodMetric(
+        blood_report_id=report.id,
+        user_id=report.user_id,
+        report_date=report.report_date,
+        metric_name=metric_data.get('name'),
+        metric_code=metric_code(metric_data.get('name')),
+        metric_value=metric_data.get('value'),
+        unit=metric_data.get('unit'),
+        reference_range=metric_data.get('reference_range'),
+        is_normal=metric_data.get('is_normal')
+    )
+
+def report_date_from_filename(filename):
+    """Guess the report date from a YYYY-MM-DD or YYYYMMDD date in the file name
+    
+    The date must stand on its own, not inside a longer run of digits like a
+    lab accession number, and fall between 1900 and today.
+    """
+    for match in re.finditer(r'(?<!\d)(\d{4})([-_.]?)(\d{2})\2(\d{2})(?!\d)', filename):
+        try:
+            date = datetime(int(match.group(1)), int(match.group(3)), int(match.group(4))).date()
+        except ValueError:
+            continue
+        if date.year >= 1900 and date <= datetime.utcnow().date():
+            return date
+    return None
+
 def extract_text_from_pdf(pdf_path):
     """Extract text from PDF using pdftotext"""
     try:
@@ -191,6 +384,87 @@ def extract_text_from_pdf(pdf_path):
     except Exception as e:
         raise Exception(f"Error extracting text: {str(e)}")
 
+def get_pdf_page_count(pdf_path):
+    """Get the number of pages in a PDF using pdfinfo"""
+    try:
+        result = subprocess.run(['pdfinfo', pdf_path], capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"pdfinfo error: {e.stderr}")
+    
+    match = re.search(r'^Pages:\s+(\d+)', result.stdout, re.MULTILINE)
+    if not match:
+        raise Exception("Could not determine PDF page count")
+    return int(match.group(1))
+
+def extract_text_from_pdf_page(pdf_path, page):
+    """Extract text from a single PDF page using pdftotext"""
+    try:
+        result = subprocess.run(['pdftotext', '-layout', '-f', str(page), '-l', str(page), pdf_path, '-'],
+                               capture_output=True, text=True, check=True)
+        return result.stdout
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"pdftotext error on page {page}: {e.stderr}")
+
+def pdf_executor():
+    """The process pool shared by all PDF extraction, started on first use"""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            _pdf_executor = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS)
+        return _pdf_executor
+
+def discard_pdf_executor(executor):
+    """Drop a broken pool so the next extraction starts a new one"""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is executor:
+            _pdf_executor = None
+    executor.shutdown(wait=False)
+
+def extract_text_from_pdfs(pdf_paths):
+    """Extract text from many PDFs in the shared process pool, fanning out one task per page
+    
+    Concurrent uploads queue their pages on the same PDF_EXTRACT_WORKERS
+    processes. Returns a dict of pdf path to merged text, or to the exception
+    raised for that file.
+    """
+    results = {}
+    executor = pdf_executor()
+    try:
+        # Count pages first so every page can be scheduled independently
+        page_count_futures = {pdf_path: executor.submit(get_pdf_page_count, pdf_path) for pdf_path in pdf_paths}
+        
+        page_futures = {}
+        for pdf_path, future in page_count_futures.items():
+            try:
+                page_count = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                results[pdf_path] = e
+                continue
+            page_futures[pdf_path] = [
+                executor.submit(extract_text_from_pdf_page, pdf_path, page)
+                for page in range(1, page_count + 1)
+            ]
+        
+        # Merge page texts back in page order
+        for pdf_path, futures in page_futures.items():
+            try:
+                results[pdf_path] = '\f'.join(future.result() for future in futures)
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                results[pdf_path] = Exception(f"Failed to extract text from PDF: {str(e)}")
+    except BrokenProcessPool:
+        # A worker died; fail what is left of this upload and start afresh next time
+        discard_pdf_executor(executor)
+        error = Exception("PDF extraction workers stopped unexpectedly")
+        for pdf_path in pdf_paths:
+            results.setdefault(pdf_path, error)
+    
+    return results
+
 def parse_blood_metrics(text):
     """Parse blood metrics from extracted text"""
     # This is a simplified parser that looks for common patterns in blood test reports
@@ -1,5 +1,8 @@
 import os
-from flask import Blueprint, request, jsonify, current_app
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
 from src.models.user import db, User
 from src.models.chat import UserQuery, Insight
 from src.models.data_source import DataSource, UserDataSource
@@ -12,10 +15,36 @@ from src.models.workout import Workout, WorkoutExercise, Exercise
 from datetime import datetime, timedelta
 import json
 import re
-from sqlalchemy import func, desc, and_, or_
+from sqlalchemy import func, desc, and_, or_, case
+from src.services.events import change_bus
+from src.services.query_parser import parse_query
+from src.services.aggregates import aggregate, aggregate_by, present, rollup, total
+from src.services.workout_analytics import workout_summary, exercise_history, total_volume
+from src.services.personal_records import get_personal_record
+from src.services.blood_metrics import QUERY_METRIC_CODES, metric_history
+from src.services.medication_logs import get_user_medications, get_medication_log_entries
+from src.services.adherence import medication_adherence
+from src.services.comparisons import compare_domain, compare_metrics, deltas
+from src.services.response_cache import response_cache, get_data_version, bump_data_version
+from src.services.chat_history import chat_history
 
 chat_bp = Blueprint('chat', __name__)
 
+logger = logging.getLogger(__name__)
+
+# Threads answering the domain parts of summary queries concurrently. SQLite
+# serves readers in parallel under WAL, so a summary takes about as long as
+# its slowest domain.
+SUMMARY_WORKERS = int(os.getenv('CHAT_SUMMARY_WORKERS', 8))
+summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="chat-summary")
+
+# Users whose first insights are being generated
+_seeding = set()
+_seeding_lock = threading.Lock()
+
+# Sections of a summary response, in the order they are assembled
+SUMMARY_SECTIONS = ['Activity', 'Sleep', 'Nutrition', 'Workouts', 'Insights']
+
 @chat_bp.route('/query', methods=['POST'])
 def process_query():
     """Process a user query and return a response based on their health data"""
@@ -25,39 +54,67 @@ def process_query():
     if not user_id or not query_text:
         return jsonify({"error": "User ID and query text are required"}), 400
     
-    # Create a record of the query
-    user_query = UserQuery(
-        user_id=user_id,
-        query_text=query_text,
-        query_time=datetime.utcnow()
-    )
-    db.session.add(user_query)
-    db.session.commit()
+    # Record the query; the history buffer writes it in the background
+    query_id = chat_history.record_query(user_id, query_text)
     
     try:
         # Process the query and generate a response
         response, data_sources_used = generate_response(user_id, query_text)
         
         # Update the query record with the response
-        user_query.response_text = response
-        user_query.data_sources_used = data_sources_used
-        db.session.commit()
+        chat_history.record_response(query_id, response, data_sources_used)
         
         return jsonify({
             "success": True,
-            "query_id": user_query.id,
+            "query_id": query_id,
             "response": response,
             "data_sources_used": data_sources_used
         })
     except Exception as e:
         # Update the query record with the error
-        user_query.response_text = f"Error processing query: {str(e)}"
-        db.session.commit()
+        chat_history.record_response(query_id, f"Error processing query: {str(e)}")
         
         return jsonify({
             "error": f"Failed to process query: {str(e)}"
         }), 500
 
+@chat_bp.route('/query/stream', methods=['POST'])
+def stream_query():
+    """Process a user query, streaming each section of the response as Server-Sent Events"""
+    user_id = request.json.get('user_id')
+    query_text = request.json.get('query')
+    
+    if not user_id or not query_text:
+        return jsonify({"error": "User ID and query text are required"}), 400
+    
+    # Record the query; the history buffer writes it in the background
+    query_id = chat_history.record_query(user_id, query_text)
+    
+    def generate():
+        try:
+            for name, data in stream_response(user_id, query_text):
+                if name == "complete":
+                    # Update the query record with the assembled response
+                    chat_history.record_response(query_id, data['response'], data['data_sources_used'])
+                    data = {"success": True, "query_id": query_id, **data}
+                
+                yield format_chat_event(name, data)
+        except Exception as e:
+            # Update the query record with the error
+            chat_history.record_response(query_id, f"Error processing query: {str(e)}")
+            
+            yield format_chat_event("error", {"error": f"Failed to process query: {str(e)}"})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def format_chat_event(name, data):
+    """Format a chat response event as an SSE message"""
+    return f"event: {name}\ndata: {json.dumps(data, default=str)}\n\n"
+
 @chat_bp.route('/history', methods=['GET'])
 def get_query_history():
     """Get chat history for a user"""
@@ -68,6 +125,9 @@ def get_query_history():
     if not user_id:
         return jsonify({"error": "User ID is required"}), 400
     
+    # Write buffered queries first so the history includes them
+    chat_history.flush()
+    
     # Get query history
     queries = UserQuery.query.filter_by(user_id=user_id) \
                             .order_by(UserQuery.query_time.desc()) \
@@ -79,6 +139,14 @@ def get_query_history():
         "total": UserQuery.query.filter_by(user_id=user_id).count()
     })
 
+@chat_bp.route('/cache-stats', methods=['GET'])
+def get_cache_stats():
+    """Get hit and miss metrics of the chat response cache"""
+    return jsonify({
+        "success": True,
+        "cache": response_cache.stats()
+    })
+
 @chat_bp.route('/insights', methods=['GET'])
 def get_insights():
     """Get insights for a user"""
@@ -144,96 +212,111 @@ def mark_insight_read():
 
 def generate_response(user_id, query_text):
     """Generate a response to a user query based on their health data"""
-    # Normalize query text
-    query_text = query_text.lower().strip()
+    # Parse the query once for every handler
+    query = parse_query(query_text)
     
     # Track which data sources are used
     data_sources_used = []
     
-    # Check if user exists
-    user = User.query.get(user_id)
-    if not user:
+    # Check if user exists, answering repeated questions from the cache
+    cache_key, cached = cached_response(user_id, query)
+    if cache_key is None:
         return "User not found", data_sources_used
+    if cached is not None:
+        return cached
     
     # Determine query intent
-    intent = determine_query_intent(query_text)
+    intent = query.intent
     
     # Process query based on intent
     if intent == 'activity':
-        response, sources = process_activity_query(user_id, query_text)
+        response, sources = process_activity_query(user_id, query)
         data_sources_used.extend(sources)
     elif intent == 'food':
-        response, sources = process_food_query(user_id, query_text)
+        response, sources = process_food_query(user_id, query)
         data_sources_used.extend(sources)
     elif intent == 'sleep':
-        response, sources = process_sleep_query(user_id, query_text)
+        response, sources = process_sleep_query(user_id, query)
         data_sources_used.extend(sources)
     elif intent == 'blood':
-        response, sources = process_blood_query(user_id, query_text)
+        response, sources = process_blood_query(user_id, query)
         data_sources_used.extend(sources)
     elif intent == 'medication':
-        response, sources = process_medication_query(user_id, query_text)
+        response, sources = process_medication_query(user_id, query)
         data_sources_used.extend(sources)
     elif intent == 'workout':
-        response, sources = process_workout_query(user_id, query_text)
+        response, sources = process_workout_query(user_id, query)
         data_sources_used.extend(sources)
     elif intent == 'summary':
-        response, sources = process_summary_query(user_id, query_text)
+        response, sources = process_summary_query(user_id, query)
         data_sources_used.extend(sources)
     elif intent == 'comparison':
-        response, sources = process_comparison_query(user_id, query_text)
+        response, sources = process_comparison_query(user_id, query)
         data_sources_used.extend(sources)
     else:
         # Default response for unrecognized queries
         response = "I'm not sure how to answer that question. You can ask me about your activities, food, sleep, blood reports, medications, or workouts. For example, 'How was my sleep last week?' or 'What was my average heart rate during my last run?'"
     
-    return response, list(set(data_sources_used))  # Remove duplicates
+    data_sources_used = list(set(data_sources_used))  # Remove duplicates
+    response_cache.put(cache_key, response, data_sources_used)
+    return response, data_sources_used
+
+def cached_response(user_id, query):
+    """Look up the cache key of a parsed query and any cached answer to it
+    
+    Returns (cache_key, cached): cache_key is None if the user doesn't
+    exist, cached the (response, data_sources_used) stored while the user's
+    data is unchanged or None on a miss.
+    """
+    data_version = get_data_version(user_id)
+    if data_version is None:
+        return None, None
+    
+    cache_key = response_cache.key(user_id, data_version, query, get_date_range(query.time_range))
+    return cache_key, response_cache.get(cache_key)
+
+def stream_response(user_id, query_text):
+    """Generate a response to a user query section by section
+    
+    Yields ("section", {"title", "text"}) as each part is computed, then
+    ("complete", {"response", "data_sources_used"}) with the response as
+    generate_response() returns it. Summaries send a section per domain as
+    soon as it is answered and the insights last; other answers, and
+    cached ones, are a single untitled section.
+    """
+    query = parse_query(query_text)
+    if query.intent != 'summary':
+        response, data_sources_used = generate_response(user_id, query)
+        yield "section", {"title": None, "text": response}
+        yield "complete", {"response": response, "data_sources_used": data_sources_used}
+        return
+    
+    cache_key, cached = cached_response(user_id, query)
+    if cache_key is None or cached is not None:
+        response, data_sources_used = cached or ("User not found", [])
+        yield "section", {"title": None, "text": response}
+        yield "complete", {"response": response, "data_sources_used": data_sources_used}
+        return
+    
+    sections = {}
+    data_sources_used = []
+    for title, text, sources in summary_sections(user_id, query):
+        sections[title] = text
+        data_sources_used.extend(sources)
+        yield "section", {"title": title, "text": text}
+    
+    response = format_summary(query.time_range, sections)
+    data_sources_used = list(set(data_sources_used))  # Remove duplicates
+    response_cache.put(cache_key, response, data_sources_used)
+    yield "complete", {"response": response, "data_sources_used": data_sources_used}
 
 def determine_query_intent(query_text):
     """Determine the intent of a user query"""
-    # Define keywords for each intent
-    intent_keywords = {
-        'activity': ['activity', 'activities', 'run', 'running', 'walk', 'walking', 'cycle', 'cycling', 'steps', 'distance', 'strava'],
-        'food': ['food', 'eat', 'eating', 'nutrition', 'diet', 'calories', 'carbs', 'protein', 'fat', 'meal', 'breakfast', 'lunch', 'dinner', 'snack', 'healthifyme'],
-        'sleep': ['sleep', 'slept', 'bedtime', 'wake', 'rem', 'deep', 'light', 'apple health', 'oura', 'fitbit'],
-        'blood': ['blood', 'test', 'report', 'cholesterol', 'glucose', 'hemoglobin', 'lab'],
-        'medication': ['medication', 'medicine', 'pill', 'drug', 'prescription', 'dose', 'dosage'],
-        'workout': ['workout', 'exercise', 'gym', 'weight', 'strength', 'training', 'hevy', 'bench', 'squat', 'deadlift'],
-        'summary': ['summary', 'overall', 'health', 'status', 'dashboard', 'overview'],
-        'comparison': ['compare', 'comparison', 'versus', 'vs', 'difference', 'between', 'than']
-    }
-    
-    # Check for time-related keywords
-    time_keywords = ['today', 'yesterday', 'week', 'month', 'year', 'last', 'this', 'past', 'recent']
-    
-    # Count matches for each intent
-    intent_scores = {intent: 0 for intent in intent_keywords}
-    
-    for intent, keywords in intent_keywords.items():
-        for keyword in keywords:
-            if keyword in query_text:
-                intent_scores[intent] += 1
-    
-    # If we have a clear winner, return that intent
-    max_score = max(intent_scores.values())
-    if max_score > 0:
-        # Get all intents with the max score
-        top_intents = [intent for intent, score in intent_scores.items() if score == max_score]
-        if len(top_intents) == 1:
-            return top_intents[0]
-    
-    # If no clear intent or tie, check for specific patterns
-    if 'compare' in query_text or ' vs ' in query_text or 'versus' in query_text:
-        return 'comparison'
-    
-    if any(word in query_text for word in ['summary', 'overview', 'dashboard']):
-        return 'summary'
-    
-    # Default to summary if no clear intent
-    return 'summary'
+    return parse_query(query_text).intent
 
-def process_activity_query(user_id, query_text):
+def process_activity_query(user_id, query):
     """Process a query about activities"""
+    query = parse_query(query)
     data_sources_used = []
     
     # Get Strava data source
@@ -242,70 +325,70 @@ def process_activity_query(user_id, query_text):
         data_sources_used.append("Strava")
     
     # Determine time range
-    time_range = extract_time_range(query_text)
+    time_range = query.time_range
     start_date, end_date = get_date_range(time_range)
     
-    # Query activities
-    activities = Activity.query.filter(
-        Activity.user_id == user_id,
-        Activity.start_time >= start_date,
-        Activity.start_time <= end_date
-    ).order_by(Activity.start_time.desc()).all()
+    # Aggregate activities per type in one query, most recent type first
+    activity_types = aggregate_by(
+        Activity, user_id, Activity.start_time, start_date, end_date, Activity.activity_type,
+        order_by=func.max(Activity.start_time).desc(),
+        count=func.count(Activity.id),
+        total_duration=total(Activity.duration),
+        total_distance=total(Activity.distance),
+        total_calories=total(Activity.calories),
+        with_calories=func.count(present(Activity.calories)),
+        total_heart_rate=total(Activity.average_heart_rate),
+        with_heart_rate=func.count(present(Activity.average_heart_rate)),
+        max_heart_rate=func.max(case((Activity.average_heart_rate != 0, present(Activity.max_heart_rate))))
+    )
     
-    if not activities:
+    if not activity_types:
         return f"I couldn't find any activities in the specified time range ({time_range}).", data_sources_used
     
+    totals = rollup(activity_types, maxes=('max_heart_rate',))
+    
     # Check for specific metrics
-    if 'steps' in query_text:
-        total_steps = sum(activity.distance * 1.31 for activity in activities if activity.distance)  # Rough conversion from meters to steps
-        avg_steps = total_steps / len(activities) if activities else 0
+    if query.has('steps'):
+        total_steps = totals['total_distance'] * 1.31  # Rough conversion from meters to steps
+        avg_steps = total_steps / totals['count']
         return f"You took approximately {int(total_steps)} steps in total during this period, averaging {int(avg_steps)} steps per activity.", data_sources_used
     
-    if 'distance' in query_text:
-        total_distance = sum(activity.distance for activity in activities if activity.distance)
-        avg_distance = total_distance / len(activities) if activities else 0
+    if query.has('distance'):
+        total_distance = totals['total_distance']
+        avg_distance = total_distance / totals['count']
         return f"You covered {total_distance/1000:.2f} km in total during this period, averaging {avg_distance/1000:.2f} km per activity.", data_sources_used
     
-    if 'heart rate' in query_text or 'heartrate' in query_text:
-        activities_with_hr = [a for a in activities if a.average_heart_rate]
-        if not activities_with_hr:
+    if query.has('heart rate', 'heartrate'):
+        if not totals['with_heart_rate']:
             return "I couldn't find any heart rate data for your activities in this period.", data_sources_used
         
-        avg_hr = sum(a.average_heart_rate for a in activities_with_hr) / len(activities_with_hr)
-        max_hr = max(a.max_heart_rate for a in activities_with_hr if a.max_heart_rate)
+        avg_hr = totals['total_heart_rate'] / totals['with_heart_rate']
+        max_hr = totals['max_heart_rate']
         return f"Your average heart rate during activities was {avg_hr:.0f} bpm, with a maximum of {max_hr:.0f} bpm.", data_sources_used
     
-    if 'calories' in query_text:
-        activities_with_calories = [a for a in activities if a.calories]
-        if not activities_with_calories:
+    if query.has('calories'):
+        if not totals['with_calories']:
             return "I couldn't find any calorie data for your activities in this period.", data_sources_used
         
-        total_calories = sum(a.calories for a in activities_with_calories)
-        avg_calories = total_calories / len(activities_with_calories)
+        total_calories = totals['total_calories']
+        avg_calories = total_calories / totals['with_calories']
         return f"You burned approximately {total_calories:.0f} calories in total during this period, averaging {avg_calories:.0f} calories per activity.", data_sources_used
     
     # Default summary
-    activity_types = {}
-    for activity in activities:
-        activity_type = activity.activity_type
-        if activity_type in activity_types:
-            activity_types[activity_type] += 1
-        else:
-            activity_types[activity_type] = 1
-    
-    total_duration = sum(activity.duration for activity in activities if activity.duration)
-    total_distance = sum(activity.distance for activity in activities if activity.distance)
+    total_duration = totals['total_duration']
+    total_distance = totals['total_distance']
     
-    activity_summary = ", ".join([f"{count} {activity_type}" for activity_type, count in activity_types.items()])
+    activity_summary = ", ".join([f"{group['count']} {group['group']}" for group in activity_types])
     
-    response = f"During this period ({time_range}), you completed {len(activities)} activities ({activity_summary}). "
+    response = f"During this period ({time_range}), you completed {totals['count']} activities ({activity_summary}). "
     response += f"You spent {total_duration//3600} hours and {(total_duration%3600)//60} minutes exercising, "
     response += f"covering a total distance of {total_distance/1000:.2f} km."
     
     return response, data_sources_used
 
-def process_food_query(user_id, query_text):
+def process_food_query(user_id, query):
     """Process a query about food and nutrition"""
+    query = parse_query(query)
     data_sources_used = []
     
     # Get HealthifyMe data source
@@ -314,72 +397,76 @@ def process_food_query(user_id, query_text):
         data_sources_used.append("HealthifyMe")
     
     # Determine time range
-    time_range = extract_time_range(query_text)
+    time_range = query.time_range
     start_date, end_date = get_date_range(time_range)
     
-    # Query food entries
-    food_entries = FoodEntry.query.filter(
-        FoodEntry.user_id == user_id,
-        FoodEntry.consumed_at >= start_date,
-        FoodEntry.consumed_at <= end_date
-    ).order_by(FoodEntry.consumed_at.desc()).all()
+    # Aggregate food entries per meal type in one query, most recent meal type first
+    meal_types = aggregate_by(
+        FoodEntry, user_id, FoodEntry.consumed_at, start_date, end_date, FoodEntry.meal_type,
+        order_by=func.max(FoodEntry.consumed_at).desc(),
+        count=func.count(FoodEntry.id),
+        total_calories=total(FoodEntry.total_calories),
+        total_protein=total(FoodEntry.total_protein),
+        total_carbs=total(FoodEntry.total_carbs),
+        total_fat=total(FoodEntry.total_fat)
+    )
     
-    if not food_entries:
+    if not meal_types:
         return f"I couldn't find any food entries in the specified time range ({time_range}).", data_sources_used
     
+    totals = rollup(meal_types)
+    
     # Check for specific metrics
-    if 'calories' in query_text:
-        total_calories = sum(entry.total_calories for entry in food_entries if entry.total_calories)
-        avg_calories = total_calories / len(food_entries) if food_entries else 0
+    if query.has('calories'):
+        total_calories = totals['total_calories']
+        avg_calories = total_calories / totals['count']
         return f"You consumed approximately {total_calories:.0f} calories in total during this period, averaging {avg_calories:.0f} calories per day.", data_sources_used
     
-    if 'protein' in query_text:
-        total_protein = sum(entry.total_protein for entry in food_entries if entry.total_protein)
-        avg_protein = total_protein / len(food_entries) if food_entries else 0
+    if query.has('protein'):
+        total_protein = totals['total_protein']
+        avg_protein = total_protein / totals['count']
         return f"You consumed approximately {total_protein:.0f}g of protein in total during this period, averaging {avg_protein:.0f}g per day.", data_sources_used
     
-    if 'carbs' in query_text or 'carbohydrates' in query_text:
-        total_carbs = sum(entry.total_carbs for entry in food_entries if entry.total_carbs)
-        avg_carbs = total_carbs / len(food_entries) if food_entries else 0
+    if query.has('carbs', 'carbohydrates'):
+        total_carbs = totals['total_carbs']
+        avg_carbs = total_carbs / totals['count']
         return f"You consumed approximately {total_carbs:.0f}g of carbohydrates in total during this period, averaging {avg_carbs:.0f}g per day.", data_sources_used
     
-    if 'fat' in query_text:
-        total_fat = sum(entry.total_fat for entry in food_entries if entry.total_fat)
-        avg_fat = total_fat / len(food_entries) if food_entries else 0
+    if query.has('fat'):
+        total_fat = totals['total_fat']
+        avg_fat = total_fat / totals['count']
         return f"You consumed approximately {total_fat:.0f}g of fat in total during this period, averaging {avg_fat:.0f}g per day.", data_sources_used
     
     # Check for meal type queries
-    meal_types = ['breakfast', 'lunch', 'dinner', 'snack']
-    for meal_type in meal_types:
-        if meal_type in query_text:
-            meal_entries = [entry for entry in food_entries if entry.meal_type == meal_type]
-            if not meal_entries:
-                return f"I couldn't find any {meal_type} entries in the specified time range ({time_range}).", data_sources_used
-            
-            avg_calories = sum(entry.total_calories for entry in meal_entries if entry.total_calories) / len(meal_entries)
-            
-            # Get common foods
-            food_items = []
-            for entry in meal_entries:
-                food_items.extend(FoodItem.query.filter_by(food_entry_id=entry.id).all())
-            
-            food_counts = {}
-            for item in food_items:
-                if item.name in food_counts:
-                    food_counts[item.name] += 1
-                else:
-                    food_counts[item.name] = 1
-            
-            common_foods = sorted(food_counts.items(), key=lambda x: x[1], reverse=True)[:3]
-            common_foods_str = ", ".join([food for food, count in common_foods])
-            
-            return f"For {meal_type}, you consumed an average of {avg_calories:.0f} calories. Your most common foods were {common_foods_str}.", data_sources_used
+    for meal_type in query.meal_types:
+        meal = next((group for group in meal_types if group['group'] == meal_type), None)
+        if not meal:
+            return f"I couldn't find any {meal_type} entries in the specified time range ({time_range}).", data_sources_used
+        
+        avg_calories = meal['total_calories'] / meal['count']
+        
+        # Get common foods, counted in the database
+        common_foods = db.session.query(FoodItem.name).join(
+            FoodEntry, FoodItem.food_entry_id == FoodEntry.id
+        ).filter(
+            FoodEntry.user_id == user_id,
+            FoodEntry.meal_type == meal_type,
+            FoodEntry.consumed_at >= start_date,
+            FoodEntry.consumed_at <= end_date
+        ).group_by(FoodItem.name).order_by(
+            func.count(FoodItem.id).desc(),
+            func.max(FoodEntry.consumed_at).desc(),
+            func.min(FoodItem.id)
+        ).limit(3).all()
+        common_foods_str = ", ".join([name for name, in common_foods])
+        
+        return f"For {meal_type}, you consumed an average of {avg_calories:.0f} calories. Your most common foods were {common_foods_str}.", data_sources_used
     
     # Default summary
-    total_calories = sum(entry.total_calories for entry in food_entries if entry.total_calories)
-    total_protein = sum(entry.total_protein for entry in food_entries if entry.total_protein)
-    total_carbs = sum(entry.total_carbs for entry in food_entries if entry.total_carbs)
-    total_fat = sum(entry.total_fat for entry in food_entries if entry.total_fat)
+    total_calories = totals['total_calories']
+    total_protein = totals['total_protein']
+    total_carbs = totals['total_carbs']
+    total_fat = totals['total_fat']
     
     # Calculate daily averages
     days = (end_date - start_date).days + 1
@@ -392,20 +479,14 @@ def process_food_query(user_id, query_text):
     response += f"with {avg_protein:.0f}g of protein, {avg_carbs:.0f}g of carbohydrates, and {avg_fat:.0f}g of fat. "
     
     # Get meal type distribution
-    meal_counts = {}
-    for entry in food_entries:
-        if entry.meal_type in meal_counts:
-            meal_counts[entry.meal_type] += 1
-        else:
-            meal_counts[entry.meal_type] = 1
-    
-    meal_summary = ", ".join([f"{count} {meal_type}s" for meal_type, count in meal_counts.items()])
-    response += f"You logged {len(food_entries)} meals in total ({meal_summary})."
+    meal_summary = ", ".join([f"{group['count']} {group['group']}s" for group in meal_types])
+    response += f"You logged {totals['count']} meals in total ({meal_summary})."
     
     return response, data_sources_used
 
-def process_sleep_query(user_id, query_text):
+def process_sleep_query(user_id, query):
     """Process a query about sleep"""
+    query = parse_query(query)
     data_sources_used = []
     
     # Get sleep data sources
@@ -414,72 +495,68 @@ def process_sleep_query(user_id, query_text):
         data_sources_used.append(source.name)
     
     # Determine time range
-    time_range = extract_time_range(query_text)
+    time_range = query.time_range
     start_date, end_date = get_date_range(time_range)
     
-    # Query sleep records
-    sleep_records = SleepRecord.query.filter(
-        SleepRecord.user_id == user_id,
-        SleepRecord.start_time >= start_date,
-        SleepRecord.start_time <= end_date
-    ).order_by(SleepRecord.start_time.desc()).all()
+    # Aggregate sleep records in one query
+    sleep = aggregate(
+        SleepRecord, user_id, SleepRecord.start_time, start_date, end_date,
+        count=func.count(SleepRecord.id),
+        total_duration=total(SleepRecord.duration),
+        avg_deep=func.avg(present(SleepRecord.deep_sleep_duration)),
+        avg_light=func.avg(present(SleepRecord.light_sleep_duration)),
+        avg_rem=func.avg(present(SleepRecord.rem_sleep_duration)),
+        avg_score=func.avg(present(SleepRecord.sleep_score)),
+        max_score=func.max(present(SleepRecord.sleep_score)),
+        avg_heart_rate=func.avg(present(SleepRecord.heart_rate_avg)),
+        min_heart_rate=func.min(case((SleepRecord.heart_rate_avg != 0, present(SleepRecord.heart_rate_min))))
+    )
     
-    if not sleep_records:
+    if not sleep['count']:
         return f"I couldn't find any sleep records in the specified time range ({time_range}).", data_sources_used
     
     # Check for specific metrics
-    if 'deep sleep' in query_text:
-        records_with_deep = [r for r in sleep_records if r.deep_sleep_duration]
-        if not records_with_deep:
+    if query.has('deep sleep'):
+        if not sleep['avg_deep']:
             return "I couldn't find any deep sleep data for this period.", data_sources_used
         
-        avg_deep = sum(r.deep_sleep_duration for r in records_with_deep) / len(records_with_deep)
-        return f"You averaged {avg_deep/3600:.1f} hours of deep sleep per night during this period.", data_sources_used
+        return f"You averaged {sleep['avg_deep']/3600:.1f} hours of deep sleep per night during this period.", data_sources_used
     
-    if 'rem' in query_text:
-        records_with_rem = [r for r in sleep_records if r.rem_sleep_duration]
-        if not records_with_rem:
+    if query.has('rem'):
+        if not sleep['avg_rem']:
             return "I couldn't find any REM sleep data for this period.", data_sources_used
         
-        avg_rem = sum(r.rem_sleep_duration for r in records_with_rem) / len(records_with_rem)
-        return f"You averaged {avg_rem/3600:.1f} hours of REM sleep per night during this period.", data_sources_used
+        return f"You averaged {sleep['avg_rem']/3600:.1f} hours of REM sleep per night during this period.", data_sources_used
     
-    if 'heart rate' in query_text or 'heartrate' in query_text:
-        records_with_hr = [r for r in sleep_records if r.heart_rate_avg]
-        if not records_with_hr:
+    if query.has('heart rate', 'heartrate'):
+        if not sleep['avg_heart_rate']:
             return "I couldn't find any heart rate data during sleep for this period.", data_sources_used
         
-        avg_hr = sum(r.heart_rate_avg for r in records_with_hr) / len(records_with_hr)
-        min_hr = min(r.heart_rate_min for r in records_with_hr if r.heart_rate_min)
-        return f"Your average heart rate during sleep was {avg_hr:.0f} bpm, with a minimum of {min_hr:.0f} bpm.", data_sources_used
+        return f"Your average heart rate during sleep was {sleep['avg_heart_rate']:.0f} bpm, with a minimum of {sleep['min_heart_rate']:.0f} bpm.", data_sources_used
     
-    if 'score' in query_text:
-        records_with_score = [r for r in sleep_records if r.sleep_score]
-        if not records_with_score:
+    if query.has('score'):
+        if not sleep['max_score']:
             return "I couldn't find any sleep score data for this period.", data_sources_used
         
-        avg_score = sum(r.sleep_score for r in records_with_score) / len(records_with_score)
-        max_score = max(r.sleep_score for r in records_with_score)
-        max_date = next(r.start_time.strftime('%A, %B %d') for r in records_with_score if r.sleep_score == max_score)
+        # Most recent night with the best score
+        best_night = db.session.query(SleepRecord.start_time).filter(
+            SleepRecord.user_id == user_id,
+            SleepRecord.start_time >= start_date,
+            SleepRecord.start_time <= end_date,
+            SleepRecord.sleep_score == sleep['max_score']
+        ).order_by(SleepRecord.start_time.desc()).first()
+        max_date = best_night.start_time.strftime('%A, %B %d')
         
-        return f"Your average sleep score was {avg_score:.0f}/100. Your best night was {max_date} with a score of {max_score}.", data_sources_used
+        return f"Your average sleep score was {sleep['avg_score']:.0f}/100. Your best night was {max_date} with a score of {sleep['max_score']}.", data_sources_used
     
     # Default summary
-    total_duration = sum(record.duration for record in sleep_records if record.duration)
-    avg_duration = total_duration / len(sleep_records) if sleep_records else 0
-    
-    # Calculate averages for sleep phases
-    records_with_deep = [r for r in sleep_records if r.deep_sleep_duration]
-    avg_deep = sum(r.deep_sleep_duration for r in records_with_deep) / len(records_with_deep) if records_with_deep else 0
-    
-    records_with_light = [r for r in sleep_records if r.light_sleep_duration]
-    avg_light = sum(r.light_sleep_duration for r in records_with_light) / len(records_with_light) if records_with_light else 0
-    
-    records_with_rem = [r for r in sleep_records if r.rem_sleep_duration]
-    avg_rem = sum(r.rem_sleep_duration for r in records_with_rem) / len(records_with_rem) if records_with_rem else 0
+    avg_duration = sleep['total_duration'] / sleep['count']
     
-    records_with_score = [r for r in sleep_records if r.sleep_score]
-    avg_score = sum(r.sleep_score for r in records_with_score) / len(records_with_score) if records_with_score else None
+    # Averages for sleep phases, over the nights that recorded them
+    avg_deep = sleep['avg_deep'] or 0
+    avg_light = sleep['avg_light'] or 0
+    avg_rem = sleep['avg_rem'] or 0
+    avg_score = sleep['avg_score']
     
     response = f"During this period ({time_range}), you slept an average of {avg_duration/3600:.1f} hours per night. "
     
@@ -495,12 +572,13 @@ def process_sleep_query(user_id, query_text):
     
     return response, data_sources_used
 
-def process_blood_query(user_id, query_text):
+def process_blood_query(user_id, query):
     """Process a query about blood reports"""
+    query = parse_query(query)
     data_sources_used = ["Blood Reports"]
     
     # Determine time range
-    time_range = extract_time_range(query_text)
+    time_range = query.time_range
     start_date, end_date = get_date_range(time_range)
     
     # Query blood reports
@@ -514,70 +592,49 @@ def process_blood_query(user_id, query_text):
         return f"I couldn't find any blood reports in the specified time range ({time_range}).", data_sources_used
     
     # Check for specific metrics
-    metrics_of_interest = [
-        ('cholesterol', ['cholesterol', 'ldl', 'hdl']),
-        ('glucose', ['glucose', 'blood sugar']),
-        ('hemoglobin', ['hemoglobin', 'hgb', 'hb']),
-        ('white blood cell', ['white blood cell', 'wbc']),
-        ('red blood cell', ['red blood cell', 'rbc']),
-        ('platelet', ['platelet']),
-        ('vitamin d', ['vitamin d']),
-        ('vitamin b12', ['vitamin b12']),
-        ('iron', ['iron']),
-        ('thyroid', ['thyroid', 'tsh', 't3', 't4'])
-    ]
-    
-    for metric_name, keywords in metrics_of_interest:
-        if any(keyword in query_text for keyword in keywords):
-            # Find all metrics matching this category
-            all_metrics = []
-            for report in blood_reports:
-                report_metrics = BloodMetric.query.filter(
-                    BloodMetric.blood_report_id == report.id,
-                    BloodMetric.metric_name.ilike(f'%{metric_name}%')
-                ).all()
-                
-                for metric in report_metrics:
-                    all_metrics.append({
-                        'name': metric.metric_name,
-                        'value': metric.metric_value,
-                        'unit': metric.unit,
-                        'reference_range': metric.reference_range,
-                        'is_normal': metric.is_normal,
-                        'date': report.report_date
-                    })
-            
-            if not all_metrics:
-                return f"I couldn't find any {metric_name} data in your blood reports for this period.", data_sources_used
-            
-            # Sort by date, most recent first
-            all_metrics.sort(key=lambda x: x['date'], reverse=True)
-            latest = all_metrics[0]
-            
-            response = f"Your most recent {latest['name']} level was {latest['value']} {latest['unit']} on {latest['date'].strftime('%B %d, %Y')}. "
-            
-            if latest['reference_range']:
-                response += f"The reference range is {latest['reference_range']} {latest['unit']}. "
+    for metric_name in query.blood_metrics:
+        # Fetch the history of every coded metric in this category in one indexed query
+        all_metrics = [
+            {
+                'name': metric.metric_name,
+                'value': metric.metric_value,
+                'unit': metric.unit,
+                'reference_range': metric.reference_range,
+                'is_normal': metric.is_normal,
+                'date': metric.report_date
+            }
+            for metric in metric_history(user_id, QUERY_METRIC_CODES[metric_name], start_date.date(), end_date.date())
+        ]
+        
+        if not all_metrics:
+            return f"I couldn't find any {metric_name} data in your blood reports for this period.", data_sources_used
+        
+        latest = all_metrics[0]
+        
+        response = f"Your most recent {latest['name']} level was {latest['value']} {latest['unit']} on {latest['date'].strftime('%B %d, %Y')}. "
+        
+        if latest['reference_range']:
+            response += f"The reference range is {latest['reference_range']} {latest['unit']}. "
+        
+        if latest['is_normal'] is not None:
+            if latest['is_normal']:
+                response += "This is within the normal range."
+            else:
+                response += "This is outside the normal range."
+        
+        # If we have historical data, show trend
+        if len(all_metrics) > 1:
+            oldest = all_metrics[-1]
+            change = latest['value'] - oldest['value']
+            change_pct = (change / oldest['value']) * 100
             
-            if latest['is_normal'] is not None:
-                if latest['is_normal']:
-                    response += "This is within the normal range."
+            if abs(change_pct) > 5:  # Only mention if change is significant
+                if change > 0:
+                    response += f" Your {latest['name']} has increased by {abs(change):.1f} {latest['unit']} ({abs(change_pct):.1f}%) since {oldest['date'].strftime('%B %d, %Y')}."
                 else:
-                    response += "This is outside the normal range."
-            
-            # If we have historical data, show trend
-            if len(all_metrics) > 1:
-                oldest = all_metrics[-1]
-                change = latest['value'] - oldest['value']
-                change_pct = (change / oldest['value']) * 100
-                
-                if abs(change_pct) > 5:  # Only mention if change is significant
-                    if change > 0:
-                        response += f" Your {latest['name']} has increased by {abs(change):.1f} {latest['unit']} ({abs(change_pct):.1f}%) since {oldest['date'].strftime('%B %d, %Y')}."
-                    else:
-                        response += f" Your {latest['name']} has decreased by {abs(change):.1f} {latest['unit']} ({abs(change_pct):.1f}%) since {oldest['date'].strftime('%B %d, %Y')}."
-            
-            return response, data_sources_used
+                    response += f" Your {latest['name']} has decreased by {abs(change):.1f} {latest['unit']} ({abs(change_pct):.1f}%) since {oldest['date'].strftime('%B %d, %Y')}."
+        
+        return response, data_sources_used
     
     # Default summary
     latest_report = blood_reports[0]
@@ -600,57 +657,58 @@ def process_blood_query(user_id, query_text):
     
     return response, data_sources_used
 
-def process_medication_query(user_id, query_text):
+def process_medication_query(user_id, query):
     """Process a query about medications"""
+    query = parse_query(query)
     data_sources_used = ["Medications"]
     
     # Determine time range
-    time_range = extract_time_range(query_text)
+    time_range = query.time_range
     start_date, end_date = get_date_range(time_range)
     
-    # Get user medications
-    user_medications = UserMedication.query.filter_by(user_id=user_id).all()
+    # Get user medications with their medications in one joined query
+    user_medications = get_user_medications(user_id)
     
     if not user_medications:
         return "You don't have any medications tracked in the system.", data_sources_used
     
-    # Get medication logs
-    medication_logs = []
-    for um in user_medications:
-        logs = MedicationLog.query.filter(
-            MedicationLog.user_medication_id == um.id,
-            MedicationLog.taken_at >= start_date,
-            MedicationLog.taken_at <= end_date
-        ).all()
-        
-        for log in logs:
-            medication = Medication.query.get(um.medication_id)
-            medication_logs.append({
-                'name': medication.name if medication else 'Unknown',
-                'custom_name': um.custom_name,
-                'dosage': log.dosage_taken or um.dosage,
-                'taken_at': log.taken_at
-            })
+    # Get medication logs joined with their medications in one query
+    medication_logs = [
+        {
+            'user_medication_id': log['user_medication_id'],
+            'name': log['medication_name'],
+            'custom_name': log['custom_name'],
+            'dosage': log['dosage_taken'] or log['dosage'],
+            'taken_at': log['taken_at']
+        }
+        for log in get_medication_log_entries(user_id, start_date, end_date, newest_first=False)
+    ]
     
     if not medication_logs:
         return f"I couldn't find any medication logs in the specified time range ({time_range}).", data_sources_used
     
+    # Index logs by user medication for the lookups below; a drug tracked
+    # twice, e.g. at two dosages, keeps its logs apart like its adherence
+    logs_by_user_medication = {}
+    for log in medication_logs:
+        logs_by_user_medication.setdefault(log['user_medication_id'], []).append(log)
+    
     # Check for specific medication
-    for um in user_medications:
-        medication = Medication.query.get(um.medication_id)
-        if medication and medication.name.lower() in query_text:
-            # Filter logs for this medication
-            med_logs = [log for log in medication_logs if log['name'].lower() == medication.name.lower()]
+    for um, medication in user_medications:
+        if medication and medication.name.lower() in query.text:
+            # Logs for this medication
+            med_logs = logs_by_user_medication.get(um.id, [])
             
             if not med_logs:
                 return f"I couldn't find any logs for {medication.name} in the specified time range ({time_range}).", data_sources_used
             
-            adherence_rate = len(med_logs) / ((end_date - start_date).days + 1)
-            if 'daily' in um.frequency.lower():
-                adherence_rate *= 100  # Convert to percentage for daily medications
-                return f"You took {medication.name} {len(med_logs)} times during this period, with an adherence rate of {adherence_rate:.0f}% for your daily schedule.", data_sources_used
+            # Match the doses against the medication's schedule
+            adherence = medication_adherence(user_id, start_date.date(), end_date.date(), [um.id])['medications'].get(um.id)
+            if adherence and adherence['expected']:
+                return f"You took {medication.name} {len(med_logs)} times during this period, with an adherence rate of {adherence['rate']:.0f}% ({adherence['taken']} of {adherence['expected']} scheduled doses).", data_sources_used
             else:
-                return f"You took {medication.name} {len(med_logs)} times during this period, averaging {adherence_rate:.1f} doses per day.", data_sources_used
+                doses_per_day = len(med_logs) / ((end_date - start_date).days + 1)
+                return f"You took {medication.name} {len(med_logs)} times during this period, averaging {doses_per_day:.1f} doses per day.", data_sources_used
     
     # Default summary
     medication_counts = {}
@@ -671,20 +729,16 @@ def process_medication_query(user_id, query_text):
             response += f"{name} ({count} times), "
         response = response.rstrip(', ') + ". "
     
-    # Calculate adherence rate if we have frequency information
-    daily_meds = [um for um in user_medications if um.frequency and 'daily' in um.frequency.lower()]
-    if daily_meds:
-        days = (end_date - start_date).days + 1
-        expected_doses = len(daily_meds) * days
-        actual_doses = sum(count for name, count in medication_counts.items())
-        adherence_rate = (actual_doses / expected_doses) * 100
-        
-        response += f"Your overall medication adherence rate was {adherence_rate:.0f}%."
+    # Calculate adherence rate for medications with a schedule
+    adherence = medication_adherence(user_id, start_date.date(), end_date.date())
+    if adherence['expected']:
+        response += f"Your overall medication adherence rate was {adherence['rate']:.0f}% ({adherence['taken']} of {adherence['expected']} scheduled doses)."
     
     return response, data_sources_used
 
-def process_workout_query(user_id, query_text):
+def process_workout_query(user_id, query):
     """Process a query about workouts"""
+    query = parse_query(query)
     data_sources_used = []
     
     # Get Hevy data source
@@ -692,116 +746,99 @@ def process_workout_query(user_id, query_text):
     if hevy_source:
         data_sources_used.append("Hevy")
     
+    # Personal records cover all history, so answer them before the time range;
+    # a bare best or max within a time range is about that range instead
+    if query.has('personal record', 'personal best') or (query.has('best', 'max') and not query.time_range_given):
+        for exercise_name in query.exercises:
+            exercise = Exercise.query.filter(Exercise.name.ilike(f'%{exercise_name}%')).first()
+            if not exercise:
+                continue
+            
+            record = get_personal_record(user_id, exercise.id)
+            if not record or not record.best_weight:
+                return f"I couldn't find any {exercise.name} sets with a weight logged.", data_sources_used
+            
+            response = f"Your {exercise.name} personal best is {record.best_weight:.1f}kg, set on {record.best_weight_at.strftime('%B %d, %Y')}. "
+            if record.best_e1rm:
+                response += f"Your best estimated one-rep max is {record.best_e1rm:.1f}kg ({record.best_e1rm_at.strftime('%B %d, %Y')}). "
+            if record.best_volume:
+                response += f"Your biggest session was {record.best_volume:.0f}kg of volume on {record.best_volume_at.strftime('%B %d, %Y')}."
+            return response.strip(), data_sources_used
+    
     # Determine time range
-    time_range = extract_time_range(query_text)
+    time_range = query.time_range
     start_date, end_date = get_date_range(time_range)
     
-    # Query workouts
-    workouts = Workout.query.filter(
-        Workout.user_id == user_id,
-        Workout.workout_date >= start_date,
-        Workout.workout_date <= end_date
-    ).order_by(Workout.workout_date.desc()).all()
+    # Aggregate workouts per name in one query
+    workout_names = workout_summary(user_id, start_date, end_date)
     
-    if not workouts:
+    if not workout_names:
         return f"I couldn't find any workouts in the specified time range ({time_range}).", data_sources_used
     
+    totals = rollup(workout_names)
+    
     # Check for specific exercises
-    common_exercises = ['bench press', 'squat', 'deadlift', 'pull up', 'shoulder press', 'bicep curl']
-    for exercise_name in common_exercises:
-        if exercise_name in query_text:
-            # Find the exercise
-            exercise = Exercise.query.filter(Exercise.name.ilike(f'%{exercise_name}%')).first()
-            if not exercise:
-                continue
+    for exercise_name in query.exercises:
+        # Find the exercise
+        exercise = Exercise.query.filter(Exercise.name.ilike(f'%{exercise_name}%')).first()
+        if not exercise:
+            continue
+        
+        # Find workout exercises, most recent first
+        workout_exercises = exercise_history(user_id, exercise.id, start_date, end_date)
+        
+        if not workout_exercises:
+            return f"I couldn't find any {exercise.name} exercises in the specified time range ({time_range}).", data_sources_used
+        
+        # Calculate progress
+        if len(workout_exercises) > 1 and all(ex['weight'] for ex in workout_exercises):
+            latest = workout_exercises[0]
+            oldest = workout_exercises[-1]
             
-            # Find workout exercises
-            workout_exercises = []
-            for workout in workouts:
-                exercises = WorkoutExercise.query.filter_by(
-                    workout_id=workout.id,
-                    exercise_id=exercise.id
-                ).all()
-                
-                for ex in exercises:
-                    workout_exercises.append({
-                        'workout_date': workout.workout_date,
-                        'sets': ex.sets,
-                        'reps': ex.reps,
-                        'weight': ex.weight
-                    })
+            weight_change = latest['weight'] - oldest['weight']
+            weight_change_pct = (weight_change / oldest['weight']) * 100 if oldest['weight'] else 0
             
-            if not workout_exercises:
-                return f"I couldn't find any {exercise.name} exercises in the specified time range ({time_range}).", data_sources_used
+            response = f"For {exercise.name}, your most recent workout on {latest['workout_date'].strftime('%B %d')} was {latest['sets']} sets of {latest['reps']} reps at {latest['weight']}kg. "
             
-            # Sort by date, most recent first
-            workout_exercises.sort(key=lambda x: x['workout_date'], reverse=True)
+            if abs(weight_change_pct) > 5:  # Only mention if change is significant
+                if weight_change > 0:
+                    response += f"You've increased your weight by {weight_change:.1f}kg ({weight_change_pct:.1f}%) since {oldest['workout_date'].strftime('%B %d')}."
+                else:
+                    response += f"Your weight has decreased by {abs(weight_change):.1f}kg ({abs(weight_change_pct):.1f}%) since {oldest['workout_date'].strftime('%B %d')}."
             
-            # Calculate progress
-            if len(workout_exercises) > 1 and all(ex['weight'] for ex in workout_exercises):
-                latest = workout_exercises[0]
-                oldest = workout_exercises[-1]
-                
-                weight_change = latest['weight'] - oldest['weight']
-                weight_change_pct = (weight_change / oldest['weight']) * 100 if oldest['weight'] else 0
-                
-                response = f"For {exercise.name}, your most recent workout on {latest['workout_date'].strftime('%B %d')} was {latest['sets']} sets of {latest['reps']} reps at {latest['weight']}kg. "
-                
-                if abs(weight_change_pct) > 5:  # Only mention if change is significant
-                    if weight_change > 0:
-                        response += f"You've increased your weight by {weight_change:.1f}kg ({weight_change_pct:.1f}%) since {oldest['workout_date'].strftime('%B %d')}."
-                    else:
-                        response += f"Your weight has decreased by {abs(weight_change):.1f}kg ({abs(weight_change_pct):.1f}%) since {oldest['workout_date'].strftime('%B %d')}."
-                
-                return response, data_sources_used
-            else:
-                latest = workout_exercises[0]
-                return f"For {exercise.name}, your most recent workout on {latest['workout_date'].strftime('%B %d')} was {latest['sets']} sets of {latest['reps']} reps at {latest['weight']}kg.", data_sources_used
+            return response, data_sources_used
+        else:
+            latest = workout_exercises[0]
+            return f"For {exercise.name}, your most recent workout on {latest['workout_date'].strftime('%B %d')} was {latest['sets']} sets of {latest['reps']} reps at {latest['weight']}kg.", data_sources_used
     
     # Check for specific metrics
-    if 'volume' in query_text:
-        total_volume = 0
-        for workout in workouts:
-            exercises = WorkoutExercise.query.filter_by(workout_id=workout.id).all()
-            for ex in exercises:
-                if ex.sets and ex.reps and ex.weight:
-                    total_volume += ex.sets * ex.reps * ex.weight
-        
-        avg_volume = total_volume / len(workouts) if workouts else 0
-        return f"Your total workout volume was {total_volume:.0f}kg, averaging {avg_volume:.0f}kg per workout.", data_sources_used
-    
-    if 'duration' in query_text or 'time' in query_text:
-        total_duration = sum(workout.duration for workout in workouts if workout.duration)
-        avg_duration = total_duration / len(workouts) if workouts else 0
+    if query.has('volume'):
+        volume = total_volume(user_id, start_date, end_date)
+        avg_volume = volume / totals['count']
+        return f"Your total workout volume was {volume:.0f}kg, averaging {avg_volume:.0f}kg per workout.", data_sources_used
+    
+    if query.has('duration', 'time'):
+        total_duration = totals['total_duration']
+        avg_duration = total_duration / totals['count']
         
         return f"You spent a total of {total_duration//3600} hours and {(total_duration%3600)//60} minutes working out, averaging {avg_duration//60:.0f} minutes per session.", data_sources_used
     
-    if 'calories' in query_text:
-        total_calories = sum(workout.calories_burned for workout in workouts if workout.calories_burned)
-        avg_calories = total_calories / len(workouts) if workouts else 0
+    if query.has('calories'):
+        total_calories = totals['total_calories']
+        avg_calories = total_calories / totals['count']
         
         return f"You burned approximately {total_calories:.0f} calories in total during your workouts, averaging {avg_calories:.0f} calories per session.", data_sources_used
     
     # Default summary
-    workout_names = {}
-    for workout in workouts:
-        name = workout.workout_name
-        if name in workout_names:
-            workout_names[name] += 1
-        else:
-            workout_names[name] = 1
-    
-    most_frequent = sorted(workout_names.items(), key=lambda x: x[1], reverse=True)
+    total_duration = totals['total_duration']
+    total_calories = totals['total_calories']
     
-    total_duration = sum(workout.duration for workout in workouts if workout.duration)
-    total_calories = sum(workout.calories_burned for workout in workouts if workout.calories_burned)
+    response = f"During this period ({time_range}), you completed {totals['count']} workouts. "
     
-    response = f"During this period ({time_range}), you completed {len(workouts)} workouts. "
-    
-    if most_frequent:
+    if workout_names:
         response += "Your most frequent workout types were: "
-        for name, count in most_frequent[:3]:
-            response += f"{name} ({count} times), "
+        for group in workout_names[:3]:
+            response += f"{group['group']} ({group['count']} times), "
         response = response.rstrip(', ') + ". "
     
     if total_duration:
@@ -812,187 +849,226 @@ def process_workout_query(user_id, query_text):
     
     return response, data_sources_used
 
-def process_summary_query(user_id, query_text):
+def process_summary_query(user_id, query):
     """Process a summary query about overall health"""
+    query = parse_query(query)
     data_sources_used = []
     
-    # Determine time range
-    time_range = extract_time_range(query_text)
-    start_date, end_date = get_date_range(time_range)
-    
-    # Get activity summary
-    activity_response, activity_sources = process_activity_query(user_id, f"activity summary {time_range}")
-    if "I couldn't find" not in activity_response:
-        data_sources_used.extend(activity_sources)
-    
-    # Get food summary
-    food_response, food_sources = process_food_query(user_id, f"food summary {time_range}")
-    if "I couldn't find" not in food_response:
-        data_sources_used.extend(food_sources)
-    
-    # Get sleep summary
-    sleep_response, sleep_sources = process_sleep_query(user_id, f"sleep summary {time_range}")
-    if "I couldn't find" not in sleep_response:
-        data_sources_used.extend(sleep_sources)
-    
-    # Get workout summary
-    workout_response, workout_sources = process_workout_query(user_id, f"workout summary {time_range}")
-    if "I couldn't find" not in workout_response:
-        data_sources_used.extend(workout_sources)
-    
-    # Compile response
-    response = f"Here's your health summary for {time_range}:\n\n"
-    
-    if "I couldn't find" not in activity_response:
-        response += f"Activity: {activity_response}\n\n"
-    
-    if "I couldn't find" not in sleep_response:
-        response += f"Sleep: {sleep_response}\n\n"
-    
-    if "I couldn't find" not in food_response:
-        response += f"Nutrition: {food_response}\n\n"
+    # Collect every section, then assemble them in a fixed order
+    sections = {}
+    for title, text, sources in summary_sections(user_id, query):
+        sections[title] = text
+        data_sources_used.extend(sources)
     
-    if "I couldn't find" not in workout_response:
-        response += f"Workouts: {workout_response}\n\n"
+    return format_summary(query.time_range, sections), data_sources_used
+
+def summary_sections(user_id, query):
+    """Yield the sections of a summary as (title, text, data sources) as each is computed
+    
+    Every domain is answered concurrently, each on a pool thread with its
+    own session, and yielded as soon as it finishes; domains without data
+    are left out. The stored insights come last.
+    """
+    query = parse_query(query)
+    time_range = query.time_range
+    
+    app = current_app._get_current_object()
+    futures = {
+        summary_executor.submit(run_with_app_context, app, handler, user_id, f"{domain} summary {time_range}"): title
+        for title, domain, handler in [
+            ('Activity', 'activity', process_activity_query),
+            ('Sleep', 'sleep', process_sleep_query),
+            ('Nutrition', 'food', process_food_query),
+            ('Workouts', 'workout', process_workout_query)
+        ]
+    }
+    for future in as_completed(futures):
+        response, sources = future.result()
+        if "I couldn't find" not in response:
+            yield futures[future], response, sources
     
-    # Generate insights
-    insights = create_insights_for_user(user_id, start_date, end_date)
+    # Read the stored insights, which the change bus keeps current
+    insights = Insight.query.filter_by(user_id=user_id) \
+                          .order_by(Insight.relevance_score.desc(), Insight.id) \
+                          .limit(3).all()
     if insights:
-        response += "Insights:\n"
-        for insight in insights[:3]:  # Show top 3 insights
-            response += f"- {insight.insight_text}\n"
-    
-    return response, data_sources_used
+        yield "Insights", "\n".join(f"- {insight.insight_text}" for insight in insights), []
+    else:
+        seed_insights(app, user_id)
+
+def format_summary(time_range, sections):
+    """Assemble summary sections, keyed by title, into the summary response"""
+    response = f"Here's your health summary for {time_range}:\n\n"
+    for title in SUMMARY_SECTIONS:
+        if title not in sections:
+            continue
+        if title == "Insights":
+            response += f"Insights:\n{sections[title]}\n"
+        else:
+            response += f"{title}: {sections[title]}\n\n"
+    return response
+
+def run_with_app_context(app, handler, user_id, query):
+    """Run a chat handler on a pool thread with its own app context and session"""
+    with app.app_context():
+        return handler(user_id, query)
+
+def seed_insights(app, user_id):
+    """Generate a user's first insights in the background
+    
+    Summaries only read stored insights; once a user has some, the change
+    bus keeps them current.
+    """
+    with _seeding_lock:
+        if user_id in _seeding:
+            return
+        _seeding.add(user_id)
+    
+    def seed():
+        try:
+            with app.app_context():
+                if not Insight.query.filter_by(user_id=user_id).first():
+                    create_insights_for_user(user_id)
+        except Exception as e:
+            logger.error(f"Failed to generate insights for user {user_id}: {str(e)}")
+        finally:
+            with _seeding_lock:
+                _seeding.discard(user_id)
+    
+    summary_executor.submit(seed)
+
+# Per comparable domain: the heading it is compared under, the DataSource
+# names it reads (None reads every sleep source) and its metrics with
+# label, divisor, unit and decimals
+COMPARISON_DOMAINS = {
+    'activity': ('activities', ['Strava'], [
+        ('count', 'Activities', 1, '', 0),
+        ('distance', 'Distance', 1000, ' km', 2),
+        ('duration', 'Duration', 3600, ' hours', 1),
+        ('calories', 'Calories burned', 1, ' kcal', 0),
+        ('heart_rate', 'Average heart rate', 1, ' bpm', 0)
+    ]),
+    'food': ('nutrition', ['HealthifyMe'], [
+        ('count', 'Meals logged', 1, '', 0),
+        ('calories', 'Calories', 1, ' kcal', 0),
+        ('protein', 'Protein', 1, 'g', 1),
+        ('carbs', 'Carbs', 1, 'g', 1),
+        ('fat', 'Fat', 1, 'g', 1)
+    ]),
+    'sleep': ('sleep', None, [
+        ('count', 'Nights', 1, '', 0),
+        ('duration', 'Average sleep', 3600, ' hours', 1),
+        ('score', 'Average sleep score', 1, '', 0),
+        ('deep_sleep', 'Average deep sleep', 3600, ' hours', 1)
+    ]),
+    'workout': ('workouts', ['Hevy'], [
+        ('count', 'Workouts', 1, '', 0),
+        ('duration', 'Duration', 3600, ' hours', 1),
+        ('calories', 'Calories burned', 1, ' kcal', 0)
+    ])
+}
+
+# Per comparison metric: the domain it is read from, label, divisor, unit and decimals
+COMPARISON_METRIC_FORMATS = {
+    'steps': ('activity', 'Steps (approximate)', 1, '', 0),
+    'heart rate': ('activity', 'Average heart rate', 1, ' bpm', 0),
+    'calories': ('food', 'Calories consumed', 1, ' kcal', 0),
+    'sleep': ('sleep', 'Average sleep', 3600, ' hours', 1),
+    'weight': ('workout', 'Heaviest weight lifted', 1, ' kg', 1)
+}
+
+def comparison_sources(domains):
+    """Names of the data sources behind the compared domains, from one query"""
+    names = [name for domain in domains for name in (COMPARISON_DOMAINS[domain][1] or [])]
+    conditions = [DataSource.name.in_(names)]
+    if 'sleep' in domains:
+        conditions.append(DataSource.source_type == "sleep")
+    return [source.name for source in DataSource.query.filter(or_(*conditions)).all()]
+
+def format_value(value, divisor, unit, decimals):
+    """Format a compared value, or 'no data' if it is missing"""
+    if value is None:
+        return "no data"
+    return f"{value / divisor:,.{decimals}f}{unit}"
 
-def process_comparison_query(user_id, query_text):
+def format_delta(delta, divisor, unit, decimals):
+    """Format one metric of a period comparison as 'first vs second (change)'"""
+    line = f"{format_value(delta['first'], divisor, unit, decimals)} vs {format_value(delta['second'], divisor, unit, decimals)}"
+    if delta['change'] is None:
+        return line
+    change = f"{delta['change'] / divisor:+,.{decimals}f}{unit}"
+    if delta['change_pct'] is not None:
+        change += f", {delta['change_pct']:+.0f}%"
+    return f"{line} ({change})"
+
+def process_comparison_query(user_id, query):
     """Process a comparison query between different time periods or metrics"""
+    query = parse_query(query)
     data_sources_used = []
     
     # Check for time period comparison
-    time_periods = ['today', 'yesterday', 'this week', 'last week', 'this month', 'last month']
-    period_pairs = []
-    
-    for i, period1 in enumerate(time_periods):
-        for period2 in time_periods[i+1:]:
-            if period1 in query_text and period2 in query_text:
-                period_pairs.append((period1, period2))
-    
-    if period_pairs:
-        period1, period2 = period_pairs[0]  # Take the first pair found
+    if len(query.periods) >= 2:
+        period1, period2 = query.periods[:2]  # Take the first pair found
+        periods = [get_date_range(period1), get_date_range(period2)]
         
-        # Determine what to compare
-        if 'activity' in query_text or 'steps' in query_text:
-            response1, sources1 = process_activity_query(user_id, f"activity {period1}")
-            response2, sources2 = process_activity_query(user_id, f"activity {period2}")
-            data_sources_used.extend(sources1 + sources2)
-            
-            return f"Comparing activities:\n\n{period1.capitalize()}: {response1}\n\n{period2.capitalize()}: {response2}", data_sources_used
-        
-        elif 'food' in query_text or 'calories' in query_text or 'nutrition' in query_text:
-            response1, sources1 = process_food_query(user_id, f"food {period1}")
-            response2, sources2 = process_food_query(user_id, f"food {period2}")
-            data_sources_used.extend(sources1 + sources2)
-            
-            return f"Comparing nutrition:\n\n{period1.capitalize()}: {response1}\n\n{period2.capitalize()}: {response2}", data_sources_used
+        # Determine what to compare, defaulting to every domain
+        if query.has('activity', 'steps'):
+            domains = ['activity']
+        elif query.has('food', 'calories', 'nutrition'):
+            domains = ['food']
+        elif query.has('sleep'):
+            domains = ['sleep']
+        elif query.has('workout', 'exercise'):
+            domains = ['workout']
+        else:
+            domains = ['activity', 'food', 'sleep', 'workout']
         
-        elif 'sleep' in query_text:
-            response1, sources1 = process_sleep_query(user_id, f"sleep {period1}")
-            response2, sources2 = process_sleep_query(user_id, f"sleep {period2}")
-            data_sources_used.extend(sources1 + sources2)
+        # Both periods of a domain come from one query, with the deltas taken directly
+        sections = []
+        for domain in domains:
+            heading, _, fields = COMPARISON_DOMAINS[domain]
+            first, second = compare_domain(domain, user_id, periods)
+            if not first['count'] and not second['count']:
+                continue
             
-            return f"Comparing sleep:\n\n{period1.capitalize()}: {response1}\n\n{period2.capitalize()}: {response2}", data_sources_used
+            changes = deltas(first, second)
+            lines = [
+                f"- {label}: {format_delta(changes[name], divisor, unit, decimals)}"
+                for name, label, divisor, unit, decimals in fields
+                if changes[name]['first'] is not None or changes[name]['second'] is not None
+            ]
+            sections.append("\n".join(lines) if len(domains) == 1 else f"{heading.capitalize()}:\n" + "\n".join(lines))
         
-        elif 'workout' in query_text or 'exercise' in query_text:
-            response1, sources1 = process_workout_query(user_id, f"workout {period1}")
-            response2, sources2 = process_workout_query(user_id, f"workout {period2}")
-            data_sources_used.extend(sources1 + sources2)
-            
-            return f"Comparing workouts:\n\n{period1.capitalize()}: {response1}\n\n{period2.capitalize()}: {response2}", data_sources_used
+        data_sources_used.extend(comparison_sources(domains))
+        subject = COMPARISON_DOMAINS[domains[0]][0] if len(domains) == 1 else "health summaries"
+        if not sections:
+            return f"I couldn't find any {subject} data for {period1} or {period2} to compare.", data_sources_used
         
-        else:
-            # Default to overall summary comparison
-            response1, sources1 = process_summary_query(user_id, f"summary {period1}")
-            response2, sources2 = process_summary_query(user_id, f"summary {period2}")
-            data_sources_used.extend(sources1 + sources2)
-            
-            return f"Comparing health summaries:\n\n{period1.capitalize()}:\n{response1}\n\n{period2.capitalize()}:\n{response2}", data_sources_used
+        return f"Comparing {subject}, {period1} vs {period2}:\n\n" + "\n\n".join(sections), data_sources_used
     
     # Check for metric comparison
-    metrics = ['steps', 'calories', 'sleep', 'heart rate', 'weight']
-    metric_pairs = []
-    
-    for i, metric1 in enumerate(metrics):
-        for metric2 in metrics[i+1:]:
-            if metric1 in query_text and metric2 in query_text:
-                metric_pairs.append((metric1, metric2))
-    
-    if metric_pairs:
-        metric1, metric2 = metric_pairs[0]  # Take the first pair found
-        time_range = extract_time_range(query_text) or "this week"
+    if len(query.metrics) >= 2:
+        metrics = query.metrics[:2]  # Take the first pair found
+        time_range = query.time_range
+        start_date, end_date = get_date_range(time_range)
         
-        # Get data for each metric
-        if metric1 == 'steps':
-            response1, sources1 = process_activity_query(user_id, f"steps {time_range}")
-            data_sources_used.extend(sources1)
-        elif metric1 == 'calories':
-            response1, sources1 = process_food_query(user_id, f"calories {time_range}")
-            data_sources_used.extend(sources1)
-        elif metric1 == 'sleep':
-            response1, sources1 = process_sleep_query(user_id, f"sleep duration {time_range}")
-            data_sources_used.extend(sources1)
-        elif metric1 == 'heart rate':
-            response1, sources1 = process_activity_query(user_id, f"heart rate {time_range}")
-            data_sources_used.extend(sources1)
-        elif metric1 == 'weight':
-            response1, sources1 = process_workout_query(user_id, f"weight {time_range}")
-            data_sources_used.extend(sources1)
+        # Metrics read from the same table share one scan of the time range
+        values = compare_metrics(user_id, metrics, start_date, end_date)
         
-        if metric2 == 'steps':
-            response2, sources2 = process_activity_query(user_id, f"steps {time_range}")
-            data_sources_used.extend(sources2)
-        elif metric2 == 'calories':
-            response2, sources2 = process_food_query(user_id, f"calories {time_range}")
-            data_sources_used.extend(sources2)
-        elif metric2 == 'sleep':
-            response2, sources2 = process_sleep_query(user_id, f"sleep duration {time_range}")
-            data_sources_used.extend(sources2)
-        elif metric2 == 'heart rate':
-            response2, sources2 = process_activity_query(user_id, f"heart rate {time_range}")
-            data_sources_used.extend(sources2)
-        elif metric2 == 'weight':
-            response2, sources2 = process_workout_query(user_id, f"weight {time_range}")
-            data_sources_used.extend(sources2)
+        lines = []
+        for metric in metrics:
+            _, label, divisor, unit, decimals = COMPARISON_METRIC_FORMATS[metric]
+            lines.append(f"- {label}: {format_value(values[metric], divisor, unit, decimals)}")
         
-        return f"Comparing {metric1} and {metric2} for {time_range}:\n\n{metric1.capitalize()}: {response1}\n\n{metric2.capitalize()}: {response2}", data_sources_used
+        data_sources_used.extend(comparison_sources({COMPARISON_METRIC_FORMATS[metric][0] for metric in metrics}))
+        return f"Comparing {metrics[0]} and {metrics[1]} for {time_range}:\n\n" + "\n".join(lines), data_sources_used
     
     # If no specific comparison found, provide a general response
     return "I can compare different time periods (like 'this week vs last week') or different metrics (like 'steps vs calories'). Please specify what you'd like to compare.", data_sources_used
 
 def extract_time_range(query_text):
     """Extract time range from query text"""
-    time_ranges = {
-        'today': 'today',
-        'yesterday': 'yesterday',
-        'this week': 'this week',
-        'last week': 'last week',
-        'this month': 'this month',
-        'last month': 'last month',
-        'this year': 'this year',
-        'last year': 'last year',
-        'past week': 'past week',
-        'past month': 'past month',
-        'past year': 'past year',
-        'last 7 days': 'past week',
-        'last 30 days': 'past month',
-        'last 365 days': 'past year'
-    }
-    
-    for range_text, range_value in time_ranges.items():
-        if range_text in query_text:
-            return range_value
-    
-    # Default to "this week" if no time range specified
-    return "this week"
+    return parse_query(query_text).time_range
 
 def get_date_range(time_range):
     """Convert time range to start and end dates"""
@@ -1058,16 +1134,41 @@ def get_date_range(time_range):
         start_of_week = today - timedelta(days=today.weekday())
         return start_of_week, today + timedelta(days=1) - timedelta(microseconds=1)
 
-def create_insights_for_user(user_id, start_date=None, end_date=None):
-    """Generate insights for a user based on their health data"""
+# Data source each insight domain's insights are based on, which tells the
+# insights of a domain apart when only some domains are regenerated
+INSIGHT_SOURCES = {
+    'activity': "Strava",
+    'sleep': "Apple Health",
+    'food': "HealthifyMe",
+    'workout': "Hevy"
+}
+
+def create_insights_for_user(user_id, start_date=None, end_date=None, domains=None):
+    """Generate insights for a user based on their health data
+    
+    With domains, only the insights based on those domains are replaced and
+    the other domains' data is not read. Activity and sleep are regenerated
+    together, as the correlation insight reads both.
+    """
     if not start_date:
         start_date = datetime.utcnow() - timedelta(days=30)
     
     if not end_date:
         end_date = datetime.utcnow()
     
+    regenerate = set(domains) if domains else set(INSIGHT_SOURCES)
+    if regenerate & {'activity', 'sleep'}:
+        regenerate |= {'activity', 'sleep'}
+    
     # Clear existing insights
-    Insight.query.filter_by(user_id=user_id).delete()
+    if regenerate >= set(INSIGHT_SOURCES):
+        Insight.query.filter_by(user_id=user_id).delete()
+    else:
+        sources = {INSIGHT_SOURCES[domain] for domain in regenerate}
+        for insight in Insight.query.filter_by(user_id=user_id).all():
+            if sources.intersection(insight.data_sources or ()):
+                db.session.delete(insight)
+    bump_data_version(user_id)
     
     insights = []
     
@@ -1076,7 +1177,7 @@ def create_insights_for_user(user_id, start_date=None, end_date=None):
         Activity.user_id == user_id,
         Activity.start_time >= start_date,
         Activity.start_time <= end_date
-    ).all()
+    ).all() if 'activity' in regenerate else []
     
     if activities:
         # Check for activity trends
@@ -1123,7 +1224,7 @@ def create_insights_for_user(user_id, start_date=None, end_date=None):
         SleepRecord.user_id == user_id,
         SleepRecord.start_time >= start_date,
         SleepRecord.start_time <= end_date
-    ).all()
+    ).all() if 'sleep' in regenerate else []
     
     if sleep_records:
         # Check for sleep score trends
@@ -1177,7 +1278,7 @@ def create_insights_for_user(user_id, start_date=None, end_date=None):
         FoodEntry.user_id == user_id,
         FoodEntry.consumed_at >= start_date,
         FoodEntry.consumed_at <= end_date
-    ).all()
+    ).all() if 'food' in regenerate else []
     
     if food_entries:
         # Check for calorie trends
@@ -1245,7 +1346,7 @@ def create_insights_for_user(user_id, start_date=None, end_date=None):
         Workout.user_id == user_id,
         Workout.workout_date >= start_date,
         Workout.workout_date <= end_date
-    ).all()
+    ).all() if 'workout' in regenerate else []
     
     if workouts:
         # Check for workout frequency
@@ -1319,3 +1420,17 @@ def create_insights_for_user(user_id, start_date=None, end_date=None):
     
     db.session.commit()
     return insights
+
+@change_bus.subscriber('insights', domains=('activity', 'sleep', 'food', 'workout'))
+def refresh_insights(user_id, domains, start_date, end_date):
+    """Regenerate the insights of the changed domains when the changed dates fall in the insight window"""
+    # Insights cover the last 30 days; changes outside them cannot affect them
+    window_start = datetime.utcnow() - timedelta(days=30)
+    if end_date < window_start.date() or start_date > datetime.utcnow().date():
+        return
+    
+    # Only refresh insights the user has already generated
+    if not Insight.query.filter_by(user_id=user_id).first():
+        return
+    
+    create_insights_for_user(user_id, domains=domains)
@@ -4,6 +4,9 @@ from flask import Blueprint, request, jsonify, current_app
 from src.models.user import db, User
 from src.models.data_source import DataSource, UserDataSource, SyncLog
 from src.models.food import FoodEntry, FoodItem
+from src.services.ingestion import SourceAdapter, run_sync, ingest_records, get_data_source, get_or_create_user_data_source
+from src.services.job_queue import job_queue
+from src.services.leases import SyncInProgress, sync_lease
 from datetime import datetime, timedelta
 
 healthifyme_bp = Blueprint('healthifyme', __name__)
@@ -22,17 +25,7 @@ def connect_healthifyme():
         return jsonify({"error": "User ID, username, and password are required"}), 400
     
     # Get or create HealthifyMe data source
-    healthifyme_source = DataSource.query.filter_by(name="HealthifyMe").first()
-    if not healthifyme_source:
-        healthifyme_source = DataSource(
-            name="HealthifyMe",
-            source_type="food",
-            api_endpoint=HEALTHIFYME_API_BASE,
-            requires_oauth=False,
-            description="Food tracking, nutrition, and diet planning"
-        )
-        db.session.add(healthifyme_source)
-        db.session.commit()
+    healthifyme_source = get_data_source(HealthifyMeAdapter, create=True)
     
     # Note: In a real implementation, we would authenticate with HealthifyMe API here
     # Since we don't have actual API access, we'll simulate a successful connection
@@ -85,49 +78,27 @@ def sync_healthifyme_data():
     if not user_data_source:
         return jsonify({"error": "User not connected to HealthifyMe"}), 404
     
-    # Create sync log
-    sync_log = SyncLog(
-        user_id=user_id,
-        data_source_id=healthifyme_source.id,
-        sync_start_time=datetime.utcnow(),
-        status="pending"
+    job = job_queue.enqueue('healthifyme_sync', user_id, healthifyme_source.id)
+    return jsonify({
+        "success": True, 
+        "message": "HealthifyMe sync queued",
+        "sync_log_id": job.sync_log_id,
+        "job_id": job.id
+    }), 202
+
+@job_queue.handler('healthifyme_sync', source_type='food')
+def sync_healthifyme_user(user_data_source, sync_log=None, payload=None):
+    """Fetch and store a user's HealthifyMe food entries"""
+    # In a real implementation, we would fetch data from HealthifyMe API here
+    # Since we don't have actual API access, we'll simulate data
+    return run_sync(
+        HealthifyMeAdapter(),
+        user_data_source.user_id,
+        user_data_source.data_source_id,
+        records=simulate_healthifyme_food_data(),
+        user_data_source=user_data_source,
+        sync_log=sync_log
     )
-    db.session.add(sync_log)
-    db.session.commit()
-    
-    try:
-        # In a real implementation, we would fetch data from HealthifyMe API here
-        # Since we don't have actual API access, we'll simulate data
-        
-        # Get food entries from HealthifyMe (simulated)
-        food_entries = simulate_healthifyme_food_data()
-        
-        # Process and save food entries
-        items_synced = process_healthifyme_food_data(user_id, healthifyme_source.id, food_entries)
-        
-        # Update sync log
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "success"
-        sync_log.items_synced = items_synced
-        
-        # Update last sync time
-        user_data_source.last_sync_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        return jsonify({
-            "success": True, 
-            "message": f"Successfully synced {items_synced} food entries from HealthifyMe"
-        })
-        
-    except Exception as e:
-        # Update sync log with error
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "failed"
-        sync_log.error_message = str(e)
-        db.session.commit()
-        
-        return jsonify({"error": f"Failed to sync HealthifyMe data: {str(e)}"}), 500
 
 @healthifyme_bp.route('/upload', methods=['POST'])
 def upload_healthifyme_export():
@@ -148,63 +119,30 @@ def upload_healthifyme_export():
     if not healthifyme_source:
         return jsonify({"error": "HealthifyMe data source not configured"}), 404
     
-    # Create sync log
-    sync_log = SyncLog(
-        user_id=user_id,
-        data_source_id=healthifyme_source.id,
-        sync_start_time=datetime.utcnow(),
-        status="pending"
-    )
-    db.session.add(sync_log)
-    db.session.commit()
-    
+    # Process the uploaded file
+    # In a real implementation, we would parse the CSV/JSON export file
+    # For demo purposes, we'll simulate data
+    user_data_source = get_or_create_user_data_source(user_id, healthifyme_source.id)
     try:
-        # Process the uploaded file
-        # In a real implementation, we would parse the CSV/JSON export file
-        # For demo purposes, we'll simulate data
-        
-        # Get food entries from HealthifyMe (simulated)
-        food_entries = simulate_healthifyme_food_data()
-        
-        # Process and save food entries
-        items_synced = process_healthifyme_food_data(user_id, healthifyme_source.id, food_entries)
-        
-        # Update sync log
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "success"
-        sync_log.items_synced = items_synced
-        
-        # Update or create user data source connection
-        user_data_source = UserDataSource.query.filter_by(
-            user_id=user_id, 
-            data_source_id=healthifyme_source.id
-        ).first()
-        
-        if not user_data_source:
-            user_data_source = UserDataSource(
-                user_id=user_id,
-                data_source_id=healthifyme_source.id,
-                is_active=True
+        # Don't write alongside a queued or scheduled sync of the connection
+        with sync_lease(user_id, healthifyme_source.id):
+            sync_log, stats = run_sync(
+                HealthifyMeAdapter(),
+                user_id,
+                healthifyme_source.id,
+                records=simulate_healthifyme_food_data(),
+                user_data_source=user_data_source
             )
-            db.session.add(user_data_source)
-        
-        user_data_source.last_sync_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        return jsonify({
-            "success": True, 
-            "message": f"Successfully processed {items_synced} food entries from HealthifyMe export"
-        })
-        
+    except SyncInProgress:
+        return jsonify({"error": "A HealthifyMe sync is already running for this user; upload again once it finishes"}), 409
     except Exception as e:
-        # Update sync log with error
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "failed"
-        sync_log.error_message = str(e)
-        db.session.commit()
-        
         return jsonify({"error": f"Failed to process HealthifyMe export: {str(e)}"}), 500
+    
+    return jsonify({
+        "success": True, 
+        "message": f"Successfully processed {stats['created']} food entries from HealthifyMe export",
+        "sync_log_id": sync_log.id
+    })
 
 def simulate_healthifyme_food_data():
     """Simulate food data from HealthifyMe for demo purposes"""
@@ -378,78 +316,42 @@ def simulate_healthifyme_food_data():
 
 def process_healthifyme_food_data(user_id, source_id, food_entries):
     """Process and save HealthifyMe food data to database"""
-    count = 0
-    
-    for entry_data in food_entries:
-        # Check if food entry already exists
-        existing = FoodEntry.query.filter_by(
-            user_id=user_id,
-            source_id=source_id,
-            external_id=entry_data.get('id')
-        ).first()
-        
-        if existing:
-            # Update existing food entry
-            existing.meal_type = entry_data.get('meal_type')
-            existing.consumed_at = entry_data.get('consumed_at')
-            existing.total_calories = entry_data.get('total_calories')
-            existing.total_carbs = entry_data.get('total_carbs')
-            existing.total_protein = entry_data.get('total_protein')
-            existing.total_fat = entry_data.get('total_fat')
-            existing.total_fiber = entry_data.get('total_fiber')
-            existing.updated_at = datetime.utcnow()
-            
-            # Remove existing food items
-            for item in existing.food_items:
-                db.session.delete(item)
-            
-            # Add new food items
-            for item_data in entry_data.get('items', []):
-                food_item = FoodItem(
-                    food_entry_id=existing.id,
-                    name=item_data.get('name'),
-                    quantity=item_data.get('quantity'),
-                    unit=item_data.get('unit'),
-                    calories=item_data.get('calories'),
-                    carbs=item_data.get('carbs'),
-                    protein=item_data.get('protein'),
-                    fat=item_data.get('fat'),
-                    fiber=item_data.get('fiber')
-                )
-                db.session.add(food_item)
-        else:
-            # Create new food entry
-            food_entry = FoodEntry(
-                user_id=user_id,
-                source_id=source_id,
-                external_id=entry_data.get('id'),
-                meal_type=entry_data.get('meal_type'),
-                consumed_at=entry_data.get('consumed_at'),
-                total_calories=entry_data.get('total_calories'),
-                total_carbs=entry_data.get('total_carbs'),
-                total_protein=entry_data.get('total_protein'),
-                total_fat=entry_data.get('total_fat'),
-                total_fiber=entry_data.get('total_fiber')
-            )
-            db.session.add(food_entry)
-            db.session.flush()  # Get the ID for the new food entry
-            
-            # Add food items
-            for item_data in entry_data.get('items', []):
-                food_item = FoodItem(
-                    food_entry_id=food_entry.id,
-                    name=item_data.get('name'),
-                    quantity=item_data.get('quantity'),
-                    unit=item_data.get('unit'),
-                    calories=item_data.get('calories'),
-                    carbs=item_data.get('carbs'),
-                    protein=item_data.get('protein'),
-                    fat=item_data.get('fat'),
-                    fiber=item_data.get('fiber')
-                )
-                db.session.add(food_item)
-            
-            count += 1
+    stats = ingest_records(HealthifyMeAdapter(), user_id, source_id, food_entries)
+    return stats['created']
+
+class HealthifyMeAdapter(SourceAdapter):
+    """Ingestion adapter for HealthifyMe food entries and their items"""
+    source_name = "HealthifyMe"
+    source_type = "food"
+    description = "Food tracking, nutrition, and diet planning"
+    api_endpoint = HEALTHIFYME_API_BASE
+    model = FoodEntry
+    date_column = 'consumed_at'
+    child_model = FoodItem
+    child_parent_column = 'food_entry_id'
+    child_key_columns = ('name',)
     
-    db.session.commit()
-    return count
+    def normalize(self, entry_data):
+        return {
+            'external_id': entry_data.get('id'),
+            'meal_type': entry_data.get('meal_type'),
+            'consumed_at': entry_data.get('consumed_at'),
+            'total_calories': entry_data.get('total_calories'),
+            'total_carbs': entry_data.get('total_carbs'),
+            'total_protein': entry_data.get('total_protein'),
+            'total_fat': entry_data.get('total_fat'),
+            'total_fiber': entry_data.get('total_fiber'),
+            'children': [
+                {
+                    'name': item_data.get('name'),
+                    'quantity': item_data.get('quantity'),
+                    'unit': item_data.get('unit'),
+                    'calories': item_data.get('calories'),
+                    'carbs': item_data.get('carbs'),
+                    'protein': item_data.get('protein'),
+                    'fat': item_data.get('fat'),
+                    'fiber': item_data.get('fiber')
+                }
+                for item_data in entry_data.get('items', [])
+            ]
+        }
@@ -3,6 +3,10 @@ from flask import Blueprint, request, jsonify, current_app
 from src.models.user import db, User
 from src.models.data_source import DataSource, UserDataSource, SyncLog
 from src.models.workout import Workout, Exercise, WorkoutExercise
+from src.services.ingestion import SourceAdapter, run_sync, ingest_records, get_data_source, get_or_create_user_data_source
+from src.services.job_queue import job_queue
+from src.services.leases import SyncInProgress, sync_lease
+from src.services.personal_records import record_sessions, get_personal_records
 from datetime import datetime, timedelta
 import json
 
@@ -23,16 +27,7 @@ def connect_hevy():
         return jsonify({"error": "User ID, username, and password are required"}), 400
     
     # Get or create Hevy data source
-    hevy_source = DataSource.query.filter_by(name="Hevy").first()
-    if not hevy_source:
-        hevy_source = DataSource(
-            name="Hevy",
-            source_type="workout",
-            requires_oauth=False,
-            description="Workout tracking, strength training, and exercise logs"
-        )
-        db.session.add(hevy_source)
-        db.session.commit()
+    hevy_source = get_data_source(HevyAdapter, create=True)
     
     # Note: In a real implementation, we would authenticate with Hevy API here
     # Since we don't have actual API access, we'll simulate a successful connection
@@ -86,77 +81,38 @@ def upload_hevy_export():
         return jsonify({"error": "User not found"}), 404
     
     # Get or create Hevy data source
-    hevy_source = DataSource.query.filter_by(name="Hevy").first()
-    if not hevy_source:
-        hevy_source = DataSource(
-            name="Hevy",
-            source_type="workout",
-            requires_oauth=False,
-            description="Workout tracking, strength training, and exercise logs"
-        )
-        db.session.add(hevy_source)
-        db.session.commit()
+    hevy_source = get_data_source(HevyAdapter, create=True)
     
-    # Create sync log
-    sync_log = SyncLog(
-        user_id=user_id,
-        data_source_id=hevy_source.id,
-        sync_start_time=datetime.utcnow(),
-        status="pending"
-    )
-    db.session.add(sync_log)
-    db.session.commit()
+    # Save the file
+    filename = f"{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}"
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+    file.save(file_path)
     
+    # Process the file
+    # In a real implementation, we would parse the JSON/CSV file
+    # For demo purposes, we'll simulate workout data
+    workouts, exercises = simulate_hevy_workout_data(user_id)
+    user_data_source = get_or_create_user_data_source(user_id, hevy_source.id)
     try:
-        # Save the file
-        filename = f"{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(file_path)
-        
-        # Process the file
-        # In a real implementation, we would parse the JSON/CSV file
-        # For demo purposes, we'll simulate workout data
-        workouts = simulate_hevy_workout_data(user_id)
-        
-        # Process and save workouts
-        items_synced = process_hevy_workout_data(user_id, hevy_source.id, workouts)
-        
-        # Update sync log
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "success"
-        sync_log.items_synced = items_synced
-        
-        # Update or create user data source connection
-        user_data_source = UserDataSource.query.filter_by(
-            user_id=user_id, 
-            data_source_id=hevy_source.id
-        ).first()
-        
-        if not user_data_source:
-            user_data_source = UserDataSource(
-                user_id=user_id,
-                data_source_id=hevy_source.id,
-                is_active=True
+        # Don't write alongside a queued or scheduled sync of the connection
+        with sync_lease(user_id, hevy_source.id):
+            sync_log, stats = run_sync(
+                HevyAdapter(exercises),
+                user_id,
+                hevy_source.id,
+                records=workouts,
+                user_data_source=user_data_source
             )
-            db.session.add(user_data_source)
-        
-        user_data_source.last_sync_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        return jsonify({
-            "success": True, 
-            "message": f"Successfully processed {items_synced} workouts from Hevy export"
-        })
-        
+    except SyncInProgress:
+        return jsonify({"error": "A Hevy sync is already running for this user; upload again once it finishes"}), 409
     except Exception as e:
-        # Update sync log with error
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "failed"
-        sync_log.error_message = str(e)
-        db.session.commit()
-        
         return jsonify({"error": f"Failed to process Hevy export: {str(e)}"}), 500
+    
+    return jsonify({
+        "success": True, 
+        "message": f"Successfully processed {stats['created']} workouts from Hevy export",
+        "sync_log_id": sync_log.id
+    })
 
 @hevy_bp.route('/sync', methods=['POST'])
 def sync_hevy_data():
@@ -179,47 +135,40 @@ def sync_hevy_data():
     if not user_data_source:
         return jsonify({"error": "User not connected to Hevy"}), 404
     
-    # Create sync log
-    sync_log = SyncLog(
-        user_id=user_id,
-        data_source_id=hevy_source.id,
-        sync_start_time=datetime.utcnow(),
-        status="pending"
-    )
-    db.session.add(sync_log)
-    db.session.commit()
+    job = job_queue.enqueue('hevy_sync', user_id, hevy_source.id)
+    return jsonify({
+        "success": True, 
+        "message": "Hevy sync queued",
+        "sync_log_id": job.sync_log_id,
+        "job_id": job.id
+    }), 202
+
+@hevy_bp.route('/personal-records', methods=['GET'])
+def get_hevy_personal_records():
+    """Get a user's personal record for every exercise"""
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({"error": "User ID is required"}), 400
     
-    try:
-        # In a real implementation, we would fetch data from Hevy API
-        # For demo purposes, we'll simulate workout data
-        workouts = simulate_hevy_workout_data(user_id)
-        
-        # Process and save workouts
-        items_synced = process_hevy_workout_data(user_id, hevy_source.id, workouts)
-        
-        # Update sync log
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "success"
-        sync_log.items_synced = items_synced
-        
-        # Update last sync time
-        user_data_source.last_sync_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        return jsonify({
-            "success": True, 
-            "message": f"Successfully synced {items_synced} workouts from Hevy"
-        })
-        
-    except Exception as e:
-        # Update sync log with error
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "failed"
-        sync_log.error_message = str(e)
-        db.session.commit()
-        
-        return jsonify({"error": f"Failed to sync Hevy data: {str(e)}"}), 500
+    records = get_personal_records(user_id)
+    return jsonify({
+        "personal_records": [record.to_dict() for record in records]
+    })
+
+@job_queue.handler('hevy_sync', source_type='workout')
+def sync_hevy_user(user_data_source, sync_log=None, payload=None):
+    """Fetch and store a user's Hevy workouts"""
+    # In a real implementation, we would fetch data from Hevy API
+    # For demo purposes, we'll simulate workout data
+    workouts, exercises = simulate_hevy_workout_data(user_data_source.user_id)
+    return run_sync(
+        HevyAdapter(exercises),
+        user_data_source.user_id,
+        user_data_source.data_source_id,
+        records=workouts,
+        user_data_source=user_data_source,
+        sync_log=sync_log
+    )
 
 def simulate_hevy_workout_data(user_id):
     """Simulate workout data from Hevy for demo purposes"""
@@ -331,93 +280,87 @@ def simulate_hevy_workout_data(user_id):
 def process_hevy_workout_data(user_id, source_id, workout_data):
     """Process and save Hevy workout data to database"""
     workouts, exercise_data = workout_data
-    count = 0
+    stats = ingest_records(HevyAdapter(exercise_data), user_id, source_id, workouts)
+    return stats['created']
+
+class HevyAdapter(SourceAdapter):
+    """Ingestion adapter for Hevy workouts and their exercises"""
+    source_name = "Hevy"
+    source_type = "workout"
+    description = "Workout tracking, strength training, and exercise logs"
+    model = Workout
+    date_column = 'workout_date'
+    child_model = WorkoutExercise
+    child_parent_column = 'workout_id'
+    child_key_columns = ('exercise_id',)
     
-    # First, ensure all exercises exist in the database
-    for exercise_info in exercise_data:
-        existing_exercise = Exercise.query.filter_by(name=exercise_info["name"]).first()
+    def __init__(self, exercise_data=None):
+        # Hevy exercise ids are only meaningful within one export, so exercises are matched by name
+        self.exercise_data = exercise_data or []
+        self.exercise_names = {e["id"]: e["name"] for e in self.exercise_data}
+        self.exercise_ids = {}
+    
+    def begin(self, user_id, source_id):
+        # Ensure all exercises exist in the database with one lookup and one bulk insert
+        names = [e["name"] for e in self.exercise_data]
+        if not names:
+            return
         
-        if not existing_exercise:
-            new_exercise = Exercise(
-                name=exercise_info["name"],
-                muscle_group=exercise_info["muscle_group"],
-                exercise_type=exercise_info["exercise_type"]
-            )
-            db.session.add(new_exercise)
+        self.exercise_ids = dict(db.session.query(Exercise.name, Exercise.id).filter(Exercise.name.in_(names)).all())
+        missing = [
+            {
+                'name': e["name"],
+                'muscle_group': e["muscle_group"],
+                'exercise_type': e["exercise_type"]
+            }
+            for e in self.exercise_data if e["name"] not in self.exercise_ids
+        ]
+        if missing:
+            db.session.bulk_insert_mappings(Exercise, missing)
+            self.exercise_ids = dict(db.session.query(Exercise.name, Exercise.id).filter(Exercise.name.in_(names)).all())
     
-    db.session.commit()
+    def normalize(self, workout_info):
+        return {
+            'external_id': workout_info["id"],
+            'workout_name': workout_info["workout_name"],
+            'workout_date': workout_info["workout_date"],
+            'duration': workout_info["duration"],
+            'calories_burned': workout_info["calories_burned"],
+            'notes': workout_info["notes"],
+            'children': [
+                {
+                    'exercise_name': self.exercise_names.get(exercise_info["exercise_id"]),
+                    'sets': exercise_info["sets"],
+                    'reps': exercise_info["reps"],
+                    'weight': exercise_info["weight"],
+                    'duration': exercise_info["duration"],
+                    'distance': exercise_info["distance"],
+                    'notes': exercise_info["notes"]
+                }
+                for exercise_info in workout_info["exercises"]
+            ]
+        }
     
-    # Now process workouts
-    for workout_info in workouts:
-        # Check if workout already exists
-        existing_workout = Workout.query.filter_by(
-            user_id=user_id,
-            source_id=source_id,
-            external_id=workout_info["id"]
-        ).first()
-        
-        if existing_workout:
-            # Update existing workout
-            existing_workout.workout_name = workout_info["workout_name"]
-            existing_workout.workout_date = workout_info["workout_date"]
-            existing_workout.duration = workout_info["duration"]
-            existing_workout.calories_burned = workout_info["calories_burned"]
-            existing_workout.notes = workout_info["notes"]
-            existing_workout.updated_at = datetime.utcnow()
-            
-            # Remove existing workout exercises
-            for exercise in existing_workout.exercises:
-                db.session.delete(exercise)
-            
-            # Add new workout exercises
-            for exercise_info in workout_info["exercises"]:
-                exercise = Exercise.query.filter_by(name=next(e["name"] for e in exercise_data if e["id"] == exercise_info["exercise_id"])).first()
-                
-                if exercise:
-                    workout_exercise = WorkoutExercise(
-                        workout_id=existing_workout.id,
-                        exercise_id=exercise.id,
-                        sets=exercise_info["sets"],
-                        reps=exercise_info["reps"],
-                        weight=exercise_info["weight"],
-                        duration=exercise_info["duration"],
-                        distance=exercise_info["distance"],
-                        notes=exercise_info["notes"]
-                    )
-                    db.session.add(workout_exercise)
-        else:
-            # Create new workout
-            new_workout = Workout(
-                user_id=user_id,
-                source_id=source_id,
-                external_id=workout_info["id"],
-                workout_name=workout_info["workout_name"],
-                workout_date=workout_info["workout_date"],
-                duration=workout_info["duration"],
-                calories_burned=workout_info["calories_burned"],
-                notes=workout_info["notes"]
-            )
-            db.session.add(new_workout)
-            db.session.flush()  # Get the ID for the new workout
-            
-            # Add workout exercises
-            for exercise_info in workout_info["exercises"]:
-                exercise = Exercise.query.filter_by(name=next(e["name"] for e in exercise_data if e["id"] == exercise_info["exercise_id"])).first()
-                
-                if exercise:
-                    workout_exercise = WorkoutExercise(
-                        workout_id=new_workout.id,
-                        exercise_id=exercise.id,
-                        sets=exercise_info["sets"],
-                        reps=exercise_info["reps"],
-                        weight=exercise_info["weight"],
-                        duration=exercise_info["duration"],
-                        distance=exercise_info["distance"],
-                        notes=exercise_info["notes"]
-                    )
-                    db.session.add(workout_exercise)
-            
-            count += 1
+    def resolve_children(self, children):
+        resolved = []
+        for child in children:
+            exercise_id = self.exercise_ids.get(child.pop('exercise_name'))
+            if exercise_id:
+                child['exercise_id'] = exercise_id
+                resolved.append(child)
+        return resolved
     
-    db.session.commit()
-    return count
+    def written(self, user_id, source_id, records):
+        # Fold the written workouts into the per-exercise personal records
+        sessions = []
+        for record in records:
+            sets_by_exercise = {}
+            for child in record.get('children') or []:
+                exercise_id = self.exercise_ids.get(child['exercise_name'])
+                if exercise_id:
+                    sets_by_exercise.setdefault(exercise_id, []).append((child['sets'], child['reps'], child['weight']))
+            sessions.extend(
+                (exercise_id, record['workout_date'], sets)
+                for exercise_id, sets in sets_by_exercise.items()
+            )
+        record_sessions(user_id, sessions)
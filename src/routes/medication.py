@@ -3,6 +3,10 @@ from flask import Blueprint, request, jsonify, current_app
 from src.models.user import db, User
 from src.models.data_source import DataSource, UserDataSource, SyncLog
 from src.models.medication import Medication, UserMedication, MedicationLog
+from src.services.events import publish_change
+from src.services.medication_logs import get_medication_log_entries
+from src.services.adherence import medication_adherence, invalidate_adherence
+from src.services.response_cache import bump_data_version
 from datetime import datetime, timedelta
 import json
 
@@ -128,6 +132,7 @@ def add_user_medication():
     )
     
     db.session.add(user_medication)
+    bump_data_version(user_id)
     db.session.commit()
     
     return jsonify({
@@ -172,6 +177,11 @@ def update_user_medication(id):
     if 'notes' in request.json:
         user_medication.notes = request.json.get('notes')
     
+    # A new schedule changes every cached adherence day
+    if any(field in request.json for field in ('frequency', 'start_date', 'end_date')):
+        invalidate_adherence(user_medication)
+    
+    bump_data_version(user_medication.user_id)
     db.session.commit()
     
     return jsonify({
@@ -187,6 +197,8 @@ def delete_user_medication(id):
     if not user_medication:
         return jsonify({"error": "User medication not found"}), 404
     
+    invalidate_adherence(user_medication)
+    bump_data_version(user_medication.user_id)
     db.session.delete(user_medication)
     db.session.commit()
     
@@ -223,28 +235,28 @@ def get_medication_logs():
     else:
         end_date = datetime.utcnow().date()
     
-    # Get user medications
-    user_medications = UserMedication.query.filter_by(user_id=user_id).all()
-    user_medication_ids = [um.id for um in user_medications]
-    
-    # Get logs for these medications
-    logs = MedicationLog.query.filter(
-        MedicationLog.user_medication_id.in_(user_medication_ids),
-        MedicationLog.taken_at >= datetime.combine(start_date, datetime.min.time()),
-        MedicationLog.taken_at <= datetime.combine(end_date, datetime.max.time())
-    ).order_by(MedicationLog.taken_at.desc()).all()
-    
-    # Prepare response with medication details
-    result = []
-    for log in logs:
-        user_medication = next((um for um in user_medications if um.id == log.user_medication_id), None)
-        if user_medication:
-            medication = Medication.query.get(user_medication.medication_id)
-            log_dict = log.to_dict()
-            log_dict['medication_name'] = medication.name if medication else 'Unknown'
-            log_dict['custom_name'] = user_medication.custom_name
-            log_dict['standard_dosage'] = user_medication.dosage
-            result.append(log_dict)
+    # Get logs with their medication details in one joined query
+    logs = get_medication_log_entries(
+        user_id,
+        datetime.combine(start_date, datetime.min.time()),
+        datetime.combine(end_date, datetime.max.time())
+    )
+    
+    result = [
+        {
+            'id': log['id'],
+            'user_medication_id': log['user_medication_id'],
+            'taken_at': log['taken_at'],
+            'dosage_taken': log['dosage_taken'],
+            'notes': log['notes'],
+            'created_at': log['created_at'],
+            'updated_at': log['updated_at'],
+            'medication_name': log['medication_name'],
+            'custom_name': log['custom_name'],
+            'standard_dosage': log['dosage']
+        }
+        for log in logs
+    ]
     
     return jsonify({
         "success": True,
@@ -288,7 +300,10 @@ def add_medication_log():
     )
     
     db.session.add(medication_log)
+    invalidate_adherence(user_medication, taken_at.date())
+    bump_data_version(user_medication.user_id)
     db.session.commit()
+    publish_change(user_medication.user_id, 'medication', taken_at)
     
     return jsonify({
         "success": True,
@@ -303,14 +318,58 @@ def delete_medication_log(id):
     if not medication_log:
         return jsonify({"error": "Medication log not found"}), 404
     
+    user_id = medication_log.user_medication.user_id
+    taken_at = medication_log.taken_at
+    invalidate_adherence(medication_log.user_medication, taken_at.date())
+    bump_data_version(user_id)
     db.session.delete(medication_log)
     db.session.commit()
+    publish_change(user_id, 'medication', taken_at)
     
     return jsonify({
         "success": True,
         "message": "Medication log deleted"
     })
 
+@medication_bp.route('/adherence', methods=['GET'])
+def get_medication_adherence():
+    """Get scheduled-dose adherence for a user's medications"""
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({"error": "User ID is required"}), 400
+    
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    
+    # Parse dates
+    try:
+        start_date = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else (datetime.utcnow() - timedelta(days=30)).date()
+        end_date = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else datetime.utcnow().date()
+    except ValueError:
+        return jsonify({"error": "Invalid date format. Use YYYY-MM-DD"}), 400
+    
+    adherence = medication_adherence(user_id, start_date, end_date)
+    
+    return jsonify({
+        "success": True,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "expected_doses": adherence['expected'],
+        "taken_doses": adherence['taken'],
+        "extra_doses": adherence['extra'],
+        "adherence_rate": adherence['rate'],
+        "medications": [
+            {
+                "user_medication_id": user_medication_id,
+                "expected_doses": result['expected'],
+                "taken_doses": result['taken'],
+                "extra_doses": result['extra'],
+                "adherence_rate": result['rate']
+            }
+            for user_medication_id, result in adherence['medications'].items()
+        ]
+    })
+
 @medication_bp.route('/initialize', methods=['POST'])
 def initialize_medication_repository():
     """Initialize the medication repository with common medications"""
@@ -1,9 +1,13 @@
 import os
+import calendar
 import requests
 from flask import Blueprint, request, jsonify, current_app, redirect, url_for, render_template
 from src.models.user import db, User
 from src.models.data_source import DataSource, UserDataSource, SyncLog
 from src.models.activity import Activity
+from src.services.ingestion import SourceAdapter, run_sync, ingest_records, get_data_source
+from src.services.job_queue import job_queue
+from src.services.token_manager import token_manager
 from datetime import datetime, timedelta
 import logging
 import json
@@ -31,18 +35,7 @@ def strava_auth():
         return jsonify({"error": "User ID is required"}), 400
     
     # Get or create Strava data source
-    strava_source = DataSource.query.filter_by(name="Strava").first()
-    if not strava_source:
-        strava_source = DataSource(
-            name="Strava",
-            source_type="activity",
-            api_endpoint=STRAVA_API_BASE,
-            requires_oauth=True,
-            oauth_url=STRAVA_AUTH_URL,
-            description="Activity tracking for running, cycling, and more"
-        )
-        db.session.add(strava_source)
-        db.session.commit()
+    strava_source = get_data_source(StravaAdapter, create=True)
     
     # Generate authorization URL with exact redirect URI
     # Use absolute URL to ensure it matches exactly what's registered in Strava
@@ -146,6 +139,7 @@ def strava_callback():
         user_data_source.is_active = True
         
         db.session.commit()
+        token_manager.invalidate(user_data_source.id)
         logger.info(f"Successfully stored Strava tokens for user {user.id}")
         
         # Redirect to frontend with success message
@@ -181,63 +175,47 @@ def sync_strava_data():
         logger.error(f"User {user_id} not connected to Strava")
         return jsonify({"error": "User not connected to Strava"}), 404
     
-    # Check if token is expired and refresh if needed
-    if user_data_source.token_expires_at and user_data_source.token_expires_at < datetime.utcnow():
-        logger.info(f"Refreshing expired Strava token for user {user_id}")
-        refresh_result = refresh_strava_token(user_data_source)
-        if not refresh_result['success']:
-            logger.error(f"Failed to refresh Strava token: {refresh_result['error']}")
-            return jsonify({"error": f"Failed to refresh Strava token: {refresh_result['error']}"}), 401
+    # Token refresh, fetching and storing happen on a sync worker
+    job = job_queue.enqueue('strava_sync', user_id, strava_source.id)
+    return jsonify({
+        "success": True, 
+        "message": "Strava sync queued",
+        "sync_log_id": job.sync_log_id,
+        "job_id": job.id
+    }), 202
+
+@job_queue.handler('strava_sync', source_type='activity')
+def sync_strava_user(user_data_source, sync_log=None, payload=None):
+    """Fetch and store a user's Strava activities"""
+    user_id = user_data_source.user_id
     
-    # Create sync log
-    sync_log = SyncLog(
-        user_id=user_id,
-        data_source_id=strava_source.id,
-        sync_start_time=datetime.utcnow(),
-        status="pending"
-    )
-    db.session.add(sync_log)
-    db.session.commit()
+    # Cached token, normally already refreshed ahead of expiry in the background
+    access_token = token_manager.get_access_token(user_data_source)
     
+    # Fetch and store activities through the ingestion pipeline
+    logger.info(f"Fetching Strava activities for user {user_id}")
     try:
-        # Get activities from Strava
-        logger.info(f"Fetching Strava activities for user {user_id}")
-        activities_result = fetch_strava_activities(user_data_source.access_token)
-        
-        if not activities_result['success']:
-            raise Exception(activities_result['error'])
-            
-        activities = activities_result['data']
-        
-        # Process and save activities
-        logger.info(f"Processing {len(activities)} Strava activities for user {user_id}")
-        items_synced = process_strava_activities(user_id, strava_source.id, activities)
-        
-        # Update sync log
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "success"
-        sync_log.items_synced = items_synced
-        
-        # Update last sync time
-        user_data_source.last_sync_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        logger.info(f"Successfully synced {items_synced} activities from Strava for user {user_id}")
-        return jsonify({
-            "success": True, 
-            "message": f"Successfully synced {items_synced} activities from Strava"
-        })
-        
-    except Exception as e:
-        # Update sync log with error
-        logger.error(f"Failed to sync Strava data for user {user_id}: {str(e)}")
-        sync_log.sync_end_time = datetime.utcnow()
-        sync_log.status = "failed"
-        sync_log.error_message = str(e)
-        db.session.commit()
-        
-        return jsonify({"error": f"Failed to sync Strava data: {str(e)}"}), 500
+        sync_log, stats = run_sync(
+            StravaAdapter(access_token),
+            user_id,
+            user_data_source.data_source_id,
+            user_data_source=user_data_source,
+            sync_log=sync_log
+        )
+    except StravaUnauthorized:
+        # The token was revoked, e.g. by a reauthorization; retry once with the stored or a refreshed one
+        logger.warning(f"Strava rejected the access token for user {user_id}, retrying with a new one")
+        token_manager.invalidate(user_data_source.id)
+        access_token = token_manager.refresh(user_data_source, rejected=access_token)
+        sync_log, stats = run_sync(
+            StravaAdapter(access_token),
+            user_id,
+            user_data_source.data_source_id,
+            user_data_source=user_data_source,
+            sync_log=sync_log
+        )
+    logger.info(f"Successfully synced {stats['created']} activities from Strava for user {user_id}")
+    return sync_log, stats
 
 @strava_bp.route('/activities', methods=['GET'])
 def get_activities():
@@ -324,6 +302,7 @@ def get_status():
         "activity_count": activity_count
     })
 
+@token_manager.refresher('Strava')
 def refresh_strava_token(user_data_source):
     """Refresh Strava access token"""
     try:
@@ -401,7 +380,7 @@ def fetch_strava_activities(access_token, after=None):
         if response.status_code != 200:
             error_message = f"Failed to fetch activities: {response.text}"
             logger.error(error_message)
-            return {'success': False, 'error': error_message}
+            return {'success': False, 'error': error_message, 'status_code': response.status_code}
         
         # Parse response
         try:
@@ -420,58 +399,67 @@ def fetch_strava_activities(access_token, after=None):
 
 def process_strava_activities(user_id, source_id, activities):
     """Process and save Strava activities to database"""
-    count = 0
+    stats = ingest_records(StravaAdapter(), user_id, source_id, activities)
+    return stats['created']
+
+class StravaUnauthorized(Exception):
+    """Strava rejected the access token"""
+    pass
+
+class StravaAdapter(SourceAdapter):
+    """Ingestion adapter for Strava activities"""
+    source_name = "Strava"
+    source_type = "activity"
+    description = "Activity tracking for running, cycling, and more"
+    api_endpoint = STRAVA_API_BASE
+    requires_oauth = True
+    oauth_url = STRAVA_AUTH_URL
+    model = Activity
+    date_column = 'start_time'
     
-    for activity_data in activities:
-        try:
-            # Check if activity already exists
-            existing = Activity.query.filter_by(
-                user_id=user_id,
-                source_id=source_id,
-                external_id=str(activity_data.get('id'))
-            ).first()
-            
-            if existing:
-                # Update existing activity
-                existing.activity_type = activity_data.get('type', '').lower()
-                existing.start_time = datetime.strptime(activity_data.get('start_date'), "%Y-%m-%dT%H:%M:%SZ")
-                existing.duration = activity_data.get('elapsed_time')
-                existing.distance = activity_data.get('distance')
-                existing.calories = activity_data.get('calories')
-                existing.average_heart_rate = activity_data.get('average_heartrate')
-                existing.max_heart_rate = activity_data.get('max_heartrate')
-                existing.elevation_gain = activity_data.get('total_elevation_gain')
-                existing.title = activity_data.get('name')
-                existing.description = activity_data.get('description')
-                existing.updated_at = datetime.utcnow()
-            else:
-                # Create new activity
-                activity = Activity(
-                    user_id=user_id,
-                    source_id=source_id,
-                    external_id=str(activity_data.get('id')),
-                    activity_type=activity_data.get('type', '').lower(),
-                    start_time=datetime.strptime(activity_data.get('start_date'), "%Y-%m-%dT%H:%M:%SZ"),
-                    duration=activity_data.get('elapsed_time'),
-                    distance=activity_data.get('distance'),
-                    calories=activity_data.get('calories'),
-                    average_heart_rate=activity_data.get('average_heartrate'),
-                    max_heart_rate=activity_data.get('max_heartrate'),
-                    elevation_gain=activity_data.get('total_elevation_gain'),
-                    title=activity_data.get('name'),
-                    description=activity_data.get('description')
-                )
-                
-                # Add end time if available
-                if activity.start_time and activity.duration:
-                    activity.end_time = activity.start_time + timedelta(seconds=activity.duration)
-                
-                db.session.add(activity)
-                count += 1
-        except Exception as e:
-            logger.error(f"Error processing activity {activity_data.get('id')}: {str(e)}")
-            # Continue processing other activities
-            continue
-    
-    db.session.commit()
-    return count
+    def __init__(self, access_token=None):
+        self.access_token = access_token
+        self.after = None
+        self.resumed_after_id = None
+    
+    def fetch(self):
+        activities_result = fetch_strava_activities(self.access_token, after=self.after)
+        if activities_result.get('status_code') == 401:
+            raise StravaUnauthorized(activities_result['error'])
+        if not activities_result['success']:
+            raise Exception(activities_result['error'])
+        self.pages_fetched += 1
+        for activity in activities_result['data']:
+            # The checkpointed activity is fetched again on resume but was already counted
+            if self.resumed_after_id is not None and str(activity.get('id')) == self.resumed_after_id:
+                continue
+            yield activity
+    
+    def normalize(self, activity_data):
+        start_time = datetime.strptime(activity_data.get('start_date'), "%Y-%m-%dT%H:%M:%SZ")
+        duration = activity_data.get('elapsed_time')
+        return {
+            'external_id': str(activity_data.get('id')),
+            'activity_type': activity_data.get('type', '').lower(),
+            'start_time': start_time,
+            'end_time': start_time + timedelta(seconds=duration) if duration else None,
+            'duration': duration,
+            'distance': activity_data.get('distance'),
+            'calories': activity_data.get('calories'),
+            'average_heart_rate': activity_data.get('average_heartrate'),
+            'max_heart_rate': activity_data.get('max_heartrate'),
+            'elevation_gain': activity_data.get('total_elevation_gain'),
+            'title': activity_data.get('name'),
+            'description': activity_data.get('description')
+        }
+    
+    def checkpoint(self, activity):
+        # Strava returns activities oldest first when filtered with 'after',
+        # so a retry can fetch from the last saved activity on; it is fetched
+        # again in case others share its start time, and dropped by id
+        return {'after': calendar.timegm(activity['start_time'].timetuple()) - 1, 'external_id': activity['external_id']}
+    
+    def resume(self, cursor):
+        self.after = cursor['after']
+        self.resumed_after_id = cursor.get('external_id')
+        return True
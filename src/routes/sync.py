@@ -0,0 +1,218 @@
+import json
+import os
+import queue
+import time
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
+from src.models.user import db
+from src.models.data_source import SyncLog, SyncJob, DeadLetterJob
+from src.services.ingestion import sync_log_event
+from src.services.progress import progress
+from src.services.job_queue import JobInFlight, job_queue
+from src.services.scheduler import sync_scheduler
+from src.services.orchestrator import start_sync_all, get_sync_run
+
+sync_bp = Blueprint('sync', __name__)
+
+# Seconds between checks of the SyncLog for progress stored by a sync
+# running in another process, like the `flask worker` job runner
+EVENT_STREAM_POLL_INTERVAL = float(os.getenv('EVENT_STREAM_POLL_INTERVAL', 1))
+
+# Seconds between keepalive comments on an idle event stream
+EVENT_STREAM_KEEPALIVE = 15
+
+@sync_bp.route('/<int:sync_log_id>', methods=['GET'])
+def get_sync_status(sync_log_id):
+    """Get the status of a queued or finished sync"""
+    sync_log = SyncLog.query.get(sync_log_id)
+    if not sync_log:
+        return jsonify({"error": "Sync not found"}), 404
+    
+    job = SyncJob.query.filter_by(sync_log_id=sync_log_id).order_by(SyncJob.id.desc()).first()
+    
+    return jsonify({
+        "success": True,
+        "status": sync_log.status,
+        "finished": sync_log.status in ("success", "failed"),
+        "sync_log": sync_log.to_dict(),
+        "job": job.to_dict() if job else None
+    })
+
+@sync_bp.route('/<int:sync_log_id>/events', methods=['GET'])
+def stream_sync_events(sync_log_id):
+    """Stream progress events for a sync as Server-Sent Events
+    
+    Events published in this process are sent as they happen. Syncs run by
+    another process store their progress on the SyncLog at every committed
+    batch, which the stream reads every EVENT_STREAM_POLL_INTERVAL seconds.
+    """
+    # Subscribe before reading the SyncLog so no event falls in between
+    events, latest = progress.subscribe(sync_log_id)
+    
+    sync_log = SyncLog.query.get(sync_log_id)
+    if not sync_log:
+        progress.unsubscribe(sync_log_id, events)
+        return jsonify({"error": "Sync not found"}), 404
+    
+    stored = sync_log_event(sync_log)
+    first_event = stored
+    if first_event['phase'] != "complete" and latest:
+        first_event = latest
+    
+    # Don't hold a database connection for the life of the stream
+    db.session.close()
+    
+    def generate(stored=stored, local=latest is not None):
+        try:
+            yield format_sse(first_event)
+            if first_event['phase'] == "complete":
+                return
+            
+            idle_since = time.monotonic()
+            while True:
+                try:
+                    event = events.get(timeout=EVENT_STREAM_POLL_INTERVAL)
+                    local = True
+                except queue.Empty:
+                    # Pick up progress stored by a sync in another process;
+                    # a sync publishing here is only checked for completion
+                    sync_log = SyncLog.query.get(sync_log_id)
+                    event = sync_log_event(sync_log)
+                    db.session.close()
+                    if event == stored or (local and event['phase'] != "complete"):
+                        stored = event
+                        if time.monotonic() - idle_since >= EVENT_STREAM_KEEPALIVE:
+                            idle_since = time.monotonic()
+                            yield ": keepalive\n\n"
+                        continue
+                    stored = event
+                
+                yield format_sse(event)
+                idle_since = time.monotonic()
+                if event['phase'] == "complete":
+                    return
+        finally:
+            progress.unsubscribe(sync_log_id, events)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def format_sse(event):
+    """Format a progress event as an SSE message named after its kind"""
+    name = "complete" if event['phase'] == "complete" else "progress"
+    return f"event: {name}\ndata: {json.dumps(event, default=str)}\n\n"
+
+@sync_bp.route('/jobs', methods=['GET'])
+def get_sync_jobs():
+    """Get a user's recent sync jobs"""
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({"error": "User ID is required"}), 400
+    
+    limit = request.args.get('limit', 20, type=int)
+    jobs = SyncJob.query.filter_by(user_id=user_id).order_by(SyncJob.id.desc()).limit(limit).all()
+    
+    return jsonify({
+        "success": True,
+        "jobs": [job.to_dict() for job in jobs]
+    })
+
+@sync_bp.route('/schedule', methods=['GET'])
+def get_sync_schedule():
+    """Get when each of a user's connections is next due to sync"""
+    user_id = request.args.get('user_id', type=int)
+    if not user_id:
+        return jsonify({"error": "User ID is required"}), 400
+    
+    schedule = sync_scheduler.schedule(user_id=user_id)
+    
+    return jsonify({
+        "success": True,
+        "schedule": [
+            {
+                "data_source_id": data_source.id,
+                "data_source_name": data_source.name,
+                "sync_frequency": user_data_source.sync_frequency,
+                "last_sync_at": user_data_source.last_sync_at,
+                "next_sync_at": due_at,
+                "in_flight": in_flight
+            }
+            for due_at, user_data_source, data_source, job_type, in_flight in schedule
+        ]
+    })
+
+@sync_bp.route('/all', methods=['POST'])
+def sync_all_users():
+    """Start a sync of every active connection in the background"""
+    data = request.json or {}
+    
+    run_id = start_sync_all(
+        current_app._get_current_object(),
+        source_types=data.get('source_types'),
+        user_ids=data.get('user_ids'),
+        limits=data.get('limits')
+    )
+    
+    return jsonify({
+        "success": True,
+        "message": "Sync of all users started",
+        "run_id": run_id
+    }), 202
+
+@sync_bp.route('/all/<run_id>', methods=['GET'])
+def get_sync_all_status(run_id):
+    """Get the status and summary of a sync of all users"""
+    run = get_sync_run(run_id)
+    if not run:
+        return jsonify({"error": "Sync run not found"}), 404
+    
+    return jsonify({
+        "success": True,
+        "run": run
+    })
+
+@sync_bp.route('/admin/dead-letters', methods=['GET'])
+def get_dead_letters():
+    """Get sync jobs that ran out of retries"""
+    query = DeadLetterJob.query
+    
+    user_id = request.args.get('user_id', type=int)
+    if user_id:
+        query = query.filter_by(user_id=user_id)
+    
+    if request.args.get('include_replayed', 'false').lower() != 'true':
+        query = query.filter(DeadLetterJob.replayed_at.is_(None))
+    
+    dead_letters = query.order_by(DeadLetterJob.id.desc()).all()
+    
+    return jsonify({
+        "success": True,
+        "dead_letters": [dead_letter.to_dict() for dead_letter in dead_letters]
+    })
+
+@sync_bp.route('/admin/dead-letters/<int:id>/replay', methods=['POST'])
+def replay_dead_letter(id):
+    """Queue a dead-lettered sync job again from its checkpoint"""
+    dead_letter = DeadLetterJob.query.get(id)
+    if not dead_letter:
+        return jsonify({"error": "Dead-letter job not found"}), 404
+    
+    if dead_letter.replayed_at:
+        return jsonify({"error": "Dead-letter job already replayed"}), 400
+    
+    try:
+        job = job_queue.replay(dead_letter)
+    except JobInFlight as e:
+        return jsonify({
+            "error": "A sync is already queued or running for this connection; replay once it finishes",
+            "job_id": e.job.id
+        }), 409
+    
+    return jsonify({
+        "success": True,
+        "message": "Sync job replayed",
+        "sync_log_id": job.sync_log_id,
+        "job_id": job.id
+    }), 202
@@ -0,0 +1,317 @@
+import logging
+import re
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert
+from sqlalchemy.exc import IntegrityError, OperationalError
+from src.models.user import db
+from src.models.medication import UserMedication, MedicationLog, MedicationAdherence
+from src.services.ingestion import db_writers
+
+logger = logging.getLogger(__name__)
+
+# Times of day (hours) doses are expected at, by doses per day. Other counts
+# are spread evenly over the day.
+DOSE_HOURS = {
+    1: [9],
+    2: [9, 21],
+    3: [8, 14, 20],
+    4: [8, 12, 16, 20]
+}
+
+# Expected doses: hours of the day they fall at, on every every_days-th day
+Schedule = namedtuple('Schedule', ['hours', 'every_days'])
+
+_WORD_COUNTS = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6}
+_ABBREVIATIONS = {'qd': 1, 'od': 1, 'bid': 2, 'bd': 2, 'tid': 3, 'tds': 3, 'qid': 4}
+
+
+def _dose_hours(doses_per_day):
+    return DOSE_HOURS.get(doses_per_day) or [index * 24 / doses_per_day for index in range(doses_per_day)]
+
+
+def parse_frequency(frequency):
+    """Parse a UserMedication frequency into a Schedule, or None if no doses are expected
+
+    Understands 'once/twice/three times/N times daily' (or 'a day', 'per
+    day'), 'every N hours', 'every other day', 'every N days', 'weekly' and
+    the abbreviations qd, bid, tid and qid. 'As needed' and unrecognised
+    frequencies return None.
+    """
+    if not frequency:
+        return None
+    text = frequency.lower().replace('.', '')
+    if 'as needed' in text or 'when needed' in text or re.search(r'\bprn\b', text):
+        return None
+
+    match = re.search(r'every (\d+) hours?|\bq(\d+)h\b', text)
+    if match:
+        hours = int(match.group(1) or match.group(2))
+        if hours <= 0:
+            return None
+        if hours >= 24:
+            return Schedule(_dose_hours(1), hours // 24)
+        return Schedule(_dose_hours(24 // hours), 1)
+
+    if 'every other day' in text or 'alternate day' in text:
+        return Schedule(_dose_hours(1), 2)
+    match = re.search(r'every (\d+) days', text)
+    if match:
+        return Schedule(_dose_hours(1), max(int(match.group(1)), 1))
+    if 'week' in text:
+        # A few times a week has no fixed days to expect doses on
+        if re.search(r'times|twice|thrice', text):
+            return None
+        return Schedule(_dose_hours(1), 7)
+
+    for abbreviation, count in _ABBREVIATIONS.items():
+        if re.search(rf'\b{abbreviation}\b', text):
+            return Schedule(_dose_hours(count), 1)
+
+    if 'daily' in text or 'a day' in text or 'per day' in text or 'every day' in text or 'nightly' in text:
+        match = re.search(r'\b(\d+|one|two|three|four|five|six)\s*(?:x|times)\b', text)
+        if match:
+            count = int(match.group(1)) if match.group(1).isdigit() else _WORD_COUNTS[match.group(1)]
+        elif 'thrice' in text:
+            count = 3
+        elif 'twice' in text:
+            count = 2
+        else:
+            count = 1
+        return Schedule(_dose_hours(count), 1) if count > 0 else None
+
+    return None
+
+
+def match_doses(window_ends, taken):
+    """Match sorted dose times to consecutive slot windows in one two-pointer sweep
+
+    window_ends are the sorted end times of contiguous windows, one per
+    expected dose; every time in taken falls before the last end. A window
+    is taken by its first dose; further doses in it are extra. Returns
+    (taken, extra).
+    """
+    matched = extra = 0
+    slot = 0
+    filled = False
+    for taken_at in taken:
+        while taken_at >= window_ends[slot]:
+            slot += 1
+            filled = False
+        if filled:
+            extra += 1
+        else:
+            matched += 1
+            filled = True
+    return matched, extra
+
+
+def _window_ends(day, schedule):
+    """End times of a scheduled day's slot windows, split at the midpoints between doses"""
+    start = datetime.combine(day, datetime.min.time())
+    hours = schedule.hours
+    ends = [start + timedelta(hours=(hours[index] + hours[index + 1]) / 2) for index in range(len(hours) - 1)]
+    ends.append(start + timedelta(days=schedule.every_days))
+    return ends
+
+
+def _is_scheduled(user_medication, schedule, day):
+    """Whether doses are expected on a day, given the medication's start and end dates"""
+    if user_medication.start_date and day < user_medication.start_date:
+        return False
+    if user_medication.end_date and day > user_medication.end_date:
+        return False
+    if schedule.every_days > 1:
+        anchor = user_medication.start_date or user_medication.created_at.date()
+        return (day - anchor).days % schedule.every_days == 0
+    return True
+
+
+def compute_day(user_medication, schedule, day, taken, now):
+    """Adherence of a medication on one day from its sorted dose times
+
+    taken must hold every dose time from the start of the day to the end of
+    its dosing window. Doses before the day belong to earlier windows. Slots
+    that are not due yet are not expected, unless a dose was already taken
+    for them.
+    """
+    if not _is_scheduled(user_medication, schedule, day):
+        return {'expected': 0, 'taken': 0, 'extra': 0}
+
+    window_ends = _window_ends(day, schedule)
+    start = datetime.combine(day, datetime.min.time())
+    doses = taken[bisect_left(taken, start):bisect_left(taken, window_ends[-1])]
+    matched, extra = match_doses(window_ends, doses)
+
+    expected = len(window_ends)
+    if window_ends[-1] > now:
+        due = sum(1 for hour in schedule.hours if start + timedelta(hours=hour) <= now)
+        expected = max(due, matched)
+    return {'expected': expected, 'taken': matched, 'extra': extra}
+
+
+def medication_adherence(user_id, start_date, end_date, user_medication_ids=None):
+    """Adherence of a user's scheduled medications over a date range
+
+    Cached days are summed in one grouped query. Days missing from the
+    MedicationAdherence cache are computed from one query for their logs,
+    and cached once their dosing window has closed. Returns overall
+    expected, taken and extra doses and rate (percent, None when nothing was
+    expected), plus the same per user medication id under 'medications'.
+    Medications without a parseable schedule are left out.
+    """
+    now = datetime.utcnow()
+    end_date = min(end_date, now.date())
+
+    query = UserMedication.query.filter_by(user_id=user_id)
+    if user_medication_ids is not None:
+        query = query.filter(UserMedication.id.in_(list(user_medication_ids)))
+    schedules = {}
+    user_medications = {}
+    for user_medication in query.all():
+        schedule = parse_frequency(user_medication.frequency)
+        if schedule is not None:
+            schedules[user_medication.id] = schedule
+            user_medications[user_medication.id] = user_medication
+
+    totals = {user_medication_id: {'expected': 0, 'taken': 0, 'extra': 0} for user_medication_id in schedules}
+    if schedules and start_date <= end_date:
+        in_range = (
+            MedicationAdherence.user_id == user_id,
+            MedicationAdherence.user_medication_id.in_(list(schedules)),
+            MedicationAdherence.date >= start_date,
+            MedicationAdherence.date <= end_date
+        )
+
+        # Sum the cached days per medication in one grouped query
+        cached_counts = {}
+        for user_medication_id, days_cached, expected, taken, extra in db.session.query(
+            MedicationAdherence.user_medication_id,
+            func.count(MedicationAdherence.id),
+            func.sum(MedicationAdherence.expected_doses),
+            func.sum(MedicationAdherence.taken_doses),
+            func.sum(MedicationAdherence.extra_doses)
+        ).filter(*in_range).group_by(MedicationAdherence.user_medication_id):
+            cached_counts[user_medication_id] = days_cached
+            _add(totals[user_medication_id], expected, taken, extra)
+
+        # Days whose dosing window is still open are never cached and always
+        # computed; only medications with gaps among the closed days need
+        # their cached days listed
+        days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+        missing = []
+        incomplete = []
+        for user_medication_id, schedule in schedules.items():
+            closed_until = now.date() - timedelta(days=schedule.every_days)
+            closed = sum(1 for day in days if day <= closed_until)
+            missing.extend((user_medication_id, day) for day in days[closed:])
+            if cached_counts.get(user_medication_id, 0) < closed:
+                incomplete.append(user_medication_id)
+
+        if incomplete:
+            cached_days = set(db.session.query(MedicationAdherence.user_medication_id, MedicationAdherence.date).filter(
+                *in_range, MedicationAdherence.user_medication_id.in_(incomplete)
+            ).all())
+            for user_medication_id in incomplete:
+                closed_until = now.date() - timedelta(days=schedules[user_medication_id].every_days)
+                missing.extend(
+                    (user_medication_id, day) for day in days
+                    if day <= closed_until and (user_medication_id, day) not in cached_days
+                )
+        if missing:
+            closed_rows = []
+            for row in _compute_missing(user_id, user_medications, schedules, missing, now):
+                _add(totals[row['user_medication_id']], row['expected_doses'], row['taken_doses'], row['extra_doses'])
+                if row.pop('closed'):
+                    closed_rows.append(row)
+            _cache_rows(closed_rows)
+
+    overall = {'expected': 0, 'taken': 0, 'extra': 0}
+    for total in totals.values():
+        _add(overall, total['expected'], total['taken'], total['extra'])
+        total['rate'] = _rate(total)
+    overall['rate'] = _rate(overall)
+    overall['medications'] = totals
+    return overall
+
+
+def _compute_missing(user_id, user_medications, schedules, missing, now):
+    """Compute uncached (user medication, day) pairs from one query over their logs"""
+    first_day = min(day for _, day in missing)
+    last_day = max(day for _, day in missing)
+    longest_window = max(schedule.every_days for schedule in schedules.values())
+
+    taken_by_medication = {user_medication_id: [] for user_medication_id in schedules}
+    logs = db.session.query(MedicationLog.user_medication_id, MedicationLog.taken_at).filter(
+        MedicationLog.user_medication_id.in_(list({user_medication_id for user_medication_id, _ in missing})),
+        MedicationLog.taken_at >= datetime.combine(first_day, datetime.min.time()),
+        MedicationLog.taken_at < datetime.combine(last_day + timedelta(days=longest_window), datetime.min.time())
+    ).order_by(MedicationLog.taken_at).all()
+    for user_medication_id, taken_at in logs:
+        taken_by_medication[user_medication_id].append(taken_at)
+
+    rows = []
+    for user_medication_id, day in missing:
+        schedule = schedules[user_medication_id]
+        result = compute_day(user_medications[user_medication_id], schedule, day, taken_by_medication[user_medication_id], now)
+        window_end = datetime.combine(day + timedelta(days=schedule.every_days), datetime.min.time())
+        rows.append({
+            'user_id': user_id,
+            'user_medication_id': user_medication_id,
+            'date': day,
+            'expected_doses': result['expected'],
+            'taken_doses': result['taken'],
+            'extra_doses': result['extra'],
+            'closed': window_end <= now
+        })
+    return rows
+
+
+def _cache_rows(rows):
+    """Store computed days on a connection of their own, leaving the caller's transaction alone
+
+    Skipped while the caller's session holds uncommitted writes, since it
+    already holds the SQLite write lock; losing a race with another writer
+    also only skips the caching.
+    """
+    if not rows or _holds_writes():
+        return
+    try:
+        with db_writers:
+            with db.engine.begin() as connection:
+                connection.execute(insert(MedicationAdherence), rows)
+    except (IntegrityError, OperationalError) as e:
+        logger.warning(f"Could not cache {len(rows)} medication adherence days: {str(e)}")
+
+
+def _holds_writes():
+    """Whether the session has written in a transaction it hasn't committed"""
+    if db.session.new or db.session.dirty or db.session.deleted:
+        return True
+    connection = db.session.connection()
+    return connection.dialect.name == 'sqlite' and connection.connection.dbapi_connection.in_transaction
+
+
+def invalidate_adherence(user_medication, day=None):
+    """Drop cached adherence of a medication, for the windows containing a day or entirely
+
+    Call in the transaction changing its logs (with the dose's day) or its
+    schedule (without a day).
+    """
+    query = MedicationAdherence.query.filter_by(user_medication_id=user_medication.id)
+    if day is not None:
+        schedule = parse_frequency(user_medication.frequency)
+        span = schedule.every_days if schedule else 1
+        query = query.filter(MedicationAdherence.date > day - timedelta(days=span), MedicationAdherence.date <= day)
+    query.delete(synchronize_session=False)
+
+
+def _add(total, expected, taken, extra):
+    total['expected'] += expected
+    total['taken'] += taken
+    total['extra'] += extra
+
+
+def _rate(total):
+    return total['taken'] / total['expected'] * 100 if total['expected'] else None
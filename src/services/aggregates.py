@@ -0,0 +1,72 @@
+from sqlalchemy import case, func
+from src.models.user import db
+
+
+def present(column):
+    """The column where it holds a value (not NULL or 0), else NULL
+
+    Aggregates skip NULLs, so count(present(c)) and avg(present(c)) match
+    Python code filtering rows with `if row.c`.
+    """
+    return case((column != 0, column))
+
+
+def total(column):
+    """SUM of a column, 0 rather than NULL when there are no values"""
+    return func.coalesce(func.sum(column), 0)
+
+
+def _range_query(model, user_id, date_column, start_date, end_date, columns):
+    return db.session.query(*columns).filter(
+        model.user_id == user_id,
+        date_column >= start_date,
+        date_column <= end_date
+    )
+
+
+def aggregate(model, user_id, date_column, start_date, end_date, **aggregates):
+    """Run aggregate expressions over a user's rows in a date range in one query
+
+    Keyword arguments name SQL aggregate expressions; returns a dict of
+    their values.
+    """
+    columns = [expression.label(name) for name, expression in aggregates.items()]
+    row = _range_query(model, user_id, date_column, start_date, end_date, columns).one()
+    return dict(row._mapping)
+
+
+def aggregate_by(model, user_id, date_column, start_date, end_date, group_column, order_by=None, **aggregates):
+    """Run aggregate expressions per value of group_column in one GROUP BY query
+
+    Returns a list of dicts holding the group value under 'group' and the
+    named aggregates, ordered by the order_by expression, or tuple of
+    expressions, if given.
+    """
+    columns = [group_column.label('group')] + [expression.label(name) for name, expression in aggregates.items()]
+    query = _range_query(model, user_id, date_column, start_date, end_date, columns).group_by(group_column)
+    if order_by is not None:
+        query = query.order_by(*(order_by if isinstance(order_by, tuple) else (order_by,)))
+    return [dict(row._mapping) for row in query.all()]
+
+
+def rollup(groups, maxes=()):
+    """Combine aggregate_by() groups into overall totals
+
+    Every aggregate is summed across groups, except those named in maxes,
+    which take the largest non-NULL value. Only sums, counts and maxima
+    combine this way; averages should be derived from combined sums and
+    counts.
+    """
+    totals = {}
+    for group in groups:
+        for name, value in group.items():
+            if name == 'group':
+                continue
+            if name in maxes:
+                if value is not None and (totals.get(name) is None or value > totals[name]):
+                    totals[name] = value
+                else:
+                    totals.setdefault(name, None)
+            else:
+                totals[name] = totals.get(name, 0) + (value or 0)
+    return totals
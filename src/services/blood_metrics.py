@@ -0,0 +1,122 @@
+import logging
+import re
+from sqlalchemy import select, update
+from src.models.user import db
+from src.models.blood_report import BloodReport, BloodMetric
+
+logger = logging.getLogger(__name__)
+
+# Canonical blood metrics: code -> (display name, names labs report it under)
+METRICS = {
+    'hemoglobin': ('Hemoglobin', ['hemoglobin', 'haemoglobin', 'hgb', 'hb']),
+    'wbc': ('White Blood Cell Count', ['white blood cell count', 'white blood cells', 'white blood cell', 'wbc', 'total leukocyte count', 'tlc']),
+    'rbc': ('Red Blood Cell Count', ['red blood cell count', 'red blood cells', 'red blood cell', 'rbc']),
+    'platelets': ('Platelet Count', ['platelet count', 'platelets', 'platelet']),
+    'glucose': ('Glucose', ['glucose', 'fasting glucose', 'blood sugar', 'fasting blood sugar']),
+    'cholesterol': ('Cholesterol', ['cholesterol', 'total cholesterol']),
+    'hdl': ('HDL Cholesterol', ['hdl cholesterol', 'hdl']),
+    'ldl': ('LDL Cholesterol', ['ldl cholesterol', 'ldl']),
+    'triglycerides': ('Triglycerides', ['triglycerides', 'triglyceride']),
+    'sodium': ('Sodium', ['sodium', 'na']),
+    'potassium': ('Potassium', ['potassium', 'k']),
+    'calcium': ('Calcium', ['calcium', 'ca']),
+    'creatinine': ('Creatinine', ['creatinine']),
+    'urea': ('Urea', ['urea', 'bun', 'blood urea nitrogen']),
+    'uric_acid': ('Uric Acid', ['uric acid']),
+    'alt': ('ALT', ['alt', 'sgpt']),
+    'ast': ('AST', ['ast', 'sgot']),
+    'vitamin_d': ('Vitamin D', ['vitamin d', '25 oh vitamin d', 'vitamin d3']),
+    'vitamin_b12': ('Vitamin B12', ['vitamin b12', 'b12']),
+    'iron': ('Iron', ['iron', 'serum iron']),
+    'tsh': ('TSH', ['tsh', 'thyroid stimulating hormone']),
+    't3': ('T3', ['t3', 'total t3']),
+    't4': ('T4', ['t4', 'total t4'])
+}
+
+# Metric codes answering each blood metric a chat query can name
+# (query_parser.BLOOD_METRICS)
+QUERY_METRIC_CODES = {
+    'cholesterol': ['cholesterol', 'hdl', 'ldl'],
+    'glucose': ['glucose'],
+    'hemoglobin': ['hemoglobin'],
+    'white blood cell': ['wbc'],
+    'red blood cell': ['rbc'],
+    'platelet': ['platelets'],
+    'vitamin d': ['vitamin_d'],
+    'vitamin b12': ['vitamin_b12'],
+    'iron': ['iron'],
+    'thyroid': ['tsh', 't3', 't4']
+}
+
+
+def _normalize(name):
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', name.lower()).split())
+
+
+# Built once at import
+_CODES_BY_ALIAS = {_normalize(alias): code for code, (_, aliases) in METRICS.items() for alias in aliases}
+_CODES_BY_ALIAS.update({_normalize(code): code for code in METRICS})
+
+
+def metric_code(name):
+    """Canonical code for a metric name as printed on a report
+
+    Names outside the dictionary get a code derived from the name itself, so
+    the same unknown metric still lines up across reports.
+    """
+    if not name:
+        return None
+    normalized = _normalize(name)
+    return _CODES_BY_ALIAS.get(normalized) or normalized.replace(' ', '_')[:50]
+
+
+def metric_display_name(code):
+    """Display name of a metric code"""
+    return METRICS[code][0] if code in METRICS else code.replace('_', ' ').title()
+
+
+def metric_history(user_id, codes, start_date=None, end_date=None):
+    """Every value of the given metric codes in a user's reports in one indexed query
+
+    Served by the (user_id, metric_code, report_date) index. Returns
+    BloodMetric rows, most recent report first.
+    """
+    query = BloodMetric.query.filter(
+        BloodMetric.user_id == user_id,
+        BloodMetric.metric_code.in_(list(codes))
+    )
+    if start_date is not None:
+        query = query.filter(BloodMetric.report_date >= start_date)
+    if end_date is not None:
+        query = query.filter(BloodMetric.report_date <= end_date)
+    return query.order_by(BloodMetric.report_date.desc(), BloodMetric.blood_report_id, BloodMetric.id).all()
+
+
+def backfill_blood_metrics():
+    """Fill in metric_code, user_id and report_date on metrics stored before they existed
+
+    One UPDATE copies the report columns and one UPDATE per distinct metric
+    name sets the codes, so this is cheap to run at every startup.
+    """
+    report = select(BloodReport).where(BloodReport.id == BloodMetric.blood_report_id)
+    result = db.session.execute(
+        update(BloodMetric)
+        .where(BloodMetric.user_id.is_(None))
+        .values(
+            user_id=report.with_only_columns(BloodReport.user_id).scalar_subquery(),
+            report_date=report.with_only_columns(BloodReport.report_date).scalar_subquery()
+        )
+    )
+    updated = result.rowcount
+
+    names = [name for (name,) in db.session.query(BloodMetric.metric_name).filter(BloodMetric.metric_code.is_(None)).distinct()]
+    for name in names:
+        db.session.execute(
+            update(BloodMetric)
+            .where(BloodMetric.metric_code.is_(None), BloodMetric.metric_name == name)
+            .values(metric_code=metric_code(name))
+        )
+    db.session.commit()
+
+    if updated or names:
+        logger.info(f"Backfilled {updated} blood metrics and codes for {len(names)} metric names")
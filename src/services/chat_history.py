@@ -0,0 +1,259 @@
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from src.models.user import db
+from src.models.chat import UserQuery, IdSequence
+from src.services.ingestion import begin_write, db_writers
+
+logger = logging.getLogger(__name__)
+
+# Seconds buffered chat history may wait before it is written
+CHAT_HISTORY_FLUSH_INTERVAL = float(os.getenv('CHAT_HISTORY_FLUSH_INTERVAL', 2))
+
+# Buffered queries and responses that trigger a write before the interval is up
+CHAT_HISTORY_BATCH_SIZE = int(os.getenv('CHAT_HISTORY_BATCH_SIZE', 50))
+
+# Query ids reserved per write; ids left over when a process exits are skipped
+QUERY_ID_BLOCK_SIZE = int(os.getenv('QUERY_ID_BLOCK_SIZE', 100))
+
+
+class ChatHistoryBuffer:
+    """Write-behind buffer for chat history
+
+    Queries and their responses are kept in memory and written in batches by
+    a background thread, every CHAT_HISTORY_FLUSH_INTERVAL seconds or as soon
+    as CHAT_HISTORY_BATCH_SIZE changes are waiting, so answering a chat
+    message needs no write transaction of its own. Query ids are handed out
+    at once from blocks reserved in the IdSequence table, which keeps them
+    unique across processes. The thread reserves the next block before the
+    current one runs out, so only a burst outrunning it reserves one while
+    answering, and even then without holding up the buffer. The thread
+    starts with the first change recorded in a process, and the buffer is
+    flushed at interpreter exit. Until init_app binds an app, every change
+    is written through.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._inserts = {}
+        self._updates = {}
+        self._next_id = None
+        self._block_end = None
+        self._spare_block = None
+        self._lock = threading.Lock()
+        self._reserve_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def init_app(self, app):
+        """Bind the app buffered history is written in and flush it at exit"""
+        self.app = app
+        atexit.register(self.close)
+
+    def record_query(self, user_id, query_text):
+        """Buffer a new query and return its id"""
+        query_id = self._take_id()
+        now = datetime.utcnow()
+        with self._lock:
+            self._inserts[query_id] = {
+                'id': query_id,
+                'user_id': user_id,
+                'query_text': query_text,
+                'query_time': now,
+                'response_text': None,
+                'data_sources_used': None,
+                'created_at': now,
+                'updated_at': now
+            }
+        self._written()
+        return query_id
+
+    def record_response(self, query_id, response_text, data_sources_used=None):
+        """Buffer the response to a query recorded earlier"""
+        changes = {
+            'response_text': response_text,
+            'data_sources_used': data_sources_used,
+            'updated_at': datetime.utcnow()
+        }
+        with self._lock:
+            if query_id in self._inserts:
+                self._inserts[query_id].update(changes)
+            else:
+                self._updates.setdefault(query_id, {'id': query_id}).update(changes)
+        self._written()
+
+    def pending(self):
+        """Number of buffered queries and responses not written yet"""
+        with self._lock:
+            return len(self._inserts) + len(self._updates)
+
+    def flush(self):
+        """Write every buffered change in one transaction
+
+        A batch failing on an integrity error is written change by change so
+        only the offending ones are dropped; batches failing otherwise are put
+        back to be retried with the next one. Returns the number of changes
+        written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                inserts, self._inserts = self._inserts, {}
+                updates, self._updates = self._updates, {}
+            if not inserts and not updates:
+                return 0
+
+            try:
+                self._write(list(inserts.values()), list(updates.values()))
+            except IntegrityError:
+                db.session.rollback()
+                return self._write_each(inserts, updates)
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                self._requeue(inserts, updates)
+                logger.error(f"Could not write {len(inserts)} chat queries and {len(updates)} responses: {str(e)}")
+                return 0
+            return len(inserts) + len(updates)
+
+    def close(self):
+        """Stop the thread and write whatever is still buffered"""
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=CHAT_HISTORY_FLUSH_INTERVAL + 5)
+        if self.app is not None:
+            with self.app.app_context():
+                written = self.flush()
+            if written:
+                logger.info(f"Flushed {written} buffered chat history changes at shutdown")
+
+    def _take_id(self):
+        """Hand out the next query id, reserving a block outside the buffer lock if none is left"""
+        query_id = self._take_reserved_id()
+        if query_id is not None:
+            return query_id
+
+        with self._reserve_lock:
+            # Another thread may have reserved a block while we waited
+            query_id = self._take_reserved_id()
+            if query_id is not None:
+                return query_id
+
+            start = self._reserve_ids()
+            with self._lock:
+                self._next_id = start + 1
+                self._block_end = start + QUERY_ID_BLOCK_SIZE
+            return start
+
+    def _take_reserved_id(self):
+        """Next id of the current or spare block, or None once both are used up"""
+        with self._lock:
+            if (self._next_id is None or self._next_id >= self._block_end) and self._spare_block is not None:
+                self._next_id, self._block_end = self._spare_block, self._spare_block + QUERY_ID_BLOCK_SIZE
+                self._spare_block = None
+            if self._next_id is None or self._next_id >= self._block_end:
+                return None
+
+            query_id = self._next_id
+            self._next_id += 1
+            # Have the thread reserve the next block while half of this one is left
+            if self._spare_block is None and self._block_end - self._next_id == QUERY_ID_BLOCK_SIZE // 2:
+                self._wake.set()
+            return query_id
+
+    def _reserve_ahead(self):
+        """Reserve a spare block once the current one is half used"""
+        with self._reserve_lock:
+            with self._lock:
+                if self._next_id is None or self._spare_block is not None:
+                    return
+                if self._block_end - self._next_id > QUERY_ID_BLOCK_SIZE // 2:
+                    return
+
+            start = self._reserve_ids()
+            with self._lock:
+                self._spare_block = start
+
+    def _reserve_ids(self):
+        """Reserve the next block of query ids in its own write transaction, returning its first id"""
+        try:
+            with db_writers:
+                begin_write()
+                sequence = db.session.get(IdSequence, UserQuery.__tablename__)
+                if sequence is None:
+                    sequence = IdSequence(name=UserQuery.__tablename__, next_id=1)
+                    db.session.add(sequence)
+                # Stay above rows written without the sequence
+                start = max(sequence.next_id, (db.session.query(func.max(UserQuery.id)).scalar() or 0) + 1)
+                sequence.next_id = start + QUERY_ID_BLOCK_SIZE
+                db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        return start
+
+    def _write(self, inserts, updates):
+        """Insert and update UserQuery rows in one transaction holding the write lock"""
+        with db_writers:
+            begin_write()
+            if inserts:
+                db.session.bulk_insert_mappings(UserQuery, inserts)
+            if updates:
+                db.session.bulk_update_mappings(UserQuery, updates)
+            db.session.commit()
+
+    def _write_each(self, inserts, updates):
+        """Write changes one at a time, dropping those that still fail"""
+        written = 0
+        for inserts_one, updates_one in [([row], []) for row in inserts.values()] + [([], [row]) for row in updates.values()]:
+            try:
+                self._write(inserts_one, updates_one)
+                written += 1
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                logger.error(f"Dropped chat history change for query {(inserts_one or updates_one)[0]['id']}: {str(e)}")
+        return written
+
+    def _requeue(self, inserts, updates):
+        """Put back changes that failed to write, under any made since"""
+        with self._lock:
+            for query_id, row in inserts.items():
+                row.update(self._updates.pop(query_id, {}))
+                self._inserts.setdefault(query_id, row)
+            for query_id, changes in updates.items():
+                self._updates[query_id] = {**changes, **self._updates.get(query_id, {})}
+
+    def _written(self):
+        """Write through without an app, else start the thread or wake it once a batch is full"""
+        if self.app is None:
+            self.flush()
+            return
+
+        with self._lock:
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+        if self.pending() >= CHAT_HISTORY_BATCH_SIZE:
+            self._wake.set()
+
+    def _loop(self):
+        """Background loop: write buffered history every CHAT_HISTORY_FLUSH_INTERVAL seconds or when a batch fills, and reserve query ids ahead"""
+        while not self._stopping:
+            self._wake.wait(CHAT_HISTORY_FLUSH_INTERVAL)
+            self._wake.clear()
+            if self._stopping:
+                return
+            try:
+                with self.app.app_context():
+                    self.flush()
+                    self._reserve_ahead()
+            except Exception as e:
+                logger.error(f"Chat history buffer error: {str(e)}")
+
+
+chat_history = ChatHistoryBuffer()
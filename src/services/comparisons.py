@@ -0,0 +1,127 @@
+from sqlalchemy import and_, case, func
+from src.models.user import db
+from src.models.activity import Activity
+from src.models.food import FoodEntry
+from src.models.sleep import SleepRecord
+from src.models.workout import Workout, WorkoutExercise
+from src.services.aggregates import present, total
+
+
+def compare_periods(model, user_id, date_column, periods, joins=(), **metrics):
+    """Evaluate the same aggregates over several date ranges in one query
+
+    Each metric is a function taking within(column), which limits a column
+    to one period with a CASE on the period's boundaries, and returning an
+    aggregate expression, e.g. lambda within: total(within(Activity.distance)).
+    Every period gets its own conditional aggregates in a single scan of the
+    combined range, so periods may overlap. Returns one dict of metric values
+    per period, in order.
+    """
+    columns = []
+    for index, (start_date, end_date) in enumerate(periods):
+        in_period = and_(date_column >= start_date, date_column <= end_date)
+
+        def within(column, in_period=in_period):
+            return case((in_period, column))
+
+        for name, metric in metrics.items():
+            columns.append(metric(within).label(f'{name}_{index}'))
+
+    query = db.session.query(*columns).select_from(model)
+    for target, on_clause in joins:
+        query = query.join(target, on_clause)
+    row = query.filter(
+        model.user_id == user_id,
+        date_column >= min(start_date for start_date, _ in periods),
+        date_column <= max(end_date for _, end_date in periods)
+    ).one()
+
+    return [
+        {name: row._mapping[f'{name}_{index}'] for name in metrics}
+        for index in range(len(periods))
+    ]
+
+
+def deltas(first, second):
+    """Change of every metric from the second period to the first
+
+    Returns {name: {'first', 'second', 'change', 'change_pct'}}; change is
+    None when either value is missing, change_pct when the second is 0.
+    """
+    result = {}
+    for name, value in first.items():
+        other = second.get(name)
+        change = value - other if value is not None and other is not None else None
+        result[name] = {
+            'first': value,
+            'second': other,
+            'change': change,
+            'change_pct': change / other * 100 if change is not None and other else None
+        }
+    return result
+
+
+# Per domain: the model, its date column, joins and the metrics compared
+# between periods. The first metric counts the domain's records.
+DOMAINS = {
+    'activity': (Activity, Activity.start_time, (), {
+        'count': lambda within: func.count(within(Activity.id)),
+        'distance': lambda within: total(within(Activity.distance)),
+        'duration': lambda within: total(within(Activity.duration)),
+        'calories': lambda within: total(within(Activity.calories)),
+        'heart_rate': lambda within: func.avg(within(present(Activity.average_heart_rate)))
+    }),
+    'food': (FoodEntry, FoodEntry.consumed_at, (), {
+        'count': lambda within: func.count(within(FoodEntry.id)),
+        'calories': lambda within: total(within(FoodEntry.total_calories)),
+        'protein': lambda within: total(within(FoodEntry.total_protein)),
+        'carbs': lambda within: total(within(FoodEntry.total_carbs)),
+        'fat': lambda within: total(within(FoodEntry.total_fat))
+    }),
+    'sleep': (SleepRecord, SleepRecord.start_time, (), {
+        'count': lambda within: func.count(within(SleepRecord.id)),
+        'duration': lambda within: func.avg(within(present(SleepRecord.duration))),
+        'score': lambda within: func.avg(within(present(SleepRecord.sleep_score))),
+        'deep_sleep': lambda within: func.avg(within(present(SleepRecord.deep_sleep_duration)))
+    }),
+    'workout': (Workout, Workout.workout_date, (), {
+        'count': lambda within: func.count(within(Workout.id)),
+        'duration': lambda within: total(within(Workout.duration)),
+        'calories': lambda within: total(within(Workout.calories_burned))
+    })
+}
+
+# Per comparison metric (query_parser.COMPARISON_METRICS): the model, date
+# column and joins it is read from, and its aggregate. Metrics sharing a
+# model are computed in the same scan.
+METRICS = {
+    'steps': (Activity, Activity.start_time, (), lambda within: total(within(Activity.distance)) * 1.31),
+    'heart rate': (Activity, Activity.start_time, (), lambda within: func.avg(within(present(Activity.average_heart_rate)))),
+    'calories': (FoodEntry, FoodEntry.consumed_at, (), lambda within: total(within(FoodEntry.total_calories))),
+    'sleep': (SleepRecord, SleepRecord.start_time, (), lambda within: func.avg(within(present(SleepRecord.duration)))),
+    'weight': (Workout, Workout.workout_date, ((WorkoutExercise, WorkoutExercise.workout_id == Workout.id),),
+               lambda within: func.max(within(present(WorkoutExercise.weight))))
+}
+
+
+def compare_domain(domain, user_id, periods):
+    """A domain's metrics for each period, from one grouped query"""
+    model, date_column, joins, metrics = DOMAINS[domain]
+    return compare_periods(model, user_id, date_column, periods, joins, **metrics)
+
+
+def compare_metrics(user_id, names, start_date, end_date):
+    """Values of several comparison metrics over one date range
+
+    Metrics read from the same model share a single scan. Returns
+    {name: value}.
+    """
+    by_model = {}
+    for name in names:
+        model, date_column, joins, metric = METRICS[name]
+        by_model.setdefault((model, date_column, joins), {})[name] = metric
+
+    values = {}
+    for (model, date_column, joins), metrics in by_model.items():
+        values.update(compare_periods(model, user_id, date_column, [(start_date, end_date)], joins, **metrics)[0])
+    return values
@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from src.models.user import db
+
+logger = logging.getLogger(__name__)
+
+# Seconds without new changes for a user before their subscribers run, so a
+# sync committing many chunks triggers one recompute instead of one per chunk
+CHANGE_DEBOUNCE = float(os.getenv('CHANGE_DEBOUNCE', 5))
+
+# Longest a steady stream of changes can postpone a user's recompute
+CHANGE_MAX_DELAY = float(os.getenv('CHANGE_MAX_DELAY', 60))
+
+# Seconds between checks for debounced changes that are due
+FLUSH_INTERVAL = 1.0
+
+
+class ChangeBus:
+    """In-process bus for data change events that drives downstream recomputation
+
+    Write paths publish (user_id, domain, start_date, end_date) after
+    committing rows. Changes are coalesced per subscriber and user: the
+    subscriber runs once the user's changes go quiet for CHANGE_DEBOUNCE
+    seconds, called with the domains that changed and the union of their
+    date ranges, on the bus thread inside an app context. The thread starts
+    with the first change published in a process.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.subscribers = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscriber(self, name, domains=None):
+        """Register a function recomputing derived data after changes
+
+        The function is called as func(user_id, domains, start_date,
+        end_date). It only sees changes in the given domains, or in every
+        domain if none are given.
+        """
+        def decorator(func):
+            self.subscribers[name] = (set(domains) if domains else None, func)
+            return func
+        return decorator
+
+    def init_app(self, app):
+        """Bind the app subscribers run in; the thread starts on the first change"""
+        self.app = app
+
+    def publish_change(self, user_id, domain, start_date, end_date=None):
+        """Record that a user's data in a domain changed between two dates
+
+        Call after the change is committed. Datetimes are reduced to dates.
+        Never blocks on subscribers.
+        """
+        if start_date is None:
+            return
+        start_date = _as_date(start_date)
+        end_date = _as_date(end_date) if end_date is not None else start_date
+
+        now = time.monotonic()
+        with self._lock:
+            for name, (domains, _) in self.subscribers.items():
+                if domains is not None and domain not in domains:
+                    continue
+
+                pending = self._pending.get((name, user_id))
+                if pending is None:
+                    self._pending[(name, user_id)] = {
+                        'domains': {domain},
+                        'start_date': start_date,
+                        'end_date': end_date,
+                        'first_at': now,
+                        'last_at': now
+                    }
+                else:
+                    pending['domains'].add(domain)
+                    pending['start_date'] = min(pending['start_date'], start_date)
+                    pending['end_date'] = max(pending['end_date'], end_date)
+                    pending['last_at'] = now
+
+            if self._thread is None and self.app is not None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+
+    def flush(self, force=False):
+        """Run subscribers whose changes are due, or all pending ones if force
+
+        Returns the number of subscriber calls made.
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [
+                (key, pending) for key, pending in self._pending.items()
+                if force or now - pending['last_at'] >= CHANGE_DEBOUNCE or now - pending['first_at'] >= CHANGE_MAX_DELAY
+            ]
+            for key, _ in due:
+                del self._pending[key]
+
+        for (name, user_id), pending in due:
+            func = self.subscribers[name][1]
+            try:
+                func(user_id, sorted(pending['domains']), pending['start_date'], pending['end_date'])
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Change subscriber {name} failed for user {user_id}: {str(e)}")
+        return len(due)
+
+    def _loop(self):
+        """Background loop: run due subscribers every FLUSH_INTERVAL seconds"""
+        while True:
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception as e:
+                logger.error(f"Change bus error: {str(e)}")
+            time.sleep(FLUSH_INTERVAL)
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+change_bus = ChangeBus()
+publish_change = change_bus.publish_change
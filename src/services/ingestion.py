@@ -0,0 +1,689 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from sqlalchemy.exc import OperationalError
+from src.models.user import db
+from src.models.data_source import DataSource, UserDataSource, SyncLog, SyncJob
+from src.services.reconcile import reconcile_children
+from src.services.progress import progress
+from src.services.events import publish_change
+from src.services.response_cache import bump_data_version
+
+logger = logging.getLogger(__name__)
+
+# Number of normalized records written and committed per chunk. Each commit
+# releases the SQLite write lock, bounding how long readers can be blocked.
+BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 500))
+
+# Maximum number of records buffered between two stages before the
+# upstream stage blocks (backpressure)
+QUEUE_SIZE = 1000
+
+# Fetched records between two progress events from the fetch stage; the
+# write stage reports after every committed chunk
+PROGRESS_EVERY = 100
+
+# Sentinel marking the end of a stage's output
+_END = object()
+
+# Number of pipelines allowed to write chunks at the same time, across sync
+# workers and the orchestrator. SQLite allows a single writer, so the default
+# makes concurrent syncs take turns instead of failing with "database is
+# locked"; raise it for databases with concurrent writers.
+DB_WRITERS = int(os.getenv('DB_WRITERS', 1))
+db_writers = threading.BoundedSemaphore(DB_WRITERS)
+
+# Set by leases.sync_lease to an event marking the sync lease held by the
+# current thread as lost, which stops its pipeline at the next chunk
+held_lease = threading.local()
+
+
+class SyncInProgress(Exception):
+    """Another sync holds the lease for this connection"""
+    pass
+
+
+class SourceAdapter:
+    """Base class for data sources feeding the ingestion pipeline
+
+    An adapter describes its DataSource row and the model it writes, and knows
+    how to fetch and normalize raw records. SyncLog bookkeeping, deduplication
+    and batched writes are handled by the pipeline.
+    """
+    source_name = None
+    source_type = None
+    description = None
+    api_endpoint = None
+    requires_oauth = False
+    oauth_url = None
+
+    # Model written by the pipeline; must have user_id, source_id, external_id
+    # and source_fingerprint columns
+    model = None
+
+    # Optional child model, the column pointing back at the parent row and the
+    # columns identifying a child within its parent across syncs
+    child_model = None
+    child_parent_column = None
+    child_key_columns = ()
+
+    # Column dating each record; committed chunks publish the range of dates
+    # they created or updated as a change event for the adapter's source_type
+    date_column = None
+
+    # Pages requested from the source API so far, reported in sync progress
+    pages_fetched = 0
+
+    def fetch(self):
+        """Yield raw records from the source"""
+        raise NotImplementedError
+
+    def normalize(self, raw):
+        """Convert a raw record into a dict of model column values
+
+        Child rows, if any, go in a 'children' list on the returned dict.
+        Return None to drop the record.
+        """
+        raise NotImplementedError
+
+    def begin(self, user_id, source_id):
+        """Hook run on the writer thread before the first batch is written"""
+        pass
+
+    def resolve_children(self, children):
+        """Hook to fill in database references on child rows before they are written
+
+        Returns the list of child rows to insert.
+        """
+        return children
+
+    def written(self, user_id, source_id, records):
+        """Hook to maintain derived data from the records created or updated in a chunk
+
+        Runs inside the chunk's savepoint, after its rows are written, so the
+        derived data commits or rolls back with them. Records still hold their
+        'children'.
+        """
+        pass
+
+    def checkpoint(self, record):
+        """Cursor for resuming the fetch after a committed record, or None
+
+        Adapters returning a cursor must accept it in resume(); syncs of other
+        adapters resume by skipping the records already committed.
+        """
+        return None
+
+    def resume(self, cursor):
+        """Make fetch() start after a cursor from checkpoint(); return True if supported"""
+        return False
+
+
+def get_data_source(adapter, create=False):
+    """Get the adapter's DataSource row, optionally creating it"""
+    data_source = DataSource.query.filter_by(name=adapter.source_name).first()
+    if not data_source and create:
+        data_source = DataSource(
+            name=adapter.source_name,
+            source_type=adapter.source_type,
+            api_endpoint=adapter.api_endpoint,
+            requires_oauth=adapter.requires_oauth,
+            oauth_url=adapter.oauth_url,
+            description=adapter.description
+        )
+        db.session.add(data_source)
+        db.session.commit()
+    return data_source
+
+
+def get_or_create_user_data_source(user_id, data_source_id):
+    """Get a user's connection to a data source, creating an active one if missing"""
+    user_data_source = UserDataSource.query.filter_by(
+        user_id=user_id,
+        data_source_id=data_source_id
+    ).first()
+
+    if not user_data_source:
+        user_data_source = UserDataSource(
+            user_id=user_id,
+            data_source_id=data_source_id,
+            is_active=True
+        )
+        db.session.add(user_data_source)
+
+    return user_data_source
+
+
+def start_sync_log(user_id, data_source_id):
+    """Create a pending SyncLog for a sync that is about to run"""
+    sync_log = SyncLog(
+        user_id=user_id,
+        data_source_id=data_source_id,
+        sync_start_time=datetime.utcnow(),
+        status="pending"
+    )
+    db.session.add(sync_log)
+    db.session.commit()
+    return sync_log
+
+
+def complete_sync_log(sync_log, stats, user_data_source=None):
+    """Mark a SyncLog as successful and record the pipeline statistics"""
+    sync_log.sync_end_time = datetime.utcnow()
+    sync_log.status = "success"
+    sync_log.items_synced = stats['created']
+    sync_log.items_skipped = stats['unchanged']
+    sync_log.items_quarantined = stats['quarantined']
+    sync_log.stage_timings = stats['timings']
+
+    if user_data_source is not None:
+        user_data_source.last_sync_at = datetime.utcnow()
+
+    db.session.commit()
+    progress.publish(sync_log.id, sync_log_event(sync_log))
+
+
+def fail_sync_log(sync_log, error):
+    """Mark a SyncLog as failed"""
+    db.session.rollback()
+    sync_log.sync_end_time = datetime.utcnow()
+    sync_log.status = "failed"
+    sync_log.error_message = str(error)
+    db.session.commit()
+    progress.publish(sync_log.id, sync_log_event(sync_log))
+
+
+def sync_log_event(sync_log):
+    """Progress event describing a SyncLog; finished syncs are 'complete'
+
+    Unfinished syncs report the latest progress event stored on the SyncLog,
+    so streams see the progress of syncs running in another process.
+    """
+    finished = sync_log.status in ("success", "failed")
+    if not finished and sync_log.progress:
+        return dict(sync_log.progress, sync_log_id=sync_log.id)
+    return {
+        'sync_log_id': sync_log.id,
+        'phase': "complete" if finished else sync_log.status,
+        'status': sync_log.status,
+        'items_synced': sync_log.items_synced,
+        'items_skipped': sync_log.items_skipped,
+        'items_quarantined': sync_log.items_quarantined,
+        'error_message': sync_log.error_message
+    }
+
+
+def run_sync(adapter, user_id, data_source_id, records=None, user_data_source=None, sync_log=None):
+    """Run a sync through the ingestion pipeline with a uniform SyncLog lifecycle
+
+    Records default to the adapter's fetch(). A pending SyncLog created when
+    the sync was queued can be passed in: the sync then resumes from its
+    job's checkpoint, and marking the SyncLog failed is left to the caller,
+    which may retry. Otherwise a new SyncLog is started and marked failed on
+    error. Returns the finished SyncLog and the pipeline statistics;
+    exceptions are re-raised.
+    """
+    owns_sync_log = sync_log is None
+    if owns_sync_log:
+        sync_log = start_sync_log(user_id, data_source_id)
+    sync_log.status = "running"
+    sync_log.progress = None
+    db.session.commit()
+
+    try:
+        checkpoint = get_checkpoint(sync_log.id)
+        if checkpoint:
+            logger.info(f"Resuming {adapter.source_name} sync for user {user_id} from checkpoint {checkpoint}")
+        stats = ingest_records(adapter, user_id, data_source_id, records if records is not None else adapter.fetch(),
+                               sync_log_id=sync_log.id, checkpoint=checkpoint)
+        complete_sync_log(sync_log, stats, user_data_source)
+    except Exception as e:
+        logger.error(f"{adapter.source_name} sync failed for user {user_id}: {str(e)}")
+        if owns_sync_log:
+            fail_sync_log(sync_log, e)
+        else:
+            db.session.rollback()
+        raise
+
+    logger.info(f"{adapter.source_name} sync for user {user_id}: {stats['created']} created, "
+                f"{stats['updated']} updated, {stats['unchanged']} unchanged, {stats['quarantined']} quarantined, child rows {stats['child_rows']}, "
+                f"timings {stats['timings']}")
+    return sync_log, stats
+
+
+def get_checkpoint(sync_log_id):
+    """Checkpoint saved by an earlier attempt of the job behind a SyncLog, if any"""
+    row = db.session.query(SyncJob.checkpoint).filter_by(sync_log_id=sync_log_id).order_by(SyncJob.id.desc()).first()
+    return row[0] if row else None
+
+
+def begin_write():
+    """Start the session's transaction holding the SQLite write lock
+
+    A deferred SQLite transaction that reads before it writes can deadlock
+    against another writer and fail at once with "database is locked" instead
+    of waiting out the busy timeout. Taking the write lock up front avoids it.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite' and not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def fingerprint_record(record):
+    """Stable content hash of a normalized record, including its child rows"""
+    payload = json.dumps(record, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def ingest_records(adapter, user_id, source_id, records, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE, sync_log_id=None, checkpoint=None):
+    """Push records through the pipeline, committing every batch_size records
+
+    If sync_log_id is given, progress events are published for it and a
+    checkpoint is saved on its job with every chunk. A checkpoint from an
+    earlier attempt resumes the sync where that attempt stopped.
+    """
+    pipeline = IngestionPipeline(adapter, user_id, source_id, batch_size=batch_size, queue_size=queue_size,
+                                 sync_log_id=sync_log_id, checkpoint=checkpoint)
+    return pipeline.run(records)
+
+
+class IngestionPipeline:
+    """Fetch -> normalize -> dedupe -> batch-write stages over bounded queues
+
+    Fetching and normalizing run on background threads and never touch the
+    database. Deduplication and writes run on the calling thread, which owns
+    the SQLAlchemy session; when writes fall behind, the bounded queues block
+    the upstream stages.
+    """
+
+    def __init__(self, adapter, user_id, source_id, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE, sync_log_id=None, checkpoint=None):
+        self.adapter = adapter
+        self.user_id = user_id
+        self.source_id = source_id
+        self.sync_log_id = sync_log_id
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.stats = {
+            'fetched': 0,
+            'dropped': 0,
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'quarantined': 0,
+            'child_rows': {'inserted': 0, 'updated': 0, 'deleted': 0},
+            'timings': {'fetch': 0.0, 'normalize': 0.0, 'dedupe': 0.0, 'write': 0.0}
+        }
+        self._stop = threading.Event()
+        self._fetch_done = threading.Event()
+        self._errors = []
+        self._normalize_failures = 0
+        self._changed_dates = None
+
+        # Resume after an earlier attempt: carry its totals forward and start
+        # fetching from the adapter's cursor, or else skip the raw records
+        # that were already committed
+        self.start_position = 0
+        if checkpoint:
+            self.stats.update(checkpoint.get('totals', {}))
+            cursor = checkpoint.get('cursor')
+            if cursor is None or not self.adapter.resume(cursor):
+                self.start_position = checkpoint.get('position', 0)
+
+    def run(self, records):
+        """Run all stages to completion and return the statistics"""
+        raw_queue = queue.Queue(maxsize=self.queue_size)
+        normalized_queue = queue.Queue(maxsize=self.queue_size)
+
+        threads = [
+            threading.Thread(target=self._fetch_stage, args=(records, raw_queue), daemon=True),
+            threading.Thread(target=self._normalize_stage, args=(raw_queue, normalized_queue), daemon=True)
+        ]
+        self._publish_progress()
+        for thread in threads:
+            thread.start()
+
+        try:
+            with db_writers:
+                begin_write()
+                self.adapter.begin(self.user_id, self.source_id)
+                db.session.commit()
+            self._write_stage(normalized_queue)
+        except Exception:
+            self._stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+        self.stats['quarantined'] += self._normalize_failures
+        self.stats['timings'] = {stage: round(seconds, 4) for stage, seconds in self.stats['timings'].items()}
+        return self.stats
+
+    def _put(self, target, item):
+        """Put an item on a bounded queue, giving up if the pipeline is stopping"""
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source):
+        """Get an item from a queue, returning the end sentinel if the pipeline is stopping"""
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _fetch_stage(self, records, output):
+        try:
+            iterator = iter(records)
+            for _ in range(self.start_position):
+                next(iterator, None)
+
+            position = self.start_position
+            while True:
+                started = time.perf_counter()
+                try:
+                    raw = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    self.stats['timings']['fetch'] += time.perf_counter() - started
+                self.stats['fetched'] += 1
+                if self.stats['fetched'] % PROGRESS_EVERY == 0:
+                    self._publish_progress()
+                if not self._put(output, (position, raw)):
+                    return
+                position += 1
+        except Exception as e:
+            # Records fetched before the error still flow through and commit,
+            # so a retry resumes from them; the error is raised at the end
+            self._errors.append(e)
+        finally:
+            self._fetch_done.set()
+            self._put(output, _END)
+
+    def _normalize_stage(self, source, output):
+        try:
+            while True:
+                item = self._get(source)
+                if item is _END:
+                    break
+                position, raw = item
+
+                started = time.perf_counter()
+                try:
+                    record = self.adapter.normalize(raw)
+                    if record is not None:
+                        record['source_fingerprint'] = fingerprint_record(record)
+                except Exception as e:
+                    logger.error(f"Quarantined {self.adapter.source_name} record that failed to normalize: {str(e)}")
+                    self._normalize_failures += 1
+                    continue
+                finally:
+                    self.stats['timings']['normalize'] += time.perf_counter() - started
+
+                if record is None:
+                    self.stats['dropped'] += 1
+                    continue
+                if not self._put(output, (position, record)):
+                    return
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            self._put(output, _END)
+
+    def _write_stage(self, source):
+        batch = []
+        while True:
+            item = self._get(source)
+            if item is _END:
+                break
+            position, record = item
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self._commit_batch(batch, position + 1)
+                self._publish_progress()
+                batch = []
+
+        if batch:
+            self._commit_batch(batch, position + 1)
+        db.session.commit()
+        self._publish_progress()
+
+    def _publish_progress(self):
+        """Publish pages fetched, rows written and the current phase for the sync"""
+        if self.sync_log_id is None:
+            return
+
+        progress.publish(self.sync_log_id, self._progress_event())
+
+    def _progress_event(self):
+        return {
+            'phase': "writing" if self._fetch_done.is_set() else "fetching",
+            'pages_fetched': self.adapter.pages_fetched,
+            'fetched': self.stats['fetched'],
+            'written': self.stats['created'] + self.stats['updated'] + self.stats['unchanged'],
+            'created': self.stats['created'],
+            'updated': self.stats['updated'],
+            'unchanged': self.stats['unchanged'],
+            'quarantined': self.stats['quarantined'] + self._normalize_failures
+        }
+
+    def _commit_batch(self, batch, position):
+        """Write one chunk in its own transaction, isolating bad rows with savepoints
+
+        The chunk is first written under a single SAVEPOINT. If that fails it is
+        retried one record per SAVEPOINT, and records that still fail are
+        quarantined instead of aborting the import. The checkpoint covering
+        the chunk (raw records consumed up to position) and the user's data
+        version bump commit with it, and a change event for the chunk is
+        published once it is committed. Raises SyncInProgress, writing
+        nothing, once the sync lease held by this thread is lost.
+        """
+        # Another sync may have taken over the connection's lease
+        lost = getattr(held_lease, 'lost', None)
+        if lost is not None and lost.is_set():
+            raise SyncInProgress(f"Lost the sync lease for user {self.user_id} and data source {self.source_id}")
+
+        self._changed_dates = None
+        with db_writers:
+            begin_write()
+            counters = self._counters()
+            written = self.stats['created'] + self.stats['updated']
+            try:
+                with db.session.begin_nested():
+                    self._write_batch(batch)
+            except OperationalError:
+                # Locking and connection errors are not caused by the records
+                raise
+            except Exception as e:
+                logger.warning(f"Chunk of {len(batch)} {self.adapter.source_name} records failed, retrying row by row: {str(e)}")
+                self._restore_counters(counters)
+                # Dates tracked by the rolled back attempt were never written
+                self._changed_dates = None
+
+                for record in batch:
+                    counters = self._counters()
+                    changed_dates = self._changed_dates
+                    try:
+                        with db.session.begin_nested():
+                            self._write_batch([record])
+                    except OperationalError:
+                        raise
+                    except Exception as e:
+                        self._restore_counters(counters)
+                        self._changed_dates = changed_dates
+                        self.stats['quarantined'] += 1
+                        logger.error(f"Quarantined {self.adapter.source_name} record {record.get('external_id')}: {str(e)}")
+
+            # Cached chat answers over the old data are stale once this commits
+            if self.stats['created'] + self.stats['updated'] > written:
+                bump_data_version(self.user_id)
+
+            self._save_checkpoint(position, batch[-1])
+            db.session.commit()
+
+        if self._changed_dates is not None:
+            publish_change(self.user_id, self.adapter.source_type, *self._changed_dates)
+
+    def _save_checkpoint(self, position, record):
+        """Record on the sync's job how far it got and the totals so far, and on its SyncLog the progress"""
+        if self.sync_log_id is None:
+            return
+
+        checkpoint = {
+            'position': position,
+            'cursor': self.adapter.checkpoint(record),
+            'last_external_id': record.get('external_id'),
+            'totals': {
+                'created': self.stats['created'],
+                'updated': self.stats['updated'],
+                'unchanged': self.stats['unchanged'],
+                'quarantined': self.stats['quarantined'] + self._normalize_failures
+            }
+        }
+        SyncJob.query.filter_by(sync_log_id=self.sync_log_id).update({'checkpoint': checkpoint}, synchronize_session=False)
+        SyncLog.query.filter_by(id=self.sync_log_id).update({'progress': self._progress_event()}, synchronize_session=False)
+
+    def _counters(self):
+        """Snapshot the write counters so a rolled back savepoint can be undone"""
+        return copy.deepcopy({key: self.stats[key] for key in ('created', 'updated', 'unchanged', 'quarantined', 'child_rows')})
+
+    def _restore_counters(self, counters):
+        self.stats.update(copy.deepcopy(counters))
+
+    def _write_batch(self, batch):
+        model = self.adapter.model
+
+        # Dedupe within the batch (last occurrence wins) and against stored rows
+        started = time.perf_counter()
+        by_external_id = {}
+        without_external_id = []
+        for record in batch:
+            if record.get('external_id') is None:
+                without_external_id.append(record)
+            else:
+                by_external_id[record['external_id']] = record
+
+        existing_ids = {}
+        if by_external_id:
+            existing = db.session.query(model.external_id, model.id, model.source_fingerprint).filter(
+                model.user_id == self.user_id,
+                model.source_id == self.source_id,
+                model.external_id.in_(list(by_external_id))
+            ).all()
+
+            # Skip records whose payload has not changed since they were stored
+            for external_id, record_id, fingerprint in existing:
+                if fingerprint and fingerprint == by_external_id[external_id]['source_fingerprint']:
+                    del by_external_id[external_id]
+                    self.stats['unchanged'] += 1
+                else:
+                    existing_ids[external_id] = record_id
+        self.stats['timings']['dedupe'] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        children_by_external_id = {}
+        inserts = []
+        updates = []
+        for record in without_external_id + list(by_external_id.values()):
+            record = dict(record)
+            children = record.pop('children', None)
+            if record.get('external_id') is not None and children is not None:
+                children_by_external_id[record['external_id']] = children
+
+            if record.get('external_id') in existing_ids:
+                record['id'] = existing_ids[record['external_id']]
+                record['updated_at'] = now
+                updates.append(record)
+            else:
+                record['user_id'] = self.user_id
+                record['source_id'] = self.source_id
+                inserts.append(record)
+
+        if self.adapter.date_column is not None:
+            self._track_changed_dates(inserts + updates)
+
+        if inserts:
+            db.session.bulk_insert_mappings(model, inserts)
+        if updates:
+            db.session.bulk_update_mappings(model, updates)
+
+        if self.adapter.child_model is not None and children_by_external_id:
+            self._write_children(children_by_external_id, existing_ids)
+
+        if inserts or updates:
+            self.adapter.written(self.user_id, self.source_id, without_external_id + list(by_external_id.values()))
+
+        self.stats['created'] += len(inserts)
+        self.stats['updated'] += len(updates)
+        self.stats['timings']['write'] += time.perf_counter() - started
+
+    def _track_changed_dates(self, records):
+        """Widen the chunk's changed date range to cover records being written"""
+        dates = [record[self.adapter.date_column] for record in records if record.get(self.adapter.date_column) is not None]
+        if not dates:
+            return
+        if self._changed_dates is not None:
+            dates.extend(self._changed_dates)
+        self._changed_dates = (min(dates), max(dates))
+
+    def _write_children(self, children_by_external_id, existing_ids):
+        """Write the child rows of every parent written in this batch
+
+        Children of new parents are bulk inserted; children of updated parents
+        are reconciled against the stored rows so only the differences are written.
+        """
+        model = self.adapter.model
+        child_model = self.adapter.child_model
+        parent_column = self.adapter.child_parent_column
+
+        # Look up ids of the parents just inserted in one query
+        parent_ids = dict(existing_ids)
+        new_external_ids = [external_id for external_id in children_by_external_id if external_id not in parent_ids]
+        if new_external_ids:
+            parent_ids.update(
+                db.session.query(model.external_id, model.id).filter(
+                    model.user_id == self.user_id,
+                    model.source_id == self.source_id,
+                    model.external_id.in_(new_external_ids)
+                ).all()
+            )
+
+        rows = []
+        for external_id, children in children_by_external_id.items():
+            for child in children:
+                rows.append(dict(child, **{parent_column: parent_ids[external_id]}))
+        rows = self.adapter.resolve_children(rows)
+
+        updated_parent_ids = {existing_ids[external_id] for external_id in children_by_external_id if external_id in existing_ids}
+        new_rows = [row for row in rows if row[parent_column] not in updated_parent_ids]
+        if new_rows:
+            db.session.bulk_insert_mappings(child_model, new_rows)
+
+        if updated_parent_ids:
+            incoming_by_parent = {parent_id: [] for parent_id in updated_parent_ids}
+            for row in rows:
+                if row[parent_column] in updated_parent_ids:
+                    incoming_by_parent[row[parent_column]].append(row)
+
+            counts = reconcile_children(child_model, parent_column, self.adapter.child_key_columns, incoming_by_parent)
+            for action, count in counts.items():
+                self.stats['child_rows'][action] += count
+        self.stats['child_rows']['inserted'] += len(new_rows)
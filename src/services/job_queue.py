@@ -0,0 +1,329 @@
+import logging
+import os
+import random
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from src.models.user import db
+from src.models.data_source import UserDataSource, SyncLog, SyncJob, DeadLetterJob
+from src.services.ingestion import begin_write, fail_sync_log
+from src.services.leases import HEARTBEAT_INTERVAL, SyncInProgress, sync_lease
+from src.services.progress import progress
+
+logger = logging.getLogger(__name__)
+
+# Number of worker threads pulling sync jobs off the queue
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+
+# Seconds an idle worker waits before polling the queue again; enqueue()
+# wakes workers in this process immediately
+POLL_INTERVAL = 2.0
+
+# Attempts before a failing job moves to the dead-letter table
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+
+# Retry delay in seconds after the first failure, doubling with each further
+# failure up to the maximum
+RETRY_BASE_DELAY = int(os.getenv('JOB_RETRY_BASE_DELAY', 30))
+RETRY_MAX_DELAY = int(os.getenv('JOB_RETRY_MAX_DELAY', 3600))
+
+
+class JobInFlight(Exception):
+    """The connection already has a job queued or running"""
+
+    def __init__(self, job):
+        super().__init__(f"Job {job.id} is already {job.status} for user {job.user_id} and data source {job.data_source_id}")
+        self.job = job
+
+
+class JobQueue:
+    """Durable sync job queue backed by the SyncJob table
+
+    Jobs are rows, so queued work survives a restart. Worker threads claim
+    the oldest queued job with a conditional UPDATE, run the handler
+    registered for its job_type inside an app context and record the outcome
+    on the job and its SyncLog. Failed jobs are retried with exponential
+    backoff, resuming from their checkpoint, and moved to the dead-letter
+    table after JOB_MAX_ATTEMPTS attempts.
+
+    Only one job per connection is ever queued or running: enqueueing a
+    duplicate returns the job already in flight, and handlers run under the
+    connection's sync lease so syncs started outside the queue cannot
+    overlap them either.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.handlers = {}
+        self.source_types = {}
+        self._wake = threading.Event()
+        self._threads = []
+
+    def handler(self, job_type, source_type=None):
+        """Register the sync function that runs jobs of a given type
+
+        The handler is called as handler(user_data_source, sync_log, payload)
+        and should drive the SyncLog to a final status and return the SyncLog
+        and statistics, normally through run_sync(). Passing the
+        DataSource.source_type it syncs lets the scheduler and the
+        orchestrator find it.
+        """
+        def decorator(func):
+            self.handlers[job_type] = func
+            if source_type:
+                self.source_types[source_type] = job_type
+            return func
+        return decorator
+
+    def init_app(self, app):
+        """Bind the app that workers and handlers run in; starts nothing"""
+        self.app = app
+
+    def start(self, workers=JOB_WORKERS):
+        """Recover jobs orphaned by a previous process and start the worker threads
+
+        Run by one process only, such as `flask worker`.
+        """
+        with self.app.app_context():
+            self.recover()
+
+        for index in range(workers):
+            thread = threading.Thread(target=self._work, args=(f"{os.getpid()}-{index}",), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, job_type, user_id, data_source_id, payload=None, checkpoint=None, attach=True):
+        """Queue a job with a pending SyncLog and return the job
+
+        A checkpoint from an earlier job makes the sync resume from it. If the
+        connection already has a job queued or running, that job is returned
+        instead, so duplicate requests follow the sync already in flight; with
+        attach=False, JobInFlight is raised instead.
+        """
+        if job_type not in self.handlers:
+            raise ValueError(f"No handler registered for job type {job_type}")
+
+        # Hold the write lock so two requests cannot both miss each other's job
+        begin_write()
+        existing = SyncJob.query.filter(
+            SyncJob.user_id == user_id,
+            SyncJob.data_source_id == data_source_id,
+            SyncJob.status.in_(("queued", "running"))
+        ).order_by(SyncJob.id).first()
+        if existing is not None:
+            db.session.commit()
+            if not attach:
+                raise JobInFlight(existing)
+            logger.info(f"Attached {job_type} request for user {user_id} to in-flight job {existing.id}")
+            return existing
+
+        sync_log = SyncLog(
+            user_id=user_id,
+            data_source_id=data_source_id,
+            sync_start_time=datetime.utcnow(),
+            status="pending"
+        )
+        db.session.add(sync_log)
+        db.session.flush()
+
+        job = SyncJob(
+            job_type=job_type,
+            user_id=user_id,
+            data_source_id=data_source_id,
+            sync_log_id=sync_log.id,
+            payload=payload or {},
+            checkpoint=checkpoint,
+            status="queued"
+        )
+        sync_log.progress = {'phase': "queued", 'status': "pending"}
+        db.session.add(job)
+        db.session.commit()
+
+        logger.info(f"Queued {job_type} job {job.id} for user {user_id} (sync log {sync_log.id})")
+        progress.publish(sync_log.id, sync_log.progress)
+        self._wake.set()
+        return job
+
+    def recover(self):
+        """Requeue jobs left running by a worker process that no longer exists"""
+        running = SyncJob.query.filter_by(status="running").all()
+        for job in running:
+            pid = int(job.worker.split('-')[0]) if job.worker else None
+            if pid is not None and pid != os.getpid() and _pid_alive(pid):
+                continue
+
+            logger.warning(f"Requeuing {job.job_type} job {job.id} orphaned by worker {job.worker}")
+            job.status = "queued"
+            job.worker = None
+            if job.sync_log is not None and job.sync_log.status == "running":
+                job.sync_log.status = "pending"
+        db.session.commit()
+
+    def claim(self, worker):
+        """Atomically claim the oldest queued job that is due, returning its id or None"""
+        while True:
+            candidate = db.session.query(SyncJob.id).filter(
+                SyncJob.status == "queued",
+                or_(SyncJob.run_after.is_(None), SyncJob.run_after <= datetime.utcnow())
+            ).order_by(SyncJob.id).first()
+            if candidate is None:
+                db.session.commit()
+                return None
+
+            # Only one worker can move the row out of 'queued'
+            claimed = SyncJob.query.filter_by(id=candidate.id, status="queued").update({
+                'status': "running",
+                'worker': worker,
+                'attempts': SyncJob.attempts + 1,
+                'started_at': datetime.utcnow()
+            }, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return candidate.id
+
+    def run_handler(self, job_type, user_id, data_source_id, sync_log, payload=None):
+        """Run the sync function for a job type against a user's active connection
+
+        The handler runs under the connection's sync lease. Returns the
+        handler's SyncLog and statistics. Exceptions, including SyncInProgress
+        when another sync holds the lease, are re-raised with the SyncLog left
+        unfinished, for the caller to retry or fail.
+        """
+        try:
+            handler = self.handlers.get(job_type)
+            if handler is None:
+                raise ValueError(f"No handler registered for job type {job_type}")
+
+            user_data_source = UserDataSource.query.filter_by(
+                user_id=user_id,
+                data_source_id=data_source_id,
+                is_active=True
+            ).first()
+            if not user_data_source:
+                raise ValueError(f"User {user_id} not connected to data source {data_source_id}")
+
+            with sync_lease(user_id, data_source_id, sync_log.id if sync_log else None):
+                return handler(user_data_source, sync_log, payload or {})
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def run_job(self, job_id):
+        """Run a claimed job and record its outcome"""
+        job = SyncJob.query.get(job_id)
+
+        try:
+            self.run_handler(job.job_type, job.user_id, job.data_source_id, job.sync_log, job.payload)
+        except SyncInProgress as e:
+            # Not a failure: wait for the other sync without using an attempt
+            logger.info(f"{job.job_type} job {job.id} deferred: {str(e)}")
+            job.status = "queued"
+            job.worker = None
+            job.attempts -= 1
+            job.run_after = datetime.utcnow() + timedelta(seconds=HEARTBEAT_INTERVAL)
+            db.session.commit()
+            return
+        except Exception as e:
+            logger.error(f"{job.job_type} job {job.id} failed on attempt {job.attempts}: {str(e)}")
+            self._retry_or_bury(job, e)
+            return
+
+        job.status = "done"
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+    def replay(self, dead_letter):
+        """Queue a dead-lettered job again, resuming from its checkpoint
+
+        Raises JobInFlight, leaving the dead letter unreplayed, if the
+        connection already has a job queued or running, since that job would
+        not resume from the checkpoint.
+        """
+        job = self.enqueue(
+            dead_letter.job_type,
+            dead_letter.user_id,
+            dead_letter.data_source_id,
+            payload=dead_letter.payload,
+            checkpoint=dead_letter.checkpoint,
+            attach=False
+        )
+        dead_letter.replayed_at = datetime.utcnow()
+        dead_letter.replay_job_id = job.id
+        db.session.commit()
+        return job
+
+    def _retry_or_bury(self, job, error):
+        """Schedule a failed job's next attempt, or dead-letter it when out of attempts"""
+        sync_log = job.sync_log
+        job.error_message = str(error)
+
+        if job.attempts < JOB_MAX_ATTEMPTS:
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (job.attempts - 1))
+            delay += random.uniform(0, delay / 10)  # Keep jobs that failed together from retrying together
+            job.status = "queued"
+            job.worker = None
+            job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+            if sync_log is not None:
+                sync_log.status = "retrying"
+                sync_log.error_message = str(error)
+                sync_log.progress = {
+                    'phase': "retrying",
+                    'status': "retrying",
+                    'attempt': job.attempts,
+                    'retry_at': job.run_after.isoformat(),
+                    'error_message': str(error)
+                }
+            db.session.commit()
+
+            logger.info(f"Retrying {job.job_type} job {job.id} in {delay:.0f}s")
+            if sync_log is not None:
+                progress.publish(sync_log.id, sync_log.progress)
+            return
+
+        logger.error(f"Moving {job.job_type} job {job.id} to the dead-letter queue after {job.attempts} attempts")
+        job.status = "dead"
+        job.finished_at = datetime.utcnow()
+        db.session.add(DeadLetterJob(
+            sync_job_id=job.id,
+            job_type=job.job_type,
+            user_id=job.user_id,
+            data_source_id=job.data_source_id,
+            payload=job.payload,
+            checkpoint=job.checkpoint,
+            attempts=job.attempts,
+            error_message=str(error)
+        ))
+        db.session.commit()
+
+        if sync_log is not None:
+            fail_sync_log(sync_log, error)
+
+    def _work(self, worker):
+        """Worker loop: claim and run jobs forever"""
+        while True:
+            job_id = None
+            try:
+                with self.app.app_context():
+                    job_id = self.claim(worker)
+                    if job_id is not None:
+                        self.run_job(job_id)
+            except Exception as e:
+                logger.error(f"Job worker {worker} error: {str(e)}")
+
+            if job_id is None:
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+
+
+def _pid_alive(pid):
+    """Whether a process with the given id is running on this machine"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+job_queue = JobQueue()
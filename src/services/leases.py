@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from src.models.user import db
+from src.models.data_source import SyncLease
+from src.services.ingestion import SyncInProgress, begin_write, held_lease
+
+logger = logging.getLogger(__name__)
+
+# Seconds a lease stays valid without a heartbeat. A sync whose process dies
+# blocks its connection for at most this long.
+LEASE_TTL = int(os.getenv('SYNC_LEASE_TTL', 60))
+
+# Seconds between heartbeats renewing a held lease
+HEARTBEAT_INTERVAL = LEASE_TTL / 3
+
+
+def acquire_lease(user_id, data_source_id, sync_log_id=None, ttl=LEASE_TTL):
+    """Take a connection's lease, returning the holder token or None if a live sync holds it
+
+    The check and the write happen under the SQLite write lock, so two
+    processes can never both take the same lease.
+    """
+    holder = uuid.uuid4().hex
+    now = datetime.utcnow()
+
+    begin_write()
+    lease = SyncLease.query.filter_by(user_id=user_id, data_source_id=data_source_id).first()
+    if lease and lease.expires_at > now:
+        db.session.commit()
+        return None
+
+    if lease is None:
+        lease = SyncLease(user_id=user_id, data_source_id=data_source_id)
+        db.session.add(lease)
+    else:
+        logger.warning(f"Taking over expired sync lease for user {user_id}, data source {data_source_id}")
+
+    lease.holder = holder
+    lease.sync_log_id = sync_log_id
+    lease.expires_at = now + timedelta(seconds=ttl)
+    lease.heartbeat_at = now
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another process inserted the lease first
+        db.session.rollback()
+        return None
+    return holder
+
+
+def renew_lease(engine, user_id, data_source_id, holder, ttl=LEASE_TTL):
+    """Push a held lease's expiry forward; returns False if the lease was lost"""
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        result = connection.execute(
+            update(SyncLease)
+            .where(SyncLease.user_id == user_id, SyncLease.data_source_id == data_source_id, SyncLease.holder == holder)
+            .values(expires_at=now + timedelta(seconds=ttl), heartbeat_at=now, updated_at=now)
+        )
+    return result.rowcount > 0
+
+
+def release_lease(engine, user_id, data_source_id, holder):
+    """Give up a held lease"""
+    with engine.begin() as connection:
+        connection.execute(
+            delete(SyncLease)
+            .where(SyncLease.user_id == user_id, SyncLease.data_source_id == data_source_id, SyncLease.holder == holder)
+        )
+
+
+@contextmanager
+def sync_lease(user_id, data_source_id, sync_log_id=None):
+    """Hold a connection's lease for the duration of a sync
+
+    A background thread heartbeats the lease while the sync runs. Renewals
+    and the release use their own connections, so they work whatever state
+    the sync leaves the session in. Raises SyncInProgress if another sync
+    holds the lease; if the lease is lost while the sync runs, the sync's
+    pipeline raises it before writing its next chunk.
+    """
+    holder = acquire_lease(user_id, data_source_id, sync_log_id)
+    if holder is None:
+        raise SyncInProgress(f"A sync for user {user_id} and data source {data_source_id} is already running")
+
+    engine = db.engine
+    stop = threading.Event()
+    lost = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(engine, user_id, data_source_id, holder, stop, lost), daemon=True)
+    heartbeat.start()
+
+    outer_lost = getattr(held_lease, 'lost', None)
+    held_lease.lost = lost
+    try:
+        yield holder
+    finally:
+        held_lease.lost = outer_lost
+        stop.set()
+        heartbeat.join()
+        release_lease(engine, user_id, data_source_id, holder)
+
+
+def _heartbeat(engine, user_id, data_source_id, holder, stop, lost):
+    """Renew a lease every HEARTBEAT_INTERVAL seconds until stopped, setting lost if it was taken"""
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            if not renew_lease(engine, user_id, data_source_id, holder):
+                logger.error(f"Lost sync lease for user {user_id}, data source {data_source_id}, stopping the sync")
+                lost.set()
+                return
+        except Exception as e:
+            logger.warning(f"Sync lease heartbeat failed for user {user_id}, data source {data_source_id}: {str(e)}")
@@ -0,0 +1,62 @@
+from src.models.user import db
+from src.models.medication import Medication, UserMedication, MedicationLog
+
+# Columns of a log entry: the log itself plus its user medication and medication
+_LOG_COLUMNS = (
+    MedicationLog.id,
+    MedicationLog.user_medication_id,
+    MedicationLog.taken_at,
+    MedicationLog.dosage_taken,
+    MedicationLog.notes,
+    MedicationLog.created_at,
+    MedicationLog.updated_at,
+    UserMedication.medication_id,
+    UserMedication.custom_name,
+    UserMedication.dosage,
+    UserMedication.frequency,
+    Medication.name.label('medication_name')
+)
+
+
+def get_user_medications(user_id):
+    """A user's medications with their Medication rows in one joined query
+
+    Returns (user_medication, medication) pairs in creation order;
+    medication is None if its row is missing.
+    """
+    return db.session.query(UserMedication, Medication).outerjoin(
+        Medication, UserMedication.medication_id == Medication.id
+    ).filter(
+        UserMedication.user_id == user_id
+    ).order_by(UserMedication.id).all()
+
+
+def get_medication_log_entries(user_id, start, end, newest_first=True):
+    """A user's medication logs between two datetimes in one joined query
+
+    Each log is a dict of the MedicationLog columns plus medication_id,
+    custom_name, dosage and frequency from its UserMedication and the
+    medication_name ('Unknown' if the medication is missing). Logs are
+    newest first, or grouped per user medication in logging order.
+    """
+    query = db.session.query(*_LOG_COLUMNS).join(
+        UserMedication, MedicationLog.user_medication_id == UserMedication.id
+    ).outerjoin(
+        Medication, UserMedication.medication_id == Medication.id
+    ).filter(
+        UserMedication.user_id == user_id,
+        MedicationLog.taken_at >= start,
+        MedicationLog.taken_at <= end
+    )
+    if newest_first:
+        query = query.order_by(MedicationLog.taken_at.desc(), MedicationLog.id.desc())
+    else:
+        query = query.order_by(UserMedication.id, MedicationLog.id)
+
+    logs = []
+    for row in query.all():
+        log = dict(row._mapping)
+        log['medication_name'] = log['medication_name'] or 'Unknown'
+        logs.append(log)
+    return logs
+
@@ -0,0 +1,198 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from src.models.user import db
+from src.models.data_source import DataSource, UserDataSource, SyncJob
+from src.services.ingestion import start_sync_log, fail_sync_log
+from src.services.job_queue import job_queue
+from src.services.leases import SyncInProgress
+
+logger = logging.getLogger(__name__)
+
+# Concurrent syncs allowed per provider (DataSource.source_type). Provider
+# limits bound API calls; database writes are bounded separately by
+# ingestion.DB_WRITERS.
+PROVIDER_CONCURRENCY = {
+    'activity': int(os.getenv('SYNC_CONCURRENCY_ACTIVITY', 4)),
+    'workout': int(os.getenv('SYNC_CONCURRENCY_WORKOUT', 4)),
+    'food': int(os.getenv('SYNC_CONCURRENCY_FOOD', 4)),
+    'sleep': int(os.getenv('SYNC_CONCURRENCY_SLEEP', 4))
+}
+DEFAULT_PROVIDER_CONCURRENCY = 2
+
+# Number of finished run summaries kept for the API
+MAX_RUNS = 20
+
+_runs = OrderedDict()
+_runs_lock = threading.Lock()
+
+
+def sync_all(app, source_types=None, user_ids=None, limits=None):
+    """Sync every active connection in one pass and return a summary
+
+    Each provider gets its own thread pool sized by its concurrency limit, so
+    a slow provider never holds up the others. Connections with a queued or
+    running job, or whose sync lease is held elsewhere, are skipped and
+    leave no SyncLog. Every sync that runs gets its own SyncLog.
+    """
+    started = time.perf_counter()
+    limits = dict(PROVIDER_CONCURRENCY, **(limits or {}))
+
+    with app.app_context():
+        connections = _active_connections(source_types, user_ids)
+
+    summary = {
+        'users': len({connection['user_id'] for connection in connections}),
+        'connections': len(connections),
+        'succeeded': 0,
+        'failed': 0,
+        'skipped': 0,
+        'items_synced': 0,
+        'items_skipped': 0,
+        'providers': {},
+        'failures': [],
+        'wall_time': 0.0
+    }
+
+    executors = {}
+    futures = {}
+    try:
+        for connection in connections:
+            source_type = connection['source_type']
+            if source_type not in executors:
+                executors[source_type] = ThreadPoolExecutor(
+                    max_workers=limits.get(source_type, DEFAULT_PROVIDER_CONCURRENCY),
+                    thread_name_prefix=f"sync-{source_type}"
+                )
+            future = executors[source_type].submit(_sync_connection, app, connection)
+            futures[future] = connection
+
+        for future in as_completed(futures):
+            connection = futures[future]
+            provider = summary['providers'].setdefault(
+                connection['data_source_name'],
+                {'connections': 0, 'succeeded': 0, 'failed': 0, 'items_synced': 0}
+            )
+            provider['connections'] += 1
+
+            try:
+                stats = future.result()
+            except SyncInProgress:
+                summary['skipped'] += 1
+                continue
+            except Exception as e:
+                summary['failed'] += 1
+                provider['failed'] += 1
+                summary['failures'].append({
+                    'user_id': connection['user_id'],
+                    'data_source_name': connection['data_source_name'],
+                    'error': str(e)
+                })
+                continue
+
+            summary['succeeded'] += 1
+            summary['items_synced'] += stats['created']
+            summary['items_skipped'] += stats['unchanged']
+            provider['succeeded'] += 1
+            provider['items_synced'] += stats['created']
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+    summary['wall_time'] = round(time.perf_counter() - started, 3)
+    logger.info(f"Synced {summary['connections']} connections for {summary['users']} users in {summary['wall_time']}s: "
+                f"{summary['items_synced']} items, {summary['failed']} failures")
+    return summary
+
+
+def start_sync_all(app, source_types=None, user_ids=None, limits=None):
+    """Run sync_all() on a background thread and return the run id"""
+    run_id = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    run = {
+        'id': run_id,
+        'status': "running",
+        'started_at': datetime.utcnow(),
+        'finished_at': None,
+        'summary': None,
+        'error_message': None
+    }
+    with _runs_lock:
+        _runs[run_id] = run
+        while len(_runs) > MAX_RUNS:
+            _runs.popitem(last=False)
+
+    def target():
+        try:
+            run['summary'] = sync_all(app, source_types, user_ids, limits)
+            run['status'] = "success"
+        except Exception as e:
+            logger.error(f"Sync run {run_id} failed: {str(e)}")
+            run['status'] = "failed"
+            run['error_message'] = str(e)
+        run['finished_at'] = datetime.utcnow()
+
+    threading.Thread(target=target, daemon=True).start()
+    return run_id
+
+
+def get_sync_run(run_id):
+    """Get a background sync run started by start_sync_all()"""
+    with _runs_lock:
+        return _runs.get(run_id)
+
+
+def _active_connections(source_types=None, user_ids=None):
+    """Active connections with a registered sync function and no job in flight"""
+    query = db.session.query(
+        UserDataSource.user_id, DataSource.id, DataSource.name, DataSource.source_type
+    ).join(DataSource, UserDataSource.data_source_id == DataSource.id).filter(
+        UserDataSource.is_active == True,
+        DataSource.source_type.in_(list(job_queue.source_types))
+    )
+    if source_types:
+        query = query.filter(DataSource.source_type.in_(source_types))
+    if user_ids:
+        query = query.filter(UserDataSource.user_id.in_(user_ids))
+
+    in_flight = set(
+        db.session.query(SyncJob.user_id, SyncJob.data_source_id)
+        .filter(SyncJob.status.in_(("queued", "running"))).distinct().all()
+    )
+
+    return [
+        {
+            'user_id': user_id,
+            'data_source_id': data_source_id,
+            'data_source_name': name,
+            'source_type': source_type
+        }
+        for user_id, data_source_id, name, source_type in query.order_by(UserDataSource.user_id).all()
+        if (user_id, data_source_id) not in in_flight
+    ]
+
+
+def _sync_connection(app, connection):
+    """Sync one connection on a pool thread with its own app context and session"""
+    with app.app_context():
+        sync_log = start_sync_log(connection['user_id'], connection['data_source_id'])
+        try:
+            sync_log, stats = job_queue.run_handler(
+                job_queue.source_types[connection['source_type']],
+                connection['user_id'],
+                connection['data_source_id'],
+                sync_log
+            )
+        except SyncInProgress:
+            # Nothing ran, so drop the log instead of recording a failure;
+            # sync_all counts the connection as skipped
+            db.session.delete(sync_log)
+            db.session.commit()
+            raise
+        except Exception as e:
+            fail_sync_log(sync_log, e)
+            raise
+        return stats
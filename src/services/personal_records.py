@@ -0,0 +1,136 @@
+import logging
+from itertools import groupby
+from src.models.user import db
+from src.models.workout import Workout, WorkoutExercise, PersonalRecord
+
+logger = logging.getLogger(__name__)
+
+# Joined workout rows streamed from the database at a time when rebuilding
+REBUILD_BATCH_SIZE = 5000
+
+
+def epley(weight, reps):
+    """Estimated one-rep max of a set (Epley); a single rep is the weight itself"""
+    if not weight or not reps:
+        return None
+    if reps == 1:
+        return weight
+    return weight * (1 + reps / 30)
+
+
+def session_bests(performed_at, sets):
+    """Bests of one exercise within one workout, keyed like PersonalRecord columns
+
+    sets is a list of (sets, reps, weight) rows logged for the exercise. The
+    heaviest row is taken as the session's top set for the last_* values.
+    """
+    weights = [weight for _, _, weight in sets if weight]
+    e1rms = [e1rm for e1rm in (epley(weight, reps) for _, reps, weight in sets) if e1rm]
+    volume = sum(count * reps * weight for count, reps, weight in sets if count and reps and weight)
+    top_set = max(sets, key=lambda row: row[2] or 0)
+    return {
+        'best_weight': max(weights) if weights else None,
+        'best_e1rm': max(e1rms) if e1rms else None,
+        'best_volume': volume or None,
+        'last_performed_at': performed_at,
+        'last_sets': top_set[0],
+        'last_reps': top_set[1],
+        'last_weight': top_set[2]
+    }
+
+
+def record_sessions(user_id, sessions):
+    """Fold exercise sessions into a user's personal records
+
+    sessions is an iterable of (exercise_id, performed_at, sets) with sets as
+    in session_bests(). Records only move forward: a best is replaced by a
+    higher value and the last performance by a later one, so sessions can be
+    recorded in any order and more than once. Loads the affected records in
+    one query; the caller commits. Returns the number of records touched.
+    """
+    bests_by_exercise = {}
+    for exercise_id, performed_at, sets in sessions:
+        if sets:
+            bests_by_exercise.setdefault(exercise_id, []).append(session_bests(performed_at, sets))
+
+    if not bests_by_exercise:
+        return 0
+
+    records = {
+        record.exercise_id: record
+        for record in PersonalRecord.query.filter(
+            PersonalRecord.user_id == user_id,
+            PersonalRecord.exercise_id.in_(list(bests_by_exercise))
+        ).all()
+    }
+    for exercise_id, bests in bests_by_exercise.items():
+        record = records.get(exercise_id)
+        if record is None:
+            record = PersonalRecord(user_id=user_id, exercise_id=exercise_id)
+            db.session.add(record)
+        for session in bests:
+            _merge(record, session)
+    return len(bests_by_exercise)
+
+
+def _merge(record, session):
+    """Raise a record's bests and last performance to a session's where it beats them"""
+    for best in ('best_weight', 'best_e1rm', 'best_volume'):
+        value = session[best]
+        current = getattr(record, best)
+        if value is not None and (current is None or value > current):
+            setattr(record, best, value)
+            setattr(record, f'{best}_at', session['last_performed_at'])
+
+    performed_at = session['last_performed_at']
+    if performed_at is not None and (record.last_performed_at is None or performed_at >= record.last_performed_at):
+        record.last_performed_at = performed_at
+        record.last_sets = session['last_sets']
+        record.last_reps = session['last_reps']
+        record.last_weight = session['last_weight']
+
+
+def rebuild_personal_records(user_id=None):
+    """Recompute personal records from the full workout history
+
+    Needed after workouts are edited down or deleted, since incremental
+    updates only ever raise a record. Streams one joined query ordered by
+    user and workout and commits once. Returns the number of records written.
+    """
+    records = PersonalRecord.query
+    if user_id is not None:
+        records = records.filter(PersonalRecord.user_id == user_id)
+    records.delete(synchronize_session=False)
+
+    rows = db.session.query(
+        Workout.user_id, Workout.id, Workout.workout_date,
+        WorkoutExercise.exercise_id, WorkoutExercise.sets, WorkoutExercise.reps, WorkoutExercise.weight
+    ).join(
+        Workout, WorkoutExercise.workout_id == Workout.id
+    )
+    if user_id is not None:
+        rows = rows.filter(Workout.user_id == user_id)
+    rows = rows.order_by(Workout.user_id, Workout.id, WorkoutExercise.exercise_id, WorkoutExercise.id)
+
+    written = 0
+    for row_user_id, user_rows in groupby(rows.yield_per(REBUILD_BATCH_SIZE), key=lambda row: row.user_id):
+        sessions = []
+        for (_, exercise_id, performed_at), session_rows in groupby(
+            user_rows, key=lambda row: (row.id, row.exercise_id, row.workout_date)
+        ):
+            sessions.append((exercise_id, performed_at, [(row.sets, row.reps, row.weight) for row in session_rows]))
+        written += record_sessions(row_user_id, sessions)
+
+    db.session.commit()
+    logger.info(f"Rebuilt {written} personal records" + (f" for user {user_id}" if user_id is not None else ""))
+    return written
+
+
+def get_personal_record(user_id, exercise_id):
+    """A user's personal record for an exercise, or None"""
+    return PersonalRecord.query.filter_by(user_id=user_id, exercise_id=exercise_id).first()
+
+
+def get_personal_records(user_id):
+    """All of a user's personal records, most recently performed first"""
+    return PersonalRecord.query.filter_by(user_id=user_id).order_by(PersonalRecord.last_performed_at.desc()).all()
@@ -0,0 +1,64 @@
+import queue
+import threading
+from collections import OrderedDict
+
+# Latest event kept per sync so late subscribers start from current progress;
+# the oldest syncs are forgotten beyond this many
+MAX_TRACKED_SYNCS = 1000
+
+# Events buffered per subscriber; a subscriber that falls further behind
+# misses intermediate events, which later events supersede
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class ProgressBroker:
+    """In-process pub/sub for sync progress events, keyed by SyncLog id
+
+    The ingestion pipeline and job queue publish; SSE streams subscribe.
+    Publishing never blocks and never touches the database. Events only reach
+    subscribers in the publishing process; syncs also store their progress
+    on the SyncLog, which streams in other processes read.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._latest = OrderedDict()
+        self._lock = threading.Lock()
+
+    def publish(self, sync_log_id, event):
+        """Send an event to everyone following a sync"""
+        if sync_log_id is None:
+            return
+
+        event = dict(event, sync_log_id=sync_log_id)
+        with self._lock:
+            self._latest[sync_log_id] = event
+            self._latest.move_to_end(sync_log_id)
+            while len(self._latest) > MAX_TRACKED_SYNCS:
+                self._latest.popitem(last=False)
+            subscribers = list(self._subscribers.get(sync_log_id, ()))
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def subscribe(self, sync_log_id):
+        """Follow a sync, returning the subscriber queue and the latest event so far"""
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(sync_log_id, []).append(subscriber)
+            return subscriber, self._latest.get(sync_log_id)
+
+    def unsubscribe(self, sync_log_id, subscriber):
+        """Stop following a sync"""
+        with self._lock:
+            subscribers = self._subscribers.get(sync_log_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self._subscribers.pop(sync_log_id, None)
+
+
+progress = ProgressBroker()
@@ -0,0 +1,233 @@
+from collections import deque
+
+# Keywords scoring each chat intent; an intent scores one point per keyword
+# found anywhere in the query
+INTENT_KEYWORDS = {
+    'activity': ['activity', 'activities', 'run', 'running', 'walk', 'walking', 'cycle', 'cycling', 'steps', 'distance', 'strava'],
+    'food': ['food', 'eat', 'eating', 'nutrition', 'diet', 'calories', 'carbs', 'protein', 'fat', 'meal', 'breakfast', 'lunch', 'dinner', 'snack', 'healthifyme'],
+    'sleep': ['sleep', 'slept', 'bedtime', 'wake', 'rem', 'deep', 'light', 'apple health', 'oura', 'fitbit'],
+    'blood': ['blood', 'test', 'report', 'cholesterol', 'glucose', 'hemoglobin', 'lab'],
+    'medication': ['medication', 'medicine', 'pill', 'drug', 'prescription', 'dose', 'dosage'],
+    'workout': ['workout', 'exercise', 'gym', 'weight', 'strength', 'training', 'hevy', 'bench', 'squat', 'deadlift'],
+    'summary': ['summary', 'overall', 'health', 'status', 'dashboard', 'overview'],
+    'comparison': ['compare', 'comparison', 'versus', 'vs', 'difference', 'between', 'than']
+}
+
+# Phrases naming a time range, in priority order, and the range they select
+TIME_RANGES = [
+    ('today', 'today'),
+    ('yesterday', 'yesterday'),
+    ('this week', 'this week'),
+    ('last week', 'last week'),
+    ('this month', 'this month'),
+    ('last month', 'last month'),
+    ('this year', 'this year'),
+    ('last year', 'last year'),
+    ('past week', 'past week'),
+    ('past month', 'past month'),
+    ('past year', 'past year'),
+    ('last 7 days', 'past week'),
+    ('last 30 days', 'past month'),
+    ('last 365 days', 'past year')
+]
+DEFAULT_TIME_RANGE = 'this week'
+
+# Entities the handlers look for, each list in priority order
+MEAL_TYPES = ['breakfast', 'lunch', 'dinner', 'snack']
+COMMON_EXERCISES = ['bench press', 'squat', 'deadlift', 'pull up', 'shoulder press', 'bicep curl']
+BLOOD_METRICS = [
+    ('cholesterol', ['cholesterol', 'ldl', 'hdl']),
+    ('glucose', ['glucose', 'blood sugar']),
+    ('hemoglobin', ['hemoglobin', 'hgb', 'hb']),
+    ('white blood cell', ['white blood cell', 'wbc']),
+    ('red blood cell', ['red blood cell', 'rbc']),
+    ('platelet', ['platelet']),
+    ('vitamin d', ['vitamin d']),
+    ('vitamin b12', ['vitamin b12']),
+    ('iron', ['iron']),
+    ('thyroid', ['thyroid', 'tsh', 't3', 't4'])
+]
+COMPARISON_PERIODS = ['today', 'yesterday', 'this week', 'last week', 'this month', 'last month']
+COMPARISON_METRICS = ['steps', 'calories', 'sleep', 'heart rate', 'weight']
+
+# Other terms the handlers branch on
+METRIC_TERMS = [
+    'steps', 'distance', 'heart rate', 'heartrate', 'calories', 'protein', 'carbs', 'carbohydrates', 'fat',
+    'deep sleep', 'rem', 'score', 'volume', 'duration', 'time', ' vs ', 'activity', 'food', 'nutrition',
+    'sleep', 'workout', 'exercise', 'personal record', 'personal best', 'best', 'max'
+]
+
+
+class PatternMatcher:
+    """Aho-Corasick automaton finding every pattern occurring in a text in one pass
+
+    Matches are substrings, like `pattern in text`, so 'run' is found in
+    'running'. The goto and failure links are folded into a full transition
+    table at build time, making each character of the text one dict lookup.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        transitions = [{}]
+        outputs = [set()]
+
+        # Trie of the patterns
+        for pattern in self.patterns:
+            state = 0
+            for char in pattern:
+                if char not in transitions[state]:
+                    transitions.append({})
+                    outputs.append(set())
+                    transitions[state][char] = len(transitions) - 1
+                state = transitions[state][char]
+            outputs[state].add(pattern)
+
+        # Breadth-first over the trie: each state inherits the transitions and
+        # outputs of its failure state, which is shallower and already complete
+        failure = [0] * len(transitions)
+        pending = deque(transitions[0].values())
+        while pending:
+            state = pending.popleft()
+            outputs[state] |= outputs[failure[state]]
+            for char, target in list(transitions[state].items()):
+                fallback = failure[state]
+                failure[target] = transitions[fallback].get(char, 0) if state else 0
+                pending.append(target)
+            for char, target in transitions[failure[state]].items():
+                transitions[state].setdefault(char, target)
+
+        self._transitions = transitions
+        self._outputs = [frozenset(output) for output in outputs]
+
+    def find(self, text):
+        """Set of patterns occurring anywhere in text"""
+        transitions = self._transitions
+        outputs = self._outputs
+        found = set()
+        state = 0
+        for char in text:
+            state = transitions[state].get(char, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return found
+
+
+class ParsedQuery:
+    """Structured reading of a chat query shared by all the chat handlers
+
+    Built from the set of patterns found in the text, working through the
+    handful of matched terms rather than the whole vocabulary.
+    """
+
+    def __init__(self, text, terms):
+        self.text = text
+        self.terms = terms
+
+        # Positions of the matched items within each priority-ordered list
+        self.intent_scores = dict.fromkeys(INTENT_KEYWORDS, 0)
+        positions = {field: set() for field in _FIELDS}
+        for term in terms:
+            for intent in _INTENTS_BY_KEYWORD.get(term, ()):
+                self.intent_scores[intent] += 1
+            for field, position in _POSITIONS_BY_TERM.get(term, ()):
+                positions[field].add(position)
+        self.intent = _pick_intent(self.intent_scores, terms)
+
+        ordered = {field: [items[position] for position in sorted(positions[field])] for field, items in _FIELDS.items()}
+        self.time_range_given = bool(ordered['time_ranges'])
+        self.time_range = ordered['time_ranges'][0][1] if ordered['time_ranges'] else DEFAULT_TIME_RANGE
+        self.meal_types = ordered['meal_types']
+        self.exercises = ordered['exercises']
+        self.blood_metrics = [name for name, _ in ordered['blood_metrics']]
+        self.periods = ordered['periods']
+        self.metrics = ordered['metrics']
+
+    def has(self, *terms):
+        """Whether any of the terms occurs in the query"""
+        return any(term in self.terms for term in terms)
+
+    def to_dict(self):
+        return {
+            'text': self.text,
+            'intent': self.intent,
+            'intent_scores': self.intent_scores,
+            'time_range': self.time_range,
+            'time_range_given': self.time_range_given,
+            'meal_types': self.meal_types,
+            'exercises': self.exercises,
+            'blood_metrics': self.blood_metrics,
+            'periods': self.periods,
+            'metrics': self.metrics
+        }
+
+
+def _pick_intent(scores, terms):
+    """The single top-scoring intent, falling back to comparison or summary on ties"""
+    max_score = max(scores.values())
+    if max_score > 0:
+        top_intents = [intent for intent, score in scores.items() if score == max_score]
+        if len(top_intents) == 1:
+            return top_intents[0]
+
+    if 'compare' in terms or ' vs ' in terms or 'versus' in terms:
+        return 'comparison'
+
+    return 'summary'
+
+
+def _vocabulary():
+    words = [keyword for keywords in INTENT_KEYWORDS.values() for keyword in keywords]
+    words += [phrase for phrase, _ in TIME_RANGES]
+    words += MEAL_TYPES + COMMON_EXERCISES + COMPARISON_PERIODS + COMPARISON_METRICS + METRIC_TERMS
+    words += [keyword for _, keywords in BLOOD_METRICS for keyword in keywords]
+    return words
+
+
+# Priority-ordered lists a query's matches are reported in
+_FIELDS = {
+    'time_ranges': TIME_RANGES,
+    'meal_types': MEAL_TYPES,
+    'exercises': COMMON_EXERCISES,
+    'blood_metrics': BLOOD_METRICS,
+    'periods': COMPARISON_PERIODS,
+    'metrics': COMPARISON_METRICS
+}
+
+
+def _build_lookups():
+    """Map each term to the intents it scores for and the list positions it selects"""
+    intents_by_keyword = {}
+    for intent, keywords in INTENT_KEYWORDS.items():
+        for keyword in keywords:
+            intents_by_keyword.setdefault(keyword, []).append(intent)
+
+    positions_by_term = {}
+    for field, items in _FIELDS.items():
+        for position, item in enumerate(items):
+            if field == 'time_ranges':
+                terms = [item[0]]
+            elif field == 'blood_metrics':
+                terms = item[1]
+            else:
+                terms = [item]
+            for term in terms:
+                positions_by_term.setdefault(term, []).append((field, position))
+    return intents_by_keyword, positions_by_term
+
+
+# Built once at import
+_INTENTS_BY_KEYWORD, _POSITIONS_BY_TERM = _build_lookups()
+matcher = PatternMatcher(_vocabulary())
+
+
+def parse_query(query):
+    """Parse a chat query in a single pass over its text
+
+    Accepts raw text or an already parsed query, which is returned as is,
+    so handlers can be called with either.
+    """
+    if isinstance(query, ParsedQuery):
+        return query
+
+    text = query.lower().strip()
+    return ParsedQuery(text, matcher.find(text))
@@ -0,0 +1,72 @@
+from datetime import datetime
+from src.models.user import db
+
+
+def reconcile_children(child_model, parent_column, key_columns, incoming_by_parent):
+    """Bring the stored child rows of several parents in line with incoming rows
+
+    Incoming rows are matched to stored rows by a stable key: the key columns
+    plus the occurrence number among rows of the same parent sharing that key,
+    so repeated entries (the same food twice in a meal) pair up in order.
+    Matched rows are updated only if a column changed, unmatched incoming rows
+    are inserted and unmatched stored rows are deleted, all with bulk
+    statements. Parents mapped to an empty list lose all their children.
+
+    Returns the number of rows inserted, updated and deleted.
+    """
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0}
+    if not incoming_by_parent:
+        return counts
+
+    value_columns = sorted({column for rows in incoming_by_parent.values() for row in rows for column in row} - {parent_column})
+    parent_attr = getattr(child_model, parent_column)
+
+    # Load only the columns being compared, never full ORM objects
+    stored = db.session.query(
+        child_model.id, parent_attr, *[getattr(child_model, column) for column in value_columns]
+    ).filter(parent_attr.in_(list(incoming_by_parent))).order_by(child_model.id).all()
+
+    stored_by_key = {}
+    for row in stored:
+        values = dict(zip(value_columns, row[2:]))
+        key = (row[1],) + tuple(values.get(column) for column in key_columns)
+        stored_by_key.setdefault(key, []).append((row[0], values))
+
+    now = datetime.utcnow()
+    inserts = []
+    updates = []
+    for parent_id, rows in incoming_by_parent.items():
+        occurrences = {}
+        for row in rows:
+            key = (parent_id,) + tuple(row.get(column) for column in key_columns)
+            index = occurrences.get(key, 0)
+            occurrences[key] = index + 1
+
+            matches = stored_by_key.get(key, [])
+            if index < len(matches):
+                child_id, values = matches[index]
+                changed = {column: row.get(column) for column in value_columns if row.get(column) != values.get(column)}
+                if changed:
+                    changed['id'] = child_id
+                    changed['updated_at'] = now
+                    updates.append(changed)
+            else:
+                inserts.append(dict(row, **{parent_column: parent_id}))
+
+        # Stored rows beyond the incoming occurrences are left over for deletion
+        for key, count in occurrences.items():
+            stored_by_key[key] = stored_by_key.get(key, [])[count:]
+
+    deletes = [child_id for matches in stored_by_key.values() for child_id, _ in matches]
+
+    if inserts:
+        db.session.bulk_insert_mappings(child_model, inserts)
+    if updates:
+        db.session.bulk_update_mappings(child_model, updates)
+    if deletes:
+        db.session.query(child_model).filter(child_model.id.in_(deletes)).delete(synchronize_session=False)
+
+    counts['inserted'] = len(inserts)
+    counts['updated'] = len(updates)
+    counts['deleted'] = len(deletes)
+    return counts
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import func, update
+from src.models.user import db, User
+
+# Most chat responses kept; the least recently used are evicted beyond this
+CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', 1000))
+
+# Seconds a response stays cached. Data changes invalidate responses through
+# the user's data version; this only bounds answers that depend on the time
+# of day, like doses due so far today.
+CACHE_TTL = int(os.getenv('CHAT_CACHE_TTL', 900))
+
+
+def bump_data_version(user_id):
+    """Mark a user's health data as changed, invalidating their cached chat responses
+
+    Call in the transaction making the change, so the new version commits
+    with the data.
+    """
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(data_version=func.coalesce(User.data_version, 0) + 1)
+    )
+
+
+def get_data_version(user_id):
+    """A user's current data version, or None if the user does not exist"""
+    row = db.session.query(User.id, User.data_version).filter(User.id == user_id).first()
+    if row is None:
+        return None
+    return row.data_version or 0
+
+
+class ResponseCache:
+    """LRU cache of chat responses keyed on the user's data version
+
+    Keys are (user_id, data_version, intent, matched terms, resolved date
+    range), so rephrasings the parser reads the same way share an entry.
+    Medication queries also key on their normalized text, which the handler
+    searches for medication names. Any write to a user's data bumps their
+    version, so a cached response is never older than the data it was
+    computed from; stale entries are never hit again and age out of the LRU.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(user_id, data_version, query, date_range):
+        """Cache key for a parsed query answered over a resolved date range
+
+        Handlers only read the query through its intent, the fields parsed
+        from its terms and has(), so the terms stand in for the text.
+        """
+        start_date, end_date = date_range
+        text = ' '.join(query.text.split()) if query.intent == 'medication' else None
+        return (int(user_id), data_version, query.intent, frozenset(query.terms), text, start_date, end_date)
+
+    def get(self, key):
+        """Cached (response, data_sources_used) for a key, or None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], list(entry[2])
+
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, response, data_sources_used):
+        """Cache a response, evicting the least recently used beyond max_size"""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), response, list(data_sources_used))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Hit and miss counters and the current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None
+            }
+
+
+response_cache = ResponseCache()
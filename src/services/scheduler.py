@@ -0,0 +1,157 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from src.models.user import db
+from src.models.data_source import DataSource, UserDataSource, SyncJob
+from src.services.job_queue import job_queue
+
+logger = logging.getLogger(__name__)
+
+# Interval between scheduled syncs for each sync_frequency
+SYNC_INTERVALS = {
+    'hourly': timedelta(hours=1),
+    'daily': timedelta(days=1),
+    'weekly': timedelta(weeks=1)
+}
+
+# Seconds between scheduler passes over the connections
+SCHEDULER_TICK = int(os.getenv('SYNC_SCHEDULER_TICK', 60))
+
+# Most jobs queued in one pass, so a backlog of overdue connections (after
+# downtime, or on first start) drains gradually instead of all at once
+MAX_DISPATCH_PER_TICK = int(os.getenv('SYNC_SCHEDULER_MAX_DISPATCH', 20))
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def sync_interval(frequency):
+    """Interval for a sync_frequency value, defaulting to daily"""
+    return SYNC_INTERVALS.get(frequency, SYNC_INTERVALS['daily'])
+
+
+def sync_phase(user_id, data_source_id, interval):
+    """Stable offset of a connection's sync slot within its interval
+
+    Hashing the connection spreads users evenly across the interval instead
+    of syncing everyone at the top of the hour, and keeps each connection in
+    the same slot from one run to the next.
+    """
+    digest = hashlib.sha256(f"{user_id}:{data_source_id}".encode('utf-8')).digest()
+    fraction = int.from_bytes(digest[:8], 'big') / 2 ** 64
+    return timedelta(seconds=interval.total_seconds() * fraction)
+
+
+def next_sync_due(user_data_source, last_attempt=None):
+    """Next time a connection should be synced
+
+    Slots repeat every interval at the connection's phase. The next sync is
+    the first slot at least half an interval after the last sync or queued
+    attempt, so a manual sync just before a slot pushes it to the following
+    one. Connections never synced use the first slot after they were created.
+    """
+    interval = sync_interval(user_data_source.sync_frequency)
+    phase = sync_phase(user_data_source.user_id, user_data_source.data_source_id, interval)
+
+    attempts = [t for t in (user_data_source.last_sync_at, last_attempt) if t is not None]
+    if attempts:
+        earliest = max(attempts) + interval / 2
+    else:
+        earliest = user_data_source.created_at or datetime.utcnow()
+
+    slots = math.ceil((earliest - _EPOCH - phase) / interval)
+    return _EPOCH + phase + slots * interval
+
+
+class SyncScheduler:
+    """Queues sync jobs for active connections as they come due
+
+    Runs in-process on a background thread and feeds the job queue, which
+    does the actual syncing.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._thread = None
+
+    def init_app(self, app):
+        """Bind the app the scheduler runs in; starts nothing"""
+        self.app = app
+
+    def start(self, tick=SCHEDULER_TICK):
+        """Start the scheduler thread; run by one process only"""
+        self._thread = threading.Thread(target=self._loop, args=(tick,), daemon=True)
+        self._thread.start()
+
+    def schedule(self, user_id=None):
+        """Every schedulable active connection with its next due time
+
+        Returns (due_at, user_data_source, data_source, job_type, in_flight)
+        tuples sorted by due time.
+        """
+        query = db.session.query(UserDataSource, DataSource).join(
+            DataSource, UserDataSource.data_source_id == DataSource.id
+        ).filter(UserDataSource.is_active == True)
+        if user_id is not None:
+            query = query.filter(UserDataSource.user_id == user_id)
+        connections = query.all()
+
+        # Latest queued attempt and in-flight jobs per connection, one query each
+        last_attempts = {
+            (row[0], row[1]): row[2]
+            for row in db.session.query(
+                SyncJob.user_id, SyncJob.data_source_id, func.max(SyncJob.created_at)
+            ).group_by(SyncJob.user_id, SyncJob.data_source_id).all()
+        }
+        in_flight = set(
+            db.session.query(SyncJob.user_id, SyncJob.data_source_id)
+            .filter(SyncJob.status.in_(("queued", "running"))).distinct().all()
+        )
+
+        schedule = []
+        for user_data_source, data_source in connections:
+            job_type = job_queue.source_types.get(data_source.source_type)
+            if job_type is None:
+                continue
+
+            key = (user_data_source.user_id, user_data_source.data_source_id)
+            due_at = next_sync_due(user_data_source, last_attempts.get(key))
+            schedule.append((due_at, user_data_source, data_source, job_type, key in in_flight))
+
+        schedule.sort(key=lambda item: item[0])
+        return schedule
+
+    def tick(self, now=None):
+        """Queue jobs for connections that are due, returning the jobs queued"""
+        now = now or datetime.utcnow()
+        due = [item for item in self.schedule() if item[0] <= now and not item[4]]
+
+        jobs = []
+        for due_at, user_data_source, data_source, job_type, _ in due[:MAX_DISPATCH_PER_TICK]:
+            jobs.append(job_queue.enqueue(
+                job_type,
+                user_data_source.user_id,
+                data_source.id,
+                payload={'scheduled': True}
+            ))
+
+        if due:
+            logger.info(f"Scheduler queued {len(jobs)} of {len(due)} due syncs")
+        return jobs
+
+    def _loop(self, tick):
+        """Scheduler loop: queue due syncs every tick seconds"""
+        while True:
+            try:
+                with self.app.app_context():
+                    self.tick()
+            except Exception as e:
+                logger.error(f"Sync scheduler error: {str(e)}")
+            time.sleep(tick)
+
+
+sync_scheduler = SyncScheduler()
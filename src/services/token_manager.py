@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from src.models.user import db
+from src.models.data_source import DataSource, UserDataSource
+
+logger = logging.getLogger(__name__)
+
+# Tokens expiring within this margin are refreshed ahead of time by the
+# background refresher, and on demand if it has not got to them yet
+REFRESH_MARGIN = timedelta(seconds=int(os.getenv('TOKEN_REFRESH_MARGIN', 600)))
+
+# Seconds between background scans for tokens nearing expiry
+REFRESH_SCAN_INTERVAL = int(os.getenv('TOKEN_REFRESH_SCAN_INTERVAL', 60))
+
+
+class TokenManager:
+    """Hands out valid OAuth access tokens and refreshes them before they expire
+
+    Valid tokens are cached in memory per UserDataSource, so syncs get one
+    without a database round trip. A cached token is only used while the
+    connection's stored token_expires_at still matches it, so tokens changed
+    by another process, like a reauthorization in the web server, replace it.
+    Refreshes are single-flight within a process: concurrent callers for the
+    same connection wait on one refresh instead of racing on the stored
+    tokens.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.refreshers = {}
+        self._cache = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._thread = None
+
+    def refresher(self, source_name):
+        """Register the function that refreshes a data source's tokens
+
+        The function is called with a UserDataSource, must store the new
+        tokens on it and returns {'success': True} or {'success': False,
+        'error': ...}.
+        """
+        def decorator(func):
+            self.refreshers[source_name] = func
+            return func
+        return decorator
+
+    def init_app(self, app):
+        """Bind the app the refresher runs in; starts nothing"""
+        self.app = app
+
+    def start(self, interval=REFRESH_SCAN_INTERVAL):
+        """Start the background refresher; run by one process only"""
+        self._thread = threading.Thread(target=self._loop, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def get_access_token(self, user_data_source):
+        """Valid access token for a connection, refreshing it first if needed
+
+        Raises RuntimeError if the token is expiring and cannot be refreshed.
+        """
+        cached = self._cache.get(user_data_source.id)
+        if cached and cached[1] == user_data_source.token_expires_at and not _expiring(cached[1]):
+            return cached[0]
+
+        return self.refresh(user_data_source)
+
+    def refresh(self, user_data_source, rejected=None):
+        """Refresh a connection's tokens if they are still expiring once we hold its lock
+
+        Passing the access token an API rejected refreshes the tokens if that
+        token is still the stored one, whatever its expiry. Returns the valid
+        access token.
+        """
+        source_name = user_data_source.data_source.name
+        refresher = self.refreshers.get(source_name)
+
+        with self._lock_for(user_data_source.id):
+            # Another thread may have refreshed while we waited for the lock,
+            # or another process since the connection was loaded, so decide
+            # on the stored tokens
+            db.session.refresh(user_data_source)
+            stale = rejected is not None and user_data_source.access_token == rejected
+            if refresher is not None and (stale or _expiring(user_data_source.token_expires_at)):
+                logger.info(f"Refreshing {source_name} token for user {user_data_source.user_id}")
+                result = refresher(user_data_source)
+                if not result['success']:
+                    self._cache.pop(user_data_source.id, None)
+                    raise RuntimeError(f"Failed to refresh {source_name} token: {result['error']}")
+
+            self._cache[user_data_source.id] = (user_data_source.access_token, user_data_source.token_expires_at)
+            return user_data_source.access_token
+
+    def invalidate(self, user_data_source_id):
+        """Forget a connection's cached token, e.g. after it is reauthorized"""
+        self._cache.pop(user_data_source_id, None)
+
+    def refresh_expiring(self):
+        """Refresh every active connection whose token expires within the margin"""
+        if not self.refreshers:
+            return
+
+        expiring = UserDataSource.query.join(
+            DataSource, UserDataSource.data_source_id == DataSource.id
+        ).filter(
+            UserDataSource.is_active == True,
+            UserDataSource.refresh_token.isnot(None),
+            UserDataSource.token_expires_at < datetime.utcnow() + REFRESH_MARGIN,
+            DataSource.name.in_(list(self.refreshers))
+        ).all()
+
+        for user_data_source in expiring:
+            try:
+                self.refresh(user_data_source)
+            except Exception as e:
+                logger.error(f"Background token refresh failed for connection {user_data_source.id}: {str(e)}")
+
+    def _lock_for(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _loop(self, interval):
+        """Background loop: refresh tokens nearing expiry every interval seconds"""
+        while True:
+            try:
+                with self.app.app_context():
+                    self.refresh_expiring()
+            except Exception as e:
+                logger.error(f"Token refresher error: {str(e)}")
+            time.sleep(interval)
+
+
+def _expiring(expires_at):
+    """Whether a token expiring at expires_at is due for a refresh"""
+    return expires_at is not None and expires_at < datetime.utcnow() + REFRESH_MARGIN
+
+
+token_manager = TokenManager()
@@ -0,0 +1,66 @@
+from sqlalchemy import func
+from src.models.user import db
+from src.models.workout import Workout, WorkoutExercise
+from src.services.aggregates import aggregate_by, total
+
+
+def workout_summary(user_id, start_date, end_date):
+    """Workouts in a date range per workout name, most frequent first, in one query
+
+    Each group holds the number of workouts and their total duration and
+    calories; names done equally often are ordered by most recent.
+    """
+    return aggregate_by(
+        Workout, user_id, Workout.workout_date, start_date, end_date, Workout.workout_name,
+        order_by=(func.count(Workout.id).desc(), func.max(Workout.workout_date).desc()),
+        count=func.count(Workout.id),
+        total_duration=total(Workout.duration),
+        total_calories=total(Workout.calories_burned)
+    )
+
+
+def exercise_history(user_id, exercise_id, start_date, end_date):
+    """Every set logged for an exercise in a date range, most recent first, in one joined query
+
+    Returns dicts with the workout date, sets, reps and weight.
+    """
+    rows = db.session.query(
+        Workout.workout_date, WorkoutExercise.sets, WorkoutExercise.reps, WorkoutExercise.weight
+    ).join(
+        Workout, WorkoutExercise.workout_id == Workout.id
+    ).filter(
+        Workout.user_id == user_id,
+        Workout.workout_date >= start_date,
+        Workout.workout_date <= end_date,
+        WorkoutExercise.exercise_id == exercise_id
+    ).order_by(Workout.workout_date.desc(), Workout.id, WorkoutExercise.id).all()
+
+    return [dict(row._mapping) for row in rows]
+
+
+def volume_by_exercise(user_id, start_date, end_date):
+    """Training volume (sets x reps x weight) per exercise and day in one joined aggregate query
+
+    Exercises missing sets, reps or weight add no volume. Returns dicts with
+    exercise_id, day ('YYYY-MM-DD') and volume, oldest day first, so each
+    exercise's entries trace its progression.
+    """
+    day = func.date(Workout.workout_date)
+    rows = db.session.query(
+        WorkoutExercise.exercise_id,
+        day.label('day'),
+        total(WorkoutExercise.sets * WorkoutExercise.reps * WorkoutExercise.weight).label('volume')
+    ).join(
+        Workout, WorkoutExercise.workout_id == Workout.id
+    ).filter(
+        Workout.user_id == user_id,
+        Workout.workout_date >= start_date,
+        Workout.workout_date <= end_date
+    ).group_by(WorkoutExercise.exercise_id, day).order_by(day, WorkoutExercise.exercise_id).all()
+
+    return [dict(row._mapping) for row in rows]
+
+
+def total_volume(user_id, start_date, end_date):
+    """Total training volume in a date range"""
+    return sum(row['volume'] for row in volume_by_exercise(user_id, start_date, end_date))
@@ -46,6 +46,15 @@ document.addEventListener('DOMContentLoaded', function() {
         // Get current user ID (in a real app, this would be from auth)
         const userId = 1; // Placeholder
         
+        // Stream the response, falling back to a single request without stream support
+        if (!window.ReadableStream || !window.TextDecoder) {
+            fetchChatResponse(userId, message);
+            return;
+        }
+        streamChatResponse(userId, message);
+    }
+    
+    function fetchChatResponse(userId, message) {
         // Send message to backend
         fetch('/api/chat/query', {
             method: 'POST',
@@ -75,6 +84,91 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    function streamChatResponse(userId, message) {
+        // Sections are shown in one message as the server sends them
+        let contentDiv = null;
+        let finished = false;
+        
+        function handleEvent(name, data) {
+            if (name === 'section') {
+                if (!contentDiv) {
+                    contentDiv = addMessageToChat('system', '');
+                    contentDiv.innerHTML = '';
+                }
+                const sectionP = document.createElement('p');
+                sectionP.innerHTML = data.title ? `<strong>${data.title}:</strong> ${data.text}` : data.text;
+                contentDiv.appendChild(sectionP);
+                chatWidgetMessages.scrollTop = chatWidgetMessages.scrollHeight;
+            } else if (name === 'complete') {
+                finished = true;
+            } else if (name === 'error') {
+                finished = true;
+                addMessageToChat('system', 'Sorry, I encountered an error processing your request.');
+                console.error('Chat error:', data.error);
+            }
+        }
+        
+        fetch('/api/chat/query/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                user_id: userId,
+                query: message
+            })
+        })
+        .then(response => {
+            if (!response.ok || !response.body) {
+                throw new Error(`Chat stream failed with status ${response.status}`);
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            
+            // Parse Server-Sent Events as chunks arrive; events end with a blank line
+            function read() {
+                return reader.read().then(({ done, value }) => {
+                    buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+                    
+                    let boundary;
+                    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                        const rawEvent = buffer.slice(0, boundary);
+                        buffer = buffer.slice(boundary + 2);
+                        
+                        let name = 'message';
+                        let data = '';
+                        rawEvent.split('\n').forEach(line => {
+                            if (line.startsWith('event: ')) {
+                                name = line.slice(7);
+                            } else if (line.startsWith('data: ')) {
+                                data += line.slice(6);
+                            }
+                        });
+                        if (data) {
+                            handleEvent(name, JSON.parse(data));
+                        }
+                    }
+                    
+                    if (done) {
+                        if (!finished) {
+                            throw new Error('Chat stream ended before the response was complete');
+                        }
+                        return;
+                    }
+                    return read();
+                });
+            }
+            return read();
+        })
+        .catch(error => {
+            // Add error message
+            addMessageToChat('system', 'Sorry, I encountered an error processing your request.');
+            console.error('Error streaming chat message:', error);
+        });
+    }
+    
     function addMessageToChat(sender, content) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${sender}`;
@@ -88,5 +182,7 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Scroll to bottom
         chatWidgetMessages.scrollTop = chatWidgetMessages.scrollHeight;
+        
+        return contentDiv;
     }
 });
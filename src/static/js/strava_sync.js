@@ -104,6 +104,15 @@ function syncStravaData() {
         return response.json();
     })
     .then(data => {
+        // The sync runs on a background worker; follow its progress
+        return waitForSync(data.sync_log_id, event => {
+            if (syncStatus) {
+                const phases = { queued: 'Queued', pending: 'Queued', running: 'Starting', fetching: 'Fetching', writing: 'Saving', retrying: 'Retrying' };
+                syncStatus.textContent = `${phases[event.phase] || 'Syncing'}... ${event.fetched || 0} fetched, ${event.written || 0} saved`;
+            }
+        });
+    })
+    .then(syncLog => {
         // Update sync status
         if (syncStatus) {
             const lastSyncDate = new Date().toLocaleString();
@@ -112,7 +121,7 @@ function syncStravaData() {
         }
         
         // Show success notification
-        showNotification(data.message, 'success');
+        showNotification(`Successfully synced ${syncLog.items_synced} activities from Strava`, 'success');
         
         // Load activities
         loadStravaActivities();
@@ -139,6 +148,65 @@ function syncStravaData() {
     });
 }
 
+function waitForSync(syncLogId, onProgress) {
+    // Follow the sync's progress stream until it completes
+    if (!window.EventSource) {
+        return pollSync(syncLogId);
+    }
+    
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`/api/sync/${syncLogId}/events`);
+        
+        source.addEventListener('progress', event => {
+            if (onProgress) {
+                onProgress(JSON.parse(event.data));
+            }
+        });
+        
+        source.addEventListener('complete', event => {
+            source.close();
+            const data = JSON.parse(event.data);
+            if (data.status === 'success') {
+                resolve(data);
+            } else {
+                reject(new Error(data.error_message || 'Sync failed'));
+            }
+        });
+        
+        source.onerror = () => {
+            // Stream dropped before completion; fall back to polling
+            source.close();
+            pollSync(syncLogId).then(resolve, reject);
+        };
+    });
+}
+
+function pollSync(syncLogId, interval = 2000) {
+    // Poll the sync status until the worker marks it success or failed
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            fetch(`/api/sync/${syncLogId}`)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`HTTP error! Status: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(data => {
+                    if (data.status === 'success') {
+                        resolve(data.sync_log);
+                    } else if (data.status === 'failed') {
+                        reject(new Error(data.sync_log.error_message || 'Sync failed'));
+                    } else {
+                        setTimeout(poll, interval);
+                    }
+                })
+                .catch(reject);
+        };
+        poll();
+    });
+}
+
 function checkStravaStatus() {
     // Get current user ID (in a real app, this would be from auth)
     const userId = 1; // Placeholder
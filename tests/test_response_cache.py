@@ -0,0 +1,25 @@
+from datetime import datetime
+from src.services.query_parser import parse_query
+from src.services.response_cache import ResponseCache
+
+DATE_RANGE = (datetime(2026, 1, 1), datetime(2026, 1, 31))
+
+
+def key(text):
+    query = parse_query(text)
+    return ResponseCache.key(1, 0, query, DATE_RANGE)
+
+
+def test_rephrased_queries_share_a_key():
+    assert key("How did I sleep this week?") == key("  how did i SLEEP   this week")
+    assert key("show my sleep this week") == key("this week show my sleep")
+
+
+def test_queries_read_differently_get_their_own_key():
+    assert key("how did I sleep this week") != key("how was my deep sleep this week")
+    assert key("bench press progress") != key("bench press personal best")
+
+
+def test_medication_queries_key_on_their_text():
+    assert key("did I take my aspirin medication") != key("did I take my ibuprofen medication")
+    assert key("Did I take my  aspirin medication") == key("did i take my aspirin medication")
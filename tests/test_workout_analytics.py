@@ -0,0 +1,110 @@
+from datetime import timedelta
+import pytest
+from src.models.user import db
+from src.models.data_source import DataSource
+from src.models.workout import Workout, WorkoutExercise, Exercise
+from src.routes.chat import get_date_range, process_workout_query
+from src.services.personal_records import rebuild_personal_records
+from src.services.workout_analytics import workout_summary, exercise_history, volume_by_exercise
+
+EXERCISES = ['Bench Press', 'Squat', 'Deadlift', 'Pull Up', 'Shoulder Press', 'Bicep Curl']
+
+
+def seed_workouts(workouts, sets_per_exercise):
+    """Spread workouts over this month, each logging every exercise"""
+    db.session.add(DataSource(name="Hevy", source_type="workout"))
+    exercises = [Exercise(name=name) for name in EXERCISES]
+    db.session.add_all(exercises)
+    db.session.flush()
+
+    start_date, end_date = get_date_range('this month')
+    step = (end_date - start_date) / (workouts + 1)
+    for index in range(workouts):
+        workout = Workout(
+            user_id=1, source_id=1, workout_name=['Push', 'Pull', 'Legs'][index % 3],
+            workout_date=start_date + step * (index + 1), duration=3600, calories_burned=400
+        )
+        db.session.add(workout)
+        db.session.flush()
+        for exercise in exercises:
+            for set_index in range(sets_per_exercise):
+                db.session.add(WorkoutExercise(
+                    workout_id=workout.id, exercise_id=exercise.id,
+                    sets=1, reps=8, weight=40 + index + set_index * 2.5
+                ))
+    db.session.commit()
+    rebuild_personal_records(1)
+
+
+@pytest.fixture(params=[(1, 1), (30, 5)], ids=['one workout', 'many workouts'])
+def workouts(request, app):
+    seed_workouts(*request.param)
+
+
+@pytest.mark.parametrize('query_text, expected_queries', [
+    ("workout summary this month", 2),
+    ("workout duration this month", 2),
+    ("workout volume this month", 3),
+    ("bench press progress this month", 4),
+    ("bench press personal best", 3),
+])
+def test_process_workout_query_query_count(workouts, count_queries, query_text, expected_queries):
+    with count_queries() as counter:
+        response, _ = process_workout_query(1, query_text)
+
+    assert "couldn't find" not in response
+    assert counter.count == expected_queries, counter.statements
+
+
+def test_workout_summary_is_one_query(workouts, count_queries):
+    start_date, end_date = get_date_range('this month')
+    with count_queries() as counter:
+        groups = workout_summary(1, start_date, end_date)
+
+    assert groups
+    assert counter.count == 1
+
+
+def test_exercise_history_is_one_query(workouts, count_queries):
+    start_date, end_date = get_date_range('this month')
+    exercise = Exercise.query.filter_by(name='Squat').one()
+    with count_queries() as counter:
+        history = exercise_history(1, exercise.id, start_date, end_date)
+
+    assert history
+    assert counter.count == 1
+
+
+def test_volume_by_exercise_is_one_query(workouts, count_queries):
+    start_date, end_date = get_date_range('this month')
+    with count_queries() as counter:
+        volumes = volume_by_exercise(1, start_date, end_date)
+
+    assert len({row['exercise_id'] for row in volumes}) == len(EXERCISES)
+    assert counter.count == 1
+
+
+def test_exercise_history_matches_logged_sets(app, count_queries):
+    seed_workouts(4, 3)
+    start_date, end_date = get_date_range('this month')
+    exercise = Exercise.query.filter_by(name='Deadlift').one()
+
+    history = exercise_history(1, exercise.id, start_date, end_date)
+
+    assert len(history) == 4 * 3
+    assert [row['workout_date'] for row in history] == sorted((row['workout_date'] for row in history), reverse=True)
+
+
+@pytest.mark.parametrize('query_text, all_time', [
+    ("bench press personal best", True),
+    ("bench press personal record this month", True),
+    ("my best bench press", True),
+    ("best bench press session this month", False),
+    ("bench press max weight this month", False),
+])
+def test_personal_records_only_answer_all_time_questions(app, query_text, all_time):
+    seed_workouts(4, 3)
+
+    response, _ = process_workout_query(1, query_text)
+
+    assert ("personal best is" in response) == all_time, response